@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+analyze_audioの結果をディスクにキャッシュするモジュール
+音声ファイルの内容と分析パラメータのハッシュをキーに、NumPyの.npzで保存する
+"""
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from paths import root_path
+
+CACHE_DIR = root_path(".analysis_cache")
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# 保存形式を変えたらここを上げて古いキャッシュを無視する
+CACHE_VERSION = 4
+
+ARRAY_FIELDS = ("beat_times", "onset_times", "beat_feature_times")
+# フレームごとの特徴量（float32のNumPy配列のまま返す）
+FEATURE_FIELDS = ("band_onsets", "rms", "spectral_centroid", "beat_features")
+SCALAR_FIELDS = ("bpm", "duration", "sample_rate", "feature_hop")
+# 区間の推定結果（structure.py の計算だけで決まるので、DSPの結果とは別のエントリに保存する）
+SECTION_FIELDS = ("section_starts", "section_density")
+
+def cache_key(file_path, params):
+    """音声ファイルのバイト列と分析パラメータからキーを作る"""
+    h = hashlib.sha256()
+    h.update(json.dumps({"version": CACHE_VERSION, "params": params}, sort_keys=True).encode())
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def sections_key(key, structure_hash):
+    """DSPの結果のキーと structure.py のハッシュから区間のキーを作る"""
+    return hashlib.sha256(f"sections:{key}:{structure_hash}".encode()).hexdigest()
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], f"{key}.npz")
+
+def _read(path, convert):
+    """.npzを読み、convert(data)の結果を返す（なければ・読めなければNone）"""
+    try:
+        with np.load(path) as data:
+            result = convert(data)
+    except (zipfile.BadZipFile, EOFError):
+        # 書き込み途中で切れた・空のファイルは読めないので、ミスとして扱い消しておく
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    except (OSError, KeyError, ValueError):
+        return None
+    # 最終利用時刻として更新し、追い出しの順序に使う（別のプロセスが追い出した直後なら何もしない）
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return result
+
+def _write(cache_dir, path, arrays, max_bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 書きかけのファイルを読まないよう一時ファイルに書いてから置き換える
+    # （拡張子を .npz にしないので、他のプロセスの evict が書きかけのファイルを消すことはない）
+    fd, tmp_path = tempfile.mkstemp(suffix=".npz.tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    evict(cache_dir, max_bytes)
+
+def load(cache_dir, key):
+    """キャッシュがあれば分析結果（区間を除く）を返す（なければNone）"""
+    def convert(data):
+        analysis = {name: data[name].tolist() for name in ARRAY_FIELDS}
+        analysis.update({name: data[name] for name in FEATURE_FIELDS})
+        analysis.update({name: data[name].item() for name in SCALAR_FIELDS})
+        return analysis
+    return _read(cache_path(cache_dir, key), convert)
+
+def store(cache_dir, key, analysis, max_bytes=CACHE_MAX_BYTES):
+    """分析結果（区間を除く）を保存し、上限を超えていれば古いものから削除する"""
+    arrays = {name: np.asarray(analysis[name], dtype=np.float64) for name in ARRAY_FIELDS}
+    arrays.update({name: np.asarray(analysis[name], dtype=np.float32) for name in FEATURE_FIELDS})
+    arrays.update({name: np.asarray(analysis[name]) for name in SCALAR_FIELDS})
+    _write(cache_dir, cache_path(cache_dir, key), arrays, max_bytes)
+
+def load_sections(cache_dir, key):
+    """sections_key のキーで保存した区間の推定結果を返す（なければNone）"""
+    return _read(cache_path(cache_dir, key), lambda data: {name: data[name].tolist() for name in SECTION_FIELDS})
+
+def store_sections(cache_dir, key, sections, max_bytes=CACHE_MAX_BYTES):
+    """区間の推定結果を sections_key のキーで保存する"""
+    arrays = {name: np.asarray(sections[name], dtype=np.float64) for name in SECTION_FIELDS}
+    _write(cache_dir, cache_path(cache_dir, key), arrays, max_bytes)
+
+def evict(cache_dir, max_bytes=CACHE_MAX_BYTES):
+    """合計サイズがmax_bytes以下になるまで最終利用が古いものから削除"""
+    files = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name.endswith(".npz"):
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
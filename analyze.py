@@ -2,29 +2,96 @@
 """
 音楽ファイルを分析してBPMとビート情報を抽出するツール
 """
-import librosa
 import numpy as np
+import argparse
+import hashlib
 import json
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def analyze_audio(file_path):
-    print(f"楽曲を分析中: {file_path}")
+import analysis_cache
+import chart_engine
+import instrument
+import structure
+from paths import root_path
+
+DIFFICULTIES = ["BEGINNER", "NORMAL", "HYPER", "ANOTHER"]
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".ogg", ".flac", ".m4a")
+
+# 分析パラメータ（キャッシュのキーに含める）。band_edgesはオンセット強度を分ける帯域の境界（Hz）で、
+# 低域（キック・ベース）・中域（ボーカル・スネア）・高域（ハイハット・シンバル）の3帯域になる
+ANALYSIS_PARAMS = {"sr": 22050, "hop_length": 512, "n_fft": 2048, "band_edges": [200.0, 2000.0]}
+# ストリーミング分析で一度に読み込むフレーム数（約6秒分）
+STREAM_BLOCK_FRAMES = 256
+# メルスペクトログラムのdBの下限（最大値からの差。librosa.power_to_db の top_db の既定値）
+TOP_DB = 80.0
+# テンポ推定でテンポグラムを一度に計算するフレーム数
+TEMPO_CHUNK_FRAMES = 4096
+# 構成の推定に使うMFCCの次数
+N_MFCC = 13
+N_CHROMA = 12
+# オンセット由来のノーツの密度の、曲全体の平均に対する区間ごとの倍率の範囲
+SECTION_DENSITY_RANGE = (0.5, 1.5)
+# オンセットのうちノーツにする割合（区間の密度の倍率を掛ける前）
+ONSET_RATIO = 1 / 3
+# 帯域ごとに正規化したオンセット強度がこれ以上の帯域は同時に鳴っているとみなし、同時押しにする
+CHORD_THRESHOLD = 0.6
+# オンセット由来のノーツを置くレーン（帯域の低い順に左から割り当てる）
+ONSET_LANES = 6
+# 入力を渡さなかったときに分析する楽曲（環境変数 OTOGAME_AUDIO で変えられる）
+ENV_AUDIO = "OTOGAME_AUDIO"
+DEFAULT_AUDIO_FILE = root_path("assets", "sounds", "gozen4ji.mp3")
+CHARTS_DIR = root_path("assets", "charts")
+
+def analyze_audio(file_path, verbose=True):
+    import librosa
+    if verbose:
+        print(f"楽曲を分析中: {file_path}")
     
-    # 音声ファイルを読み込み
-    y, sr = librosa.load(file_path, duration=None)
+    # 音声ファイルを読み込み（デコードとリサンプルを分けて計測できるよう、元のレートで読んでから変換）
+    with instrument.span("analysis.decode", file=file_path) as fields:
+        y, native_sr = librosa.load(file_path, sr=None, duration=None)
+        fields["sample_rate"] = native_sr
+    sr = ANALYSIS_PARAMS["sr"]
+    if native_sr != sr:
+        with instrument.span("analysis.resample", file=file_path, orig_sr=native_sr):
+            y = librosa.resample(y, orig_sr=native_sr, target_sr=sr)
     duration = len(y) / sr
-    print(f"楽曲の長さ: {duration:.2f}秒")
+    if verbose:
+        print(f"楽曲の長さ: {duration:.2f}秒")
+    
+    # 1回のSTFTから全ての特徴量を求める（beat_track・onset_detectにyを渡すと、それぞれが
+    # メルスペクトログラムを作り直すので、同じ計算で求めた包絡線を渡す）
+    hop_length = ANALYSIS_PARAMS["hop_length"]
+    n_fft = ANALYSIS_PARAMS["n_fft"]
+    with instrument.span("analysis.stft", file=file_path):
+        S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+    with instrument.span("analysis.features", file=file_path):
+        features = spectral_features(S, sr, n_fft, hop_length)
+    del S
     
     # BPM検出
-    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-    print(f"検出されたBPM: {tempo:.2f}")
+    with instrument.span("analysis.beat_track", file=file_path):
+        tempo, beats = librosa.beat.beat_track(onset_envelope=features.pop("beat_env"), sr=sr,
+                                               hop_length=hop_length)
+    tempo = float(np.atleast_1d(tempo)[0])
+    if verbose:
+        print(f"検出されたBPM: {tempo:.2f}")
     
     # ビートタイミングを秒に変換
-    beat_times = librosa.frames_to_time(beats, sr=sr)
+    beat_times = librosa.frames_to_time(beats, sr=sr, hop_length=hop_length)
+    
+    # 曲の構成（ビート同期の特徴量から区間の境界と密度）
+    with instrument.span("analysis.structure", file=file_path):
+        features.update(structure.analyze_structure(
+            np.vstack([features.pop("chroma"), features.pop("mfcc")]), features["rms"], beats, hop_length / sr))
     
     # オンセット（音の開始）検出
-    onset_frames = librosa.onset.onset_detect(y=y, sr=sr, units='time')
+    with instrument.span("analysis.onset_detect", file=file_path):
+        onset_frames = librosa.onset.onset_detect(onset_envelope=features.pop("onset_env"), sr=sr,
+                                                  hop_length=hop_length, units='time')
     
     # 楽曲の分析結果
     analysis = {
@@ -32,13 +99,253 @@ def analyze_audio(file_path):
         "duration": float(duration),
         "beat_times": beat_times.tolist(),
         "onset_times": onset_frames.tolist(),
-        "sample_rate": sr
+        "sample_rate": sr,
+        "feature_hop": hop_length / sr,
+        **features,
     }
     
     return analysis
 
-def create_chart_from_analysis(analysis, difficulty="NORMAL"):
-    """分析結果から譜面データを生成"""
+def band_channels(sr, n_mels):
+    """band_edgesで分けた帯域ごとのメル帯域の境界（onset_strength_multiのchannels）"""
+    import librosa
+    centers = librosa.mel_frequencies(n_mels=n_mels + 2, fmax=sr / 2)[1:-1]
+    return [0, *np.searchsorted(centers, ANALYSIS_PARAMS["band_edges"]).tolist(), n_mels]
+
+def spectral_features(S, sr, n_fft, hop_length):
+    """振幅スペクトログラムSから、全帯域・帯域別のオンセット強度、RMS、スペクトル重心、クロマ、MFCCを求める
+
+    onset_env・beat_env は librosa.onset.onset_strength(y=y) と（beat_envは aggregate=np.median で）同じ値。
+    帯域別のオンセット強度・RMS・スペクトル重心はフレームごとの float32 の配列で、譜面生成に使う。
+    クロマ・MFCCは構成の推定（structure.py）で拍ごとに平均してから使う
+    """
+    import librosa
+    mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S ** 2, sr=sr, n_fft=n_fft))
+    options = {"S": mel_db, "sr": sr, "n_fft": n_fft, "hop_length": hop_length}
+    return {
+        "onset_env": librosa.onset.onset_strength(**options),
+        "beat_env": librosa.onset.onset_strength(**options, aggregate=np.median),
+        "band_onsets": librosa.onset.onset_strength_multi(
+            **options, channels=band_channels(sr, mel_db.shape[0])).astype(np.float32),
+        "rms": librosa.feature.rms(S=S, frame_length=n_fft)[0].astype(np.float32),
+        "spectral_centroid": librosa.feature.spectral_centroid(S=S, sr=sr, n_fft=n_fft)[0].astype(np.float32),
+        "chroma": librosa.feature.chroma_stft(S=S ** 2, sr=sr, n_fft=n_fft),
+        "mfcc": librosa.feature.mfcc(S=mel_db, n_mfcc=N_MFCC),
+    }
+
+def analyze_audio_streaming(file_path, verbose=True):
+    """楽曲全体を読み込まずにブロック単位で分析する（長い曲向け）
+    
+    ブロックごとに1回のSTFTからオンセット強度（全帯域・帯域別）・RMS・スペクトル重心を逐次計算し、
+    ビート・オンセット検出は全帯域の包絡線に対して行う。
+    メモリに載るのは1ブロック分の音声と、1ホップ1要素の包絡線・特徴量（1時間で1系列あたり約600KB）だけ。
+    テンポ推定もテンポグラムを区間ごとに集計するので、曲全体の行列は作らない。
+    dB変換の下限（最大値からTOP_DB下）はそれまでのブロックの最大値で決めるので、曲の一番大きい箇所より前では
+    通常の分析より下限が低くなることがある。このため静かな部分のオンセットが通常の分析より増減しうる
+    （その箇所以降は同じ）。リサンプルしないことによる差もある。クリックトラックで測った通常の分析との差は、
+    BPMは同じ、オンセットは数・時刻とも同じ、ビート時刻は±1フレーム（約23ms）で、曲の端で1拍増減することがある。
+    benchmark.py --suites analysis でオンセットの差（2フレームより離れた数）を計測できる。
+    """
+    import librosa
+    if verbose:
+        print(f"楽曲をストリーミング分析中: {file_path}")
+    
+    # リサンプルせず元のサンプルレートのまま処理し、時間分解能は通常の分析に合わせる
+    sr = librosa.get_samplerate(file_path)
+    scale = sr / ANALYSIS_PARAMS["sr"]
+    hop_length = int(round(ANALYSIS_PARAMS["hop_length"] * scale))
+    n_fft = int(round(ANALYSIS_PARAMS["n_fft"] * scale))
+    duration = librosa.get_duration(path=file_path)
+    if verbose:
+        print(f"楽曲の長さ: {duration:.2f}秒")
+    
+    stream = librosa.stream(file_path, block_length=STREAM_BLOCK_FRAMES,
+                            frame_length=n_fft, hop_length=hop_length,
+                            fill_value=0)
+    envelope, band_envelope, rms, centroid, timbre = [], [], [], [], []
+    previous = None
+    channels = None
+    # power_to_db は曲全体の最大値からTOP_DB下で切り捨てるので、それまでの最大値で同じように切り捨てる
+    peak = -np.inf
+    # デコードと特徴量の計算はブロックごとに交互に行うのでまとめて計測する
+    with instrument.span("analysis.decode_onset_strength", file=file_path, sample_rate=sr):
+        for y_block in stream:
+            S = np.abs(librosa.stft(y_block, n_fft=n_fft, hop_length=hop_length, center=False))
+            mel = librosa.feature.melspectrogram(S=S ** 2, sr=sr, n_fft=n_fft, fmax=ANALYSIS_PARAMS["sr"] / 2)
+            mel_db = librosa.power_to_db(mel, top_db=None)
+            peak = max(peak, float(mel_db.max()))
+            floor = peak - TOP_DB
+            rms.append(librosa.feature.rms(S=S, frame_length=n_fft)[0])
+            centroid.append(librosa.feature.spectral_centroid(S=S, sr=sr, n_fft=n_fft)[0])
+            timbre.append(np.vstack([librosa.feature.chroma_stft(S=S ** 2, sr=sr, n_fft=n_fft),
+                                     librosa.feature.mfcc(S=np.maximum(mel_db, floor), n_mfcc=N_MFCC)]
+                                    ).astype(np.float32))
+            if channels is None:
+                channels = band_channels(ANALYSIS_PARAMS["sr"], mel_db.shape[0])
+            # ブロック境界をまたぐ差分のため、前ブロックの最後のフレームをつなげる。切り捨て前の値を持っておき、
+            # このブロックと同じ下限で切り捨てる（下限が上がった境界に、切り捨ての違いだけの差分が出ないように）
+            if previous is not None:
+                mel_db = np.concatenate([previous, mel_db], axis=1)
+            previous = mel_db[:, -1:]
+            mel_db = np.maximum(mel_db, floor)
+            if mel_db.shape[1] > 1:
+                flux = np.maximum(0.0, np.diff(mel_db, axis=1))
+                envelope.append(flux.mean(axis=0))
+                band_envelope.append(np.stack([flux[lo:hi].mean(axis=0)
+                                               for lo, hi in zip(channels[:-1], channels[1:])]))
+    
+    # center=Falseのフレームは中心がn_fft/2だけ後ろにずれるので、
+    # librosa.onset.onset_strength（center=Trueのスペクトログラム＋同じだけの前方パディング）と位置を揃える
+    shift = n_fft // (2 * hop_length)
+    pad = 1 + 2 * shift
+    onset_env = np.concatenate([np.zeros(pad)] + envelope) if envelope else np.zeros(pad)
+    bands = len(ANALYSIS_PARAMS["band_edges"]) + 1
+    band_onsets = np.concatenate([np.zeros((bands, pad))] + band_envelope, axis=1)
+    # RMS・スペクトル重心は差分をとらないので、フレームの中心のずれだけ揃える。
+    # 最後のブロックの埋め草の分は、通常の分析と同じフレーム数に切り詰める
+    frames = 1 + int(round(duration * sr)) // hop_length
+    band_onsets = band_onsets[:, :frames]
+    rms = np.concatenate([np.zeros(shift)] + rms)[:frames]
+    centroid = np.concatenate([np.zeros(shift)] + centroid)[:frames]
+    timbre = np.concatenate([np.zeros((N_CHROMA + N_MFCC, shift), dtype=np.float32)] + timbre, axis=1)[:, :frames]
+    
+    with instrument.span("analysis.tempo", file=file_path):
+        tempo = estimate_tempo_chunked(onset_env, sr, hop_length)
+    if verbose:
+        print(f"検出されたBPM: {tempo:.2f}")
+    
+    # テンポを渡すとbeat_trackは包絡線の長さに比例したメモリしか使わない
+    with instrument.span("analysis.beat_track", file=file_path):
+        _, beats = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr, hop_length=hop_length, bpm=tempo)
+    beat_times = librosa.frames_to_time(beats, sr=sr, hop_length=hop_length)
+    with instrument.span("analysis.onset_detect", file=file_path):
+        onset_times = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr,
+                                                 hop_length=hop_length, units='time')
+    with instrument.span("analysis.structure", file=file_path):
+        sections = structure.analyze_structure(timbre, rms, beats, hop_length / sr)
+    
+    return {
+        "bpm": tempo,
+        "duration": float(duration),
+        "beat_times": beat_times.tolist(),
+        "onset_times": onset_times.tolist(),
+        "sample_rate": sr,
+        "feature_hop": hop_length / sr,
+        "band_onsets": band_onsets.astype(np.float32),
+        "rms": rms.astype(np.float32),
+        "spectral_centroid": centroid.astype(np.float32),
+        **sections,
+    }
+
+def estimate_tempo_chunked(onset_env, sr, hop_length, start_bpm=120.0, std_bpm=1.0, max_tempo=320.0):
+    """librosa.feature.tempoと同じ推定を、テンポグラムを区間ごとに平均しながら行う
+    
+    曲全体のテンポグラム（384×フレーム数）を一度に作らないので、メモリが曲の長さに依存しない
+    """
+    import librosa
+    win_length = 384
+    tempogram_sum = np.zeros(win_length)
+    frames = 0
+    for start in range(0, len(onset_env), TEMPO_CHUNK_FRAMES):
+        chunk = onset_env[start:start + TEMPO_CHUNK_FRAMES]
+        tempogram = librosa.feature.tempogram(onset_envelope=chunk, sr=sr, hop_length=hop_length,
+                                              win_length=win_length)
+        tempogram_sum += tempogram.sum(axis=1)
+        frames += tempogram.shape[1]
+    
+    bpms = librosa.tempo_frequencies(win_length, sr=sr, hop_length=hop_length)
+    with np.errstate(divide='ignore'):
+        logprior = -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm) ** 2
+    logprior[bpms > max_tempo] = -np.inf
+    best = np.argmax(np.log1p(1e6 * tempogram_sum / max(frames, 1)) + logprior)
+    return float(bpms[best])
+
+def structure_source_hash():
+    """structure.py のソースのハッシュ（区間の境界・密度の求め方を変えたら区間のキャッシュを作り直す）"""
+    with open(structure.__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def analyze_audio_cached(file_path, cache_dir=analysis_cache.CACHE_DIR, verbose=True, streaming=False):
+    """キャッシュがあればDSPを実行せずに分析結果を返す"""
+    # librosaの読み込みは数秒かかるので、キャッシュのキーにはインストール済みのバージョンだけを使う
+    from importlib import metadata
+    analyze = analyze_audio_streaming if streaming else analyze_audio
+    if cache_dir is None:
+        return analyze(file_path, verbose)
+    
+    # 区間の推定は structure.py だけで決まるので、DSPのキーには含めず別のエントリにする
+    # （structure.py を変えても librosa の分析はやり直さず、保存済みの拍ごとの特徴量から求め直す）
+    params = dict(ANALYSIS_PARAMS, librosa=metadata.version("librosa"), streaming=streaming)
+    key = analysis_cache.cache_key(file_path, params)
+    skey = analysis_cache.sections_key(key, structure_source_hash())
+    with instrument.span("analysis.cache_load", file=file_path) as fields:
+        analysis = analysis_cache.load(cache_dir, key)
+        fields["hit"] = analysis is not None
+    if analysis is not None:
+        if verbose:
+            print(f"分析キャッシュを使用: {file_path}")
+        sections = analysis_cache.load_sections(cache_dir, skey)
+        if sections is None:
+            with instrument.span("analysis.sections", file=file_path):
+                sections = structure.segment_beats(analysis["beat_features"], analysis["beat_feature_times"])
+            analysis_cache.store_sections(cache_dir, skey, sections)
+        analysis.update(sections)
+        return analysis
+    
+    analysis = analyze(file_path, verbose)
+    with instrument.span("analysis.cache_store", file=file_path):
+        analysis_cache.store(cache_dir, key, analysis)
+        analysis_cache.store_sections(cache_dir, skey, analysis)
+    return analysis
+
+def band_strengths(analysis, times):
+    """各時刻のフレームの帯域別オンセット強度（帯域ごとに95パーセンタイルで正規化）。形は (時刻数, 帯域数)"""
+    bands = np.asarray(analysis["band_onsets"], dtype=np.float64)
+    scale = np.percentile(bands, 95, axis=1, keepdims=True)
+    scale[scale <= 0] = 1.0
+    frames = np.clip(np.rint(np.asarray(times) / analysis["feature_hop"]).astype(np.int64), 0, bands.shape[1] - 1)
+    return (bands[:, frames] / scale).T
+
+def section_density(analysis, times):
+    """構成の区間（structure.py）の密度から、各時刻の区間の密度の倍率（曲全体の平均に対する）と区間番号を求める"""
+    density = np.asarray(analysis["section_density"], dtype=np.float64)
+    factor = np.clip(density / max(density.mean(), 1e-9), *SECTION_DENSITY_RANGE)
+    section = np.searchsorted(np.asarray(analysis["section_starts"][1:], dtype=np.float64), times, side="right")
+    return factor[section], section
+
+def select_strongest(strength, group, fraction):
+    """グループ（区間）ごとに、強度の大きい順に fraction の割合だけ残すマスク"""
+    n = len(strength)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    order = np.lexsort((-strength, group))
+    counts = np.bincount(group)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n) - starts[group[order]]
+    return rank < np.ceil(counts[group] * fraction)
+
+def feature_onset_notes(rng, analysis, onsets, max_chord):
+    """帯域別のオンセット強度から、オンセットごとのレーン・同時押しを決めたノーツ列を作る
+
+    強い帯域から順に、同時に鳴っている帯域の数（max_chordまで）だけノーツを置く。
+    レーンは帯域の低い順に左から分けたグループの中から選ぶので、同じオンセットで重ならない
+    """
+    strengths = band_strengths(analysis, onsets)
+    bands = strengths.shape[1]
+    sizes = np.clip((strengths >= CHORD_THRESHOLD).sum(axis=1), 1, max_chord)
+    band_order = np.argsort(-strengths, axis=1, kind="stable")
+    rows, cols = np.nonzero(np.arange(bands)[None, :] < sizes[:, None])
+    chosen = band_order[rows, cols]
+    groups = np.array_split(np.arange(ONSET_LANES), bands)
+    group_start = np.array([group[0] for group in groups])
+    group_size = np.array([len(group) for group in groups])
+    lanes = group_start[chosen] + rng.integers(0, group_size[chosen])
+    return chart_engine.columns(onsets[rows], lanes)
+
+def create_chart_from_analysis(analysis, difficulty="NORMAL", title="午前四時の宮殿",
+                               audio_file="assets/sounds/gozen4ji.mp3", seed=None):
+    """分析結果から譜面データを生成（同じseedなら同じ譜面になる）"""
     bpm = analysis["bpm"]
     beat_times = analysis["beat_times"]
     onset_times = analysis["onset_times"]
@@ -50,81 +357,73 @@ def create_chart_from_analysis(analysis, difficulty="NORMAL"):
     # オフセットを最初のビートから計算
     offset = beat_times[0] if beat_times else 0.5
     
-    notes = []
-    lanes = list(range(8))  # 7鍵盤 + スクラッチ
+    rng = chart_engine.make_rng(seed)
     
     # 難易度に応じた密度調整
     density_config = {
-        "BEGINNER": {"beat_divisor": 1, "lane_variety": 3, "scratch_freq": 0.1},
-        "NORMAL": {"beat_divisor": 2, "lane_variety": 5, "scratch_freq": 0.15},
-        "HYPER": {"beat_divisor": 4, "lane_variety": 7, "scratch_freq": 0.2},
-        "ANOTHER": {"beat_divisor": 8, "lane_variety": 8, "scratch_freq": 0.25}
+        "BEGINNER": {"beat_divisor": 1, "lane_variety": 3, "scratch_freq": 0.1, "max_chord": 1},
+        "NORMAL": {"beat_divisor": 2, "lane_variety": 5, "scratch_freq": 0.15, "max_chord": 2},
+        "HYPER": {"beat_divisor": 4, "lane_variety": 7, "scratch_freq": 0.2, "max_chord": 2},
+        "ANOTHER": {"beat_divisor": 8, "lane_variety": 8, "scratch_freq": 0.25, "max_chord": 3}
     }
     
     config = density_config.get(difficulty, density_config["NORMAL"])
     
-    # メインビートでノーツ配置
-    last_lane = -1
-    for i, beat_time in enumerate(beat_times):
-        if beat_time >= duration - 1:  # 楽曲終了1秒前まで
-            break
-            
-        # ビート分割に基づいてノーツ配置
-        for subdivision in range(config["beat_divisor"]):
-            time = beat_time + (subdivision * beat_interval / config["beat_divisor"])
-            
-            # 密度調整（全てのタイミングにノーツを置かない）
-            if subdivision == 0 or (i % 2 == 0 and subdivision % 2 == 0):
-                # レーン選択（連続を避ける）
-                available_lanes = [l for l in range(config["lane_variety"]) if l != last_lane]
-                lane = np.random.choice(available_lanes)
-                last_lane = lane
-                
-                # スクラッチノーツの確率
-                if np.random.random() < config["scratch_freq"]:
-                    lane = 7  # スクラッチレーン
-                
-                # ノーツタイプ決定
-                note_type = "tap"
-                if lane != 7 and np.random.random() < 0.1:  # 10%の確率でホールドノーツ
-                    note_type = "hold"
-                    duration_hold = beat_interval * np.random.choice([1, 2])
-                elif lane == 7:
-                    note_type = "scratch"
-                
-                note = {
-                    "time": round(time, 3),
-                    "lane": lane,
-                    "type": note_type
-                }
-                
-                if note_type == "hold":
-                    note["duration"] = round(duration_hold, 3)
-                
-                notes.append(note)
+    # メインビートでノーツ配置（楽曲終了1秒前まで）
+    times, beat_index, sub_index = chart_engine.subdivision_grid(
+        beat_times, beat_interval, config["beat_divisor"], duration - 1)
+    # 密度調整（全てのタイミングにノーツを置かない）
+    placed = (sub_index == 0) | ((beat_index % 2 == 0) & (sub_index % 2 == 0))
+    times = times[placed]
+    n = len(times)
+    
+    # レーン選択（連続を避ける）
+    lanes = chart_engine.walk_lanes(rng, n, config["lane_variety"])
+    # スクラッチノーツの確率
+    scratch = chart_engine.chance(rng, n, config["scratch_freq"])
+    # ANOTHERはlane_variety=8でレーン7も選ばれるので、レーン7のノーツは常にスクラッチにする
+    scratch |= lanes == 7
+    lanes[scratch] = 7  # スクラッチレーン
+    # 10%の確率でホールドノーツ
+    hold = ~scratch & chart_engine.chance(rng, n, 0.1)
+    hold_beats = rng.choice([1, 2], size=n)
+    
+    beat_notes = chart_engine.columns(times, lanes)
+    beat_notes["type"][scratch] = chart_engine.SCRATCH
+    beat_notes["type"][hold] = chart_engine.HOLD
+    beat_notes["duration"][hold] = beat_interval * hold_beats[hold]
     
     # オンセットベースのノーツも追加（メロディライン）
-    for onset_time in onset_times[::3]:  # 3つに1つのオンセットを使用
-        if onset_time < duration - 1 and onset_time > offset:
-            # 既存のノーツと重複しないかチェック
-            conflict = any(abs(note["time"] - onset_time) < 0.1 for note in notes)
-            if not conflict:
-                lane = np.random.choice(range(6))  # 通常レーンのみ
-                notes.append({
-                    "time": round(onset_time, 3),
-                    "lane": lane,
-                    "type": "tap"
-                })
+    has_features = "band_onsets" in analysis
+    if has_features:
+        # 構成の区間の密度に応じた割合で、強いオンセットから使う
+        onsets = np.asarray(onset_times, dtype=np.float64)
+        onsets = onsets[(onsets < duration - 1) & (onsets > offset)]
+        factor, section = section_density(analysis, onsets)
+        strength = band_strengths(analysis, onsets).max(axis=1)
+        onsets = onsets[select_strongest(strength, section, np.minimum(1.0, ONSET_RATIO * factor))]
+    else:
+        # 特徴量のない分析結果（古いキャッシュなど）は3つに1つのオンセットを使う
+        onsets = np.asarray(onset_times[::3], dtype=np.float64)
+        onsets = onsets[(onsets < duration - 1) & (onsets > offset)]
+    # 既存のノーツと重複しないかチェック（ビート由来のノーツとは二分探索、オンセット同士は直前と比較）
+    placed_times = np.sort(np.round(beat_notes["time"], 3))
+    onsets = onsets[~chart_engine.near_any(placed_times, onsets, 0.1)]
+    onsets = onsets[chart_engine.thin_min_gap(np.round(onsets, 3), 0.1)]
+    if has_features:
+        onset_notes = feature_onset_notes(rng, analysis, onsets, config["max_chord"])
+    else:
+        onset_notes = chart_engine.columns(onsets, chart_engine.random_lanes(rng, len(onsets), range(6)))  # 通常レーンのみ
     
     # 時間でソート
-    notes.sort(key=lambda x: x["time"])
+    notes = chart_engine.to_notes(chart_engine.sort_by_time(chart_engine.concat(beat_notes, onset_notes)))
     
     return {
-        "title": "午前四時の宮殿",
+        "title": title,
         "artist": "Unknown",
         "bpm": round(bpm),
         "offset": round(offset, 3),
-        "audioFile": "assets/sounds/gozen4ji.mp3",
+        "audioFile": audio_file,
         "difficulty": {
             "name": difficulty,
             "level": {"BEGINNER": 3, "NORMAL": 5, "HYPER": 8, "ANOTHER": 11}[difficulty]
@@ -132,8 +431,131 @@ def create_chart_from_analysis(analysis, difficulty="NORMAL"):
         "notes": notes
     }
 
+def collect_audio_files(inputs, manifest=None):
+    """ディレクトリ・ファイル・マニフェストから処理対象の楽曲一覧を作る
+
+    マニフェストはJSON（文字列か {"file", "id", "title"} のリスト）か、1行1パスのテキスト
+    """
+    entries = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith(AUDIO_EXTENSIONS):
+                        entries.append({"file": os.path.join(root, name)})
+        else:
+            entries.append({"file": path})
+    
+    if manifest:
+        with open(manifest, 'r', encoding='utf-8') as f:
+            if manifest.endswith(".json"):
+                items = json.load(f)
+            else:
+                items = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+        for item in items:
+            entry = {"file": item} if isinstance(item, str) else dict(item)
+            entry["file"] = os.path.join(base_dir, entry["file"])
+            entries.append(entry)
+    
+    for entry in entries:
+        stem, ext = os.path.splitext(os.path.basename(entry["file"]))
+        entry.setdefault("id", stem)
+        entry.setdefault("title", stem)
+        entry.setdefault("audioFile", f"assets/sounds/{entry['id']}{ext.lower()}")
+    return entries
+
+def analyze_worker(file_path, cache_dir=analysis_cache.CACHE_DIR, streaming=False):
+    """プロセスプール上で1曲を分析し、結果と所要時間を返す"""
+    start = time.perf_counter()
+    with instrument.profiled(f"analyze-{os.path.basename(file_path)}"):
+        analysis = analyze_audio_cached(file_path, cache_dir, verbose=False, streaming=streaming)
+    return analysis, time.perf_counter() - start
+
+def write_charts(analysis, entry, output_dir, difficulties, seed=None):
+    """1曲分の全難易度の譜面を書き出す"""
+    note_counts = {}
+    for difficulty in difficulties:
+        with instrument.span("chart.generate", song=entry["id"], difficulty=difficulty):
+            chart = create_chart_from_analysis(analysis, difficulty, entry["title"], entry["audioFile"], seed)
+        output_file = os.path.join(output_dir, f"{entry['id']}_{difficulty.lower()}.json")
+        with instrument.span("chart.serialize", song=entry["id"], difficulty=difficulty):
+            with open(output_file, 'w', encoding='utf-8') as f:
+                json.dump(chart, f, indent=2, ensure_ascii=False)
+        note_counts[difficulty] = len(chart["notes"])
+    return note_counts
+
+def run_batch(entries, output_dir=CHARTS_DIR, workers=None, difficulties=DIFFICULTIES,
+              cache_dir=analysis_cache.CACHE_DIR, streaming=False, seed=None):
+    """楽曲の分析をプロセスプールに分散し、終わった曲から譜面を書き出す"""
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    print(f"{len(entries)}曲を{workers}プロセスで分析します")
+    
+    batch_start = time.perf_counter()
+    results = []
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_worker, entry["file"], cache_dir, streaming): entry for entry in entries}
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                analysis, elapsed = future.result()
+                note_counts = write_charts(analysis, entry, output_dir, difficulties, seed)
+            except Exception as e:
+                failures.append((entry, e))
+                print(f"[失敗] {entry['file']}: {e}")
+                continue
+            results.append((entry, elapsed))
+            counts = " / ".join(f"{d}:{n}" for d, n in note_counts.items())
+            print(f"[{elapsed:6.2f}秒] {entry['id']} BPM {analysis['bpm']:.1f} "
+                  f"長さ {analysis['duration']:.1f}秒 ノーツ数 {counts}")
+    
+    wall = time.perf_counter() - batch_start
+    cpu = sum(elapsed for _, elapsed in results)
+    print("\n=== 集計 ===")
+    print(f"成功: {len(results)}曲 / 失敗: {len(failures)}曲")
+    print(f"経過時間: {wall:.2f}秒 (分析時間の合計 {cpu:.2f}秒, 並列化率 {cpu / wall if wall else 0:.1f}倍)")
+    if results:
+        slowest = max(results, key=lambda r: r[1])
+        print(f"平均: {cpu / len(results):.2f}秒/曲, 最長: {slowest[0]['id']} ({slowest[1]:.2f}秒)")
+    for entry, error in failures:
+        print(f"  失敗: {entry['file']} ({error})")
+    return results, failures
+
 def main():
-    audio_file = "/Users/hayatoikeda/Downloads/午前四時の宮殿.mp3"
+    parser = argparse.ArgumentParser(description="楽曲を分析して全難易度の譜面を生成する")
+    parser.add_argument("inputs", nargs="*", help="音楽ファイルまたはディレクトリ")
+    parser.add_argument("--manifest", help="楽曲一覧（JSONまたは1行1パスのテキスト）")
+    parser.add_argument("--workers", type=int, default=None, help="並列プロセス数（既定: CPUコア数）")
+    parser.add_argument("--output-dir", default=CHARTS_DIR, help="譜面の出力先")
+    parser.add_argument("--difficulties", default=",".join(DIFFICULTIES),
+                        help="生成する難易度（カンマ区切り）")
+    parser.add_argument("--cache-dir", default=analysis_cache.CACHE_DIR, help="分析結果のキャッシュ先")
+    parser.add_argument("--no-cache", action="store_true", help="キャッシュを使わずに毎回分析する")
+    parser.add_argument("--streaming", action="store_true",
+                        help="曲全体を読み込まずにブロック単位で分析する（長い曲向け・省メモリ）")
+    parser.add_argument("--seed", type=int, default=None, help="譜面生成の乱数シード（同じ値なら同じ譜面）")
+    parser.add_argument("--profile", help="計測モード（spans,cprofile,tracemalloc。環境変数OTOGAME_PROFILEと同じ）")
+    parser.add_argument("--profile-dir", help="計測結果の出力先（既定: profile）")
+    args = parser.parse_args()
+    if args.profile or args.profile_dir:
+        try:
+            instrument.configure(args.profile, args.profile_dir)
+        except ValueError as e:
+            parser.error(str(e))
+    cache_dir = None if args.no_cache else args.cache_dir
+    
+    if args.inputs or args.manifest:
+        entries = collect_audio_files(args.inputs, args.manifest)
+        if not entries:
+            print("分析対象の音楽ファイルが見つかりません")
+            return
+        difficulties = [d.strip().upper() for d in args.difficulties.split(",") if d.strip()]
+        run_batch(entries, args.output_dir, args.workers, difficulties, cache_dir, args.streaming, args.seed)
+        return
+    
+    audio_file = os.environ.get(ENV_AUDIO) or DEFAULT_AUDIO_FILE
     
     if not os.path.exists(audio_file):
         print(f"音楽ファイルが見つかりません: {audio_file}")
@@ -141,19 +563,22 @@ def main():
     
     try:
         # 楽曲分析
-        analysis = analyze_audio(audio_file)
+        with instrument.profiled("analyze"):
+            analysis = analyze_audio_cached(audio_file, cache_dir, streaming=args.streaming)
         
         # 難易度別に譜面生成
         difficulties = ["BEGINNER", "NORMAL", "HYPER"]
         
         for difficulty in difficulties:
             print(f"\n{difficulty}譜面を生成中...")
-            chart = create_chart_from_analysis(analysis, difficulty)
+            with instrument.span("chart.generate", song="gozen4ji", difficulty=difficulty):
+                chart = create_chart_from_analysis(analysis, difficulty, seed=args.seed)
             
             # ファイル出力
-            output_file = f"assets/charts/gozen4ji_{difficulty.lower()}.json"
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(chart, f, indent=2, ensure_ascii=False)
+            output_file = os.path.join(CHARTS_DIR, f"gozen4ji_{difficulty.lower()}.json")
+            with instrument.span("chart.serialize", song="gozen4ji", difficulty=difficulty):
+                with open(output_file, 'w', encoding='utf-8') as f:
+                    json.dump(chart, f, indent=2, ensure_ascii=False)
             
             print(f"譜面保存: {output_file}")
             print(f"ノーツ数: {len(chart['notes'])}")
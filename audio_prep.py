@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+配信用の音声を作る前処理（ffmpegが必要）
+
+元の音声ファイル（WAVなど）から、曲ごとに以下を作って assets/sounds に置く:
+- ラウドネスを揃えた（2パスのloudnorm、-14 LUFS）配信用エンコード: <曲ID>.192k.mp3 / <曲ID>.128k.mp3 / <曲ID>.96k.opus
+- エディタ用の低解像度の波形ピーク: <曲ID>.peaks.json（1秒100区間の最小・最大、-127〜127）
+
+末尾の無音は削るが、先頭は削らない（譜面の時刻がずれるため）。
+デコード・フィルタは1回だけ行い、全エンコードとピーク用の出力を1回のffmpegで書き出す。
+結果は元ファイルの内容のハッシュと設定ごとに .audio_cache/ にキャッシュするので、
+同じ音声を2回処理することはない。曲ごとの処理は並列に行う。
+
+最後に、譜面の audioFile が元ファイルを指していれば配信用のファイル（既定は192k MP3）に書き換える。
+
+使い方:
+    python audio_prep.py                          # assets/sounds の元ファイルを全て処理
+    python audio_prep.py songs/new_song.wav --workers 4
+    python audio_prep.py --no-charts              # 譜面は書き換えない
+"""
+import argparse
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from build_charts import sha256_file
+from chart_transform import MetadataPatch, report, transform_charts
+from paths import root_path
+
+SOUNDS_DIR = root_path("assets", "sounds")
+CHARTS_DIR = root_path("assets", "charts")
+CACHE_DIR = root_path(".audio_cache")
+# 設定や出力形式を変えたらここを上げてキャッシュを作り直す
+PREP_VERSION = 1
+# analyze.py と同じ対応形式
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".ogg", ".flac", ".m4a")
+
+# 配信用エンコード: 名前 -> (拡張子, ffmpegのエンコード引数)
+VARIANTS = {
+    "192k": (".mp3", ["-c:a", "libmp3lame", "-b:a", "192k"]),
+    "128k": (".mp3", ["-c:a", "libmp3lame", "-b:a", "128k"]),
+    "96k": (".opus", ["-c:a", "libopus", "-b:a", "96k"]),
+}
+# 譜面のaudioFileに使うエンコード（MP3はどのブラウザでも再生できる）
+DEFAULT_VARIANT = "192k"
+OUTPUT_SAMPLE_RATE = 44100
+LOUDNESS = {"I": -14.0, "TP": -1.0, "LRA": 11.0}
+# 末尾の無音（-60dB未満）を削り、0.5秒だけ残す
+TRIM_THRESHOLD = "-60dB"
+TRIM_KEEP_SECONDS = 0.5
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+DURATION = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+PEAK_SAMPLE_RATE = 8000
+PEAKS_PER_SECOND = 100
+
+def settings_key():
+    settings = {
+        "version": PREP_VERSION,
+        "variants": VARIANTS,
+        "sample_rate": OUTPUT_SAMPLE_RATE,
+        "loudness": LOUDNESS,
+        "trim": [TRIM_THRESHOLD, TRIM_KEEP_SECONDS],
+        "peaks": [PEAK_SAMPLE_RATE, PEAKS_PER_SECOND],
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+def variant_name(song_id, variant):
+    return f"{song_id}.{variant}{VARIANTS[variant][0]}"
+
+def is_source(path):
+    """配信用に作ったファイル（<曲ID>.<名前>.<拡張子>）ではない元の音声ファイルか"""
+    name = os.path.basename(path)
+    return name.lower().endswith(AUDIO_EXTENSIONS) and "." not in os.path.splitext(name)[0]
+
+def resolve_audio_file(audio_file, variant=DEFAULT_VARIANT):
+    """譜面のaudioFileに対応する配信用ファイルがあればそのパスを、なければ元の値を返す
+
+    audioFileはプロジェクトのディレクトリからの相対パスなので、ファイルの有無もそこを基準に調べる
+    """
+    if not audio_file:
+        return audio_file
+    directory, name = os.path.split(audio_file)
+    song_id = name.split(".", 1)[0]
+    candidate = f"{directory}/{variant_name(song_id, variant)}" if directory else variant_name(song_id, variant)
+    return candidate if os.path.exists(root_path(candidate)) else audio_file
+
+def run_ffmpeg(ffmpeg, args):
+    result = subprocess.run([ffmpeg, "-hide_banner", "-nostdin", "-y", *args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpegが失敗しました: {result.stderr.strip().splitlines()[-1:]}")
+    return result.stderr
+
+def measure(ffmpeg, source):
+    """1パス目: ラウドネスと末尾の無音の開始位置を測る
+
+    戻り値は (loudnormの測定値, 末尾の無音の開始秒)。無音などで測れなければ測定値はNone、
+    末尾に無音がなければ開始秒はNone
+    """
+    loudnorm = ":".join(f"{key}={value}" for key, value in LOUDNESS.items())
+    stderr = run_ffmpeg(ffmpeg, ["-nostats", "-i", source, "-vn",
+                                 "-af", f"silencedetect=noise={TRIM_THRESHOLD}:d={TRIM_KEEP_SECONDS},"
+                                        f"loudnorm={loudnorm}:print_format=json",
+                                 "-f", "null", "-"])
+    # 最後の無音区間が曲の終わりまで続いていれば、それが末尾の無音
+    starts, ends = SILENCE_START.findall(stderr), SILENCE_END.findall(stderr)
+    duration = DURATION.search(stderr)
+    trailing_silence = None
+    if starts and len(starts) > len(ends):
+        trailing_silence = float(starts[-1])
+    elif starts and duration:
+        hours, minutes, seconds = duration.groups()
+        if float(ends[-1]) >= int(hours) * 3600 + int(minutes) * 60 + float(seconds) - 0.1:
+            trailing_silence = float(starts[-1])
+    measured = json.loads(stderr[stderr.rindex("{"):stderr.rindex("}") + 1])
+    if not math.isfinite(float(measured["input_i"])):
+        measured = None
+    return measured, trailing_silence
+
+def compute_peaks(raw_path):
+    """モノラルfloat32の生データから、区間ごとの最小・最大を -127〜127 の整数で返す"""
+    samples = array("f")
+    with open(raw_path, "rb") as f:
+        samples.frombytes(f.read())
+    if sys.byteorder != "little":
+        samples.byteswap()
+    step = PEAK_SAMPLE_RATE // PEAKS_PER_SECOND
+    peaks = []
+    for start in range(0, len(samples), step):
+        chunk = samples[start:start + step]
+        peaks.append(max(-127, round(min(chunk) * 127)))
+        peaks.append(min(127, round(max(chunk) * 127)))
+    return peaks, len(samples) / PEAK_SAMPLE_RATE
+
+def encode(ffmpeg, source, workdir):
+    """2パス目: 正規化したストリームを分岐して全エンコードとピーク用データを1回で書き出す"""
+    measured, trailing_silence = measure(ffmpeg, source)
+    filters = []
+    if trailing_silence is not None:
+        # 先頭は削らないので、譜面の時刻はそのまま使える
+        filters.append(f"atrim=end={trailing_silence + TRIM_KEEP_SECONDS:.3f}")
+    if measured is not None:
+        loudnorm = ":".join(f"{key}={value}" for key, value in LOUDNESS.items())
+        filters.append(f"loudnorm={loudnorm}:measured_I={measured['input_i']}:measured_TP={measured['input_tp']}"
+                       f":measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}"
+                       f":offset={measured['target_offset']}:linear=true")
+    # loudnormは192kHzで出力するので配信用のレートに戻す
+    filters.append(f"aresample={OUTPUT_SAMPLE_RATE}")
+    chain = ",".join(filters)
+    labels = [f"[v{i}]" for i in range(len(VARIANTS))] + ["[peaks]"]
+    args = ["-i", source, "-vn", "-filter_complex", f"[0:a]{chain},asplit={len(labels)}{''.join(labels)}"]
+    for label, (name, (ext, codec_args)) in zip(labels, VARIANTS.items()):
+        args += ["-map", label, *codec_args, "-map_metadata", "-1", os.path.join(workdir, f"{name}{ext}")]
+    raw_path = os.path.join(workdir, "peaks.f32")
+    args += ["-map", "[peaks]", "-ac", "1", "-ar", str(PEAK_SAMPLE_RATE), "-c:a", "pcm_f32le", "-f", "f32le", raw_path]
+    run_ffmpeg(ffmpeg, args)
+
+    peaks, duration = compute_peaks(raw_path)
+    os.unlink(raw_path)
+    with open(os.path.join(workdir, "peaks.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": PREP_VERSION, "peaksPerSecond": PEAKS_PER_SECOND, "duration": round(duration, 3),
+                   "peaks": peaks}, f, separators=(",", ":"))
+    return {"loudness": measured, "duration": duration}
+
+def cached_encode(ffmpeg, source, cache_dir):
+    """キャッシュにあればそれを、なければエンコードしてキャッシュのディレクトリを返す"""
+    digest = sha256_file(source)
+    entry_dir = os.path.join(cache_dir, f"{digest[:32]}-{settings_key()}")
+    if os.path.exists(os.path.join(entry_dir, "done.json")):
+        return entry_dir, True
+
+    os.makedirs(cache_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+    try:
+        info = encode(ffmpeg, source, workdir)
+        with open(os.path.join(workdir, "done.json"), "w", encoding="utf-8") as f:
+            json.dump(dict(info, source_sha256=digest), f, indent=2)
+        try:
+            os.rename(workdir, entry_dir)
+        except OSError:
+            # 別のプロセスが同じ内容を先に作った
+            shutil.rmtree(workdir)
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    return entry_dir, False
+
+def publish(src, dst):
+    """キャッシュから出力先へコピーする（同じサイズ・mtimeなら何もしない）"""
+    try:
+        if os.stat(dst).st_size == os.stat(src).st_size and os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns:
+            return
+    except FileNotFoundError:
+        pass
+    tmp = dst + ".tmp"
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+def prepare_song(ffmpeg, source, sounds_dir=SOUNDS_DIR, cache_dir=CACHE_DIR):
+    start = time.perf_counter()
+    song_id = os.path.splitext(os.path.basename(source))[0]
+    entry_dir, cached = cached_encode(ffmpeg, source, cache_dir)
+    os.makedirs(sounds_dir, exist_ok=True)
+    outputs = {}
+    for name, (ext, _) in VARIANTS.items():
+        dst = os.path.join(sounds_dir, variant_name(song_id, name))
+        publish(os.path.join(entry_dir, f"{name}{ext}"), dst)
+        outputs[name] = (dst, os.path.getsize(dst))
+    publish(os.path.join(entry_dir, "peaks.json"), os.path.join(sounds_dir, f"{song_id}.peaks.json"))
+    return {
+        "id": song_id,
+        "source": source,
+        "source_bytes": os.path.getsize(source),
+        "outputs": outputs,
+        "cached": cached,
+        "seconds": time.perf_counter() - start,
+    }
+
+def update_chart_audio(song_ids, charts_dir=CHARTS_DIR):
+    """audioFileが処理した曲を指している譜面を、配信用のファイルに書き換える"""
+    targets = {}
+    for path in sorted(glob.glob(os.path.join(charts_dir, "*.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            audio_file = json.load(f).get("audioFile")
+        if audio_file and os.path.basename(audio_file).split(".", 1)[0] in song_ids:
+            resolved = resolve_audio_file(audio_file)
+            if resolved != audio_file:
+                targets.setdefault(resolved, []).append(path)
+    results = []
+    for audio_file, paths in targets.items():
+        results += transform_charts(paths, [MetadataPatch(audioFile=audio_file)], workers=1)
+    if results:
+        report(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="配信用の音声と波形ピークを作る")
+    parser.add_argument("inputs", nargs="*", help="元の音声ファイルまたはディレクトリ（既定: assets/sounds）")
+    parser.add_argument("--sounds-dir", default=SOUNDS_DIR, help="配信用ファイルの出力先")
+    parser.add_argument("--charts-dir", default=CHARTS_DIR)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--workers", type=int, help="並列数（既定: CPUコア数）")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg"), help="ffmpegのパス")
+    parser.add_argument("--no-charts", action="store_true", help="譜面のaudioFileを書き換えない")
+    args = parser.parse_args()
+
+    if not args.ffmpeg:
+        print("ffmpegが見つかりません。インストールするか --ffmpeg でパスを指定してください")
+        sys.exit(1)
+
+    sources = []
+    for path in args.inputs or [args.sounds_dir]:
+        if os.path.isdir(path):
+            sources += sorted(os.path.join(path, name) for name in os.listdir(path) if is_source(name))
+        else:
+            sources.append(path)
+    if not sources:
+        print("処理する音声ファイルがありません")
+        return
+
+    # 処理の大半はffmpegのサブプロセスなのでスレッドで並列にする
+    workers = min(args.workers or os.cpu_count() or 1, len(sources))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(prepare_song, args.ffmpeg, source, args.sounds_dir, args.cache_dir)
+                   for source in sources]
+        results = []
+        for future, source in zip(futures, sources):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"[失敗] {source}: {e}")
+
+    for result in results:
+        sizes = " / ".join(f"{name}: {size / 1e6:.1f}MB" for name, (_, size) in result["outputs"].items())
+        state = "キャッシュ" if result["cached"] else f"{result['seconds']:.1f}秒"
+        print(f"[{state}] {result['id']}: 元 {result['source_bytes'] / 1e6:.1f}MB -> {sizes}")
+
+    if results and not args.no_charts:
+        update_chart_audio({result["id"] for result in results}, args.charts_dir)
+    if len(results) < len(sources):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
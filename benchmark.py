@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+譜面ツールとアセットサーバーのベンチマーク
+
+合成データ（既知のBPMのクリックトラック、1千〜100万ノーツの譜面）を使うので、
+楽曲ファイルがなくても毎回同じ条件で計測できる。結果はJSONで保存し、
+保存済みのベースラインと比較できる。
+
+使い方:
+    python benchmark.py                                # 全スイートを実行して bench_results.json に保存
+    python benchmark.py --suites json,transform --quick
+    python benchmark.py --suites simulation --quick     # 判定シミュレーターの毎秒プレイ数
+    python benchmark.py --suites startup               # otogame.py のサブコマンドの起動時間
+    python benchmark.py --output new.json --compare baseline.json --threshold 0.1
+    python benchmark.py --suites scores --clients 32    # スコア投稿の毎秒件数とランキング取得の遅延
+"""
+import argparse
+import functools
+import http.client
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from paths import root_path
+
+SUITES = ("analysis", "generation", "json", "transform", "simulation", "startup", "server", "scores")
+CHART_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+QUICK_CHART_SIZES = (1_000, 10_000)
+CLICK_BPMS = (90, 128, 174)
+# ストリーミング分析と通常の分析を44.1kHzの音声でも比べるクリックトラックのBPM
+STREAM_CHECK_BPM = 128
+# 起動時間を計測するサブコマンド（JSONだけを扱うものと、NumPyを読み込むもの）
+STARTUP_COMMANDS = ("transform", "index", "binary", "build", "profile", "diff", "simulate", "analyze")
+# ランキングの計測前に投入しておくプレイヤー数
+LEADERBOARD_PLAYERS = 100_000
+
+def measure(func, repeat=5, warmup=1):
+    """funcをrepeat回実行し、所要時間の統計を返す"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "mean": statistics.fmean(samples),
+        "runs": repeat,
+    }
+
+def synthetic_chart(note_count, seed=0, notes_per_second=8.0):
+    """ランダムな譜面（時刻順）を作る"""
+    rng = random.Random(seed)
+    duration = note_count / notes_per_second
+    times = sorted(round(rng.uniform(0, duration), 3) for _ in range(note_count))
+    notes = []
+    for t in times:
+        if rng.random() < 0.05:
+            notes.append({"time": t, "lane": rng.randrange(6), "type": "hold",
+                          "duration": round(rng.uniform(0.2, 1.0), 3)})
+        else:
+            notes.append({"time": t, "lane": rng.randrange(7), "type": "tap"})
+    return {
+        "title": f"synthetic-{note_count}",
+        "artist": "benchmark",
+        "bpm": 150,
+        "offset": 0.0,
+        "audioFile": "assets/sounds/synthetic.wav",
+        "difficulty": {"name": "ANOTHER", "level": 11},
+        "notes": notes,
+    }
+
+def write_click_track(path, bpm, duration=60.0, sr=22050):
+    """既知のBPMのクリックトラックを16bit WAVで書き出す"""
+    import numpy as np
+    samples = np.zeros(int(duration * sr), dtype=np.float32)
+    click = np.sin(2 * np.pi * 1000 * np.arange(400) / sr) * np.hanning(400)
+    for k, t in enumerate(np.arange(0.5, duration - 0.1, 60.0 / bpm)):
+        start = int(t * sr)
+        # 小節の頭を強くする
+        samples[start:start + len(click)] += click * (1.0 if k % 4 == 0 else 0.6)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+
+def onsets_off(reference, onsets, tolerance):
+    """onsetsのうち、referenceのどのオンセットからもtolerance秒より離れているものの数"""
+    import numpy as np
+    reference = np.asarray(reference)
+    onsets = np.asarray(onsets)
+    if not len(reference):
+        return len(onsets)
+    return int((np.abs(onsets[:, None] - reference[None, :]).min(axis=1) > tolerance).sum())
+
+def bench_analysis(workdir, args):
+    import analyze
+    # ストリーミング分析の許容差（通常の分析の2フレーム、約46ms）
+    tolerance = 2 * analyze.ANALYSIS_PARAMS["hop_length"] / analyze.ANALYSIS_PARAMS["sr"]
+    results = {}
+    tracks = [(f"click{bpm}", bpm, 22050) for bpm in CLICK_BPMS]
+    # ストリーミング分析はリサンプルしないので、分析と異なるサンプルレートの音声でも比べる
+    tracks.append((f"click{STREAM_CHECK_BPM}@44100", STREAM_CHECK_BPM, 44100))
+    for name, bpm, sr in tracks:
+        path = os.path.join(workdir, f"{name}.wav")
+        write_click_track(path, bpm, sr=sr)
+        detected = {}
+
+        def run(func=analyze.analyze_audio):
+            detected[func.__name__] = func(path, verbose=False)
+        results[f"analyze_audio/{name}"] = dict(measure(run, repeat=args.repeat),
+                                                bpm_error=abs(detected["analyze_audio"]["bpm"] - bpm))
+        streaming = measure(functools.partial(run, analyze.analyze_audio_streaming), repeat=args.repeat)
+        reference = detected["analyze_audio"]["onset_times"]
+        onsets = detected["analyze_audio_streaming"]["onset_times"]
+        # 通常の分析との差：オンセットの数と、許容差より離れたオンセットの数
+        results[f"analyze_audio_streaming/{name}"] = dict(
+            streaming, bpm_error=abs(detected["analyze_audio_streaming"]["bpm"] - bpm),
+            onsets=len(onsets), reference_onsets=len(reference),
+            onsets_off=onsets_off(reference, onsets, tolerance))
+    return results
+
+def bench_generation(workdir, args):
+    import numpy as np
+    import analyze
+    import create_chart
+    import generate_another_chart
+
+    results = {}
+    for minutes in (4, 20):
+        duration = minutes * 60.0
+        rng = np.random.default_rng(0)
+        analysis = {
+            "bpm": 150.0,
+            "duration": duration,
+            "beat_times": np.arange(0.5, duration, 0.4).tolist(),
+            "onset_times": np.sort(rng.uniform(0, duration, int(duration * 5))).tolist(),
+            "sample_rate": 22050,
+            "feature_hop": 512 / 22050,
+        }
+        frames = int(duration / analysis["feature_hop"]) + 1
+        analysis["band_onsets"] = rng.gamma(1.0, size=(3, frames)).astype(np.float32)
+        analysis["rms"] = rng.uniform(0.05, 0.3, frames).astype(np.float32)
+        analysis["spectral_centroid"] = rng.uniform(500, 4000, frames).astype(np.float32)
+        # 構成は32秒ごとの区間（structure.analyze_structure の出力と同じ形）
+        analysis["section_starts"] = np.arange(0.0, duration, 32.0).tolist()
+        analysis["section_density"] = rng.uniform(0.3, 1.0, len(analysis["section_starts"])).tolist()
+        for difficulty in analyze.DIFFICULTIES:
+            results[f"create_chart_from_analysis/{minutes}min/{difficulty}"] = measure(
+                lambda: analyze.create_chart_from_analysis(analysis, difficulty, seed=1), repeat=args.repeat)
+
+    results["create_gozen4ji_chart"] = measure(lambda: create_chart.create_gozen4ji_chart(seed=1),
+                                               repeat=args.repeat)
+    results["generate_difficulties"] = measure(lambda: create_chart.generate_difficulties(seed=1),
+                                               repeat=args.repeat)
+    raw = {"recordedTimings": sorted(random.Random(0).uniform(0, 240) for _ in range(5000))}
+    results["generate_another_chart/5000timings"] = measure(
+        lambda: generate_another_chart.generate_another_chart(raw, seed=1), repeat=args.repeat)
+    results["generate_chord/x1000"] = measure(
+        lambda: [generate_another_chart.generate_chord(rng=i) for i in range(1000)], repeat=args.repeat)
+    return results
+
+def bench_json(workdir, args):
+    import chart_binary
+
+    results = {}
+    for size in args.sizes:
+        chart = synthetic_chart(size)
+        repeat = args.repeat if size < 1_000_000 else 1
+        text = json.dumps(chart, indent=2, ensure_ascii=False)
+        binary = chart_binary.encode_chart(chart)
+        results[f"json_dump_indent2/{size}"] = dict(
+            measure(lambda: json.dumps(chart, indent=2, ensure_ascii=False), repeat=repeat), bytes=len(text.encode()))
+        results[f"json_load/{size}"] = measure(lambda: json.loads(text), repeat=repeat)
+        results[f"binary_encode/{size}"] = dict(measure(lambda: chart_binary.encode_chart(chart), repeat=repeat),
+                                                bytes=len(binary))
+        results[f"binary_read_columns/{size}"] = measure(
+            lambda: chart_binary.BinaryChart(binary).times, repeat=repeat)
+    return results
+
+def bench_transform(workdir, args):
+    import chart_index
+    import chart_transform
+
+    results = {}
+    charts_dir = os.path.join(workdir, "charts")
+    os.makedirs(charts_dir, exist_ok=True)
+    for size in args.sizes:
+        if size > 100_000:
+            continue
+        paths = []
+        for i in range(8):
+            path = os.path.join(charts_dir, f"song{i}_{size}.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(synthetic_chart(size, seed=i), f, indent=2, ensure_ascii=False)
+            paths.append(path)
+        # 毎回内容が変わるように、元に戻る2つの付け替えを交互に使う
+        forward = [chart_transform.NoteFilter(max_lane=6), chart_transform.LaneRemap({0: 1, 1: 0})]
+        results[f"transform_charts/8x{size}"] = measure(
+            lambda: chart_transform.transform_charts(paths, forward), repeat=args.repeat)
+        results[f"transform_charts_unchanged/8x{size}"] = measure(
+            lambda: chart_transform.transform_charts(paths, [chart_transform.NoteFilter(max_lane=6)]),
+            repeat=args.repeat)
+        results[f"chart_index_full/8x{size}"] = measure(
+            lambda: (os.path.exists(os.path.join(charts_dir, "index.json")) and
+                     os.unlink(os.path.join(charts_dir, "index.json")),
+                     chart_index.build_manifest(charts_dir)), repeat=args.repeat)
+        results[f"chart_index_incremental/8x{size}"] = measure(
+            lambda: chart_index.build_manifest(charts_dir), repeat=args.repeat)
+        for path in paths:
+            os.unlink(path)
+    return results
+
+def bench_simulation(workdir, args):
+    import simulate
+
+    results = {}
+    # 1プレイで全ノーツ分の判定を持つので、大きい譜面は計測しない
+    for size in (size for size in args.sizes if size <= 10_000):
+        chart = synthetic_chart(size)
+        results[f"simulate_plays/{size}notes/x{simulate.BATCH_PLAYS}"] = measure(
+            lambda: simulate.simulate_chart(chart, simulate.BATCH_PLAYS, level=11, estimate=False), repeat=args.repeat)
+        results[f"estimate_level/{size}notes"] = measure(
+            lambda: simulate.simulate_chart(chart, 1, level=11), repeat=args.repeat)
+    return results
+
+def bench_startup(workdir, args):
+    """otogame.py <サブコマンド> --help を別プロセスで実行する時間（Pythonの起動そのものも別に計測する）"""
+    entry = os.path.join(os.path.dirname(os.path.abspath(__file__)), "otogame.py")
+    results = {"interpreter": measure(
+        lambda: subprocess.run([sys.executable, "-c", "pass"], check=True), repeat=args.repeat)}
+    for command in STARTUP_COMMANDS:
+        results[command] = measure(
+            lambda: subprocess.run([sys.executable, entry, command, "--help"], stdout=subprocess.DEVNULL, check=True),
+            repeat=args.repeat)
+    return results
+
+def bench_server(workdir, args):
+    from http.server import ThreadingHTTPServer
+    from simple_server import FastHTTPRequestHandler
+
+    serve_dir = os.path.join(workdir, "serve")
+    os.makedirs(serve_dir, exist_ok=True)
+    with open(os.path.join(serve_dir, "chart.json"), "w", encoding="utf-8") as f:
+        json.dump(synthetic_chart(2000), f, indent=2, ensure_ascii=False)
+    with open(os.path.join(serve_dir, "song.wav"), "wb") as f:
+        f.write(os.urandom(8 * 1024 * 1024))
+
+    class QuietHandler(FastHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    handler = functools.partial(QuietHandler, directory=serve_dir)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    port = httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    scenarios = {
+        "chart_gzip": ("/chart.json", {"Accept-Encoding": "gzip"}),
+        "chart_revalidate_304": ("/chart.json", None),
+        "audio_range_256k": ("/song.wav", {"Range": "bytes=1048576-1310719"}),
+    }
+    results = {}
+    try:
+        for name, (path, headers) in scenarios.items():
+            for clients in args.clients:
+                results[f"{name}/{clients}clients"] = run_clients(port, path, headers, clients,
+                                                                        args.requests)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    return results
+
+def run_clients(port, path, headers, clients, requests_per_client, method="GET", make_body=None):
+    """clients本の接続（keep-alive）から並行にリクエストを送り、スループットと遅延を測る。
+    make_bodyを渡すと (接続番号, リクエスト番号) から作った本文を送る"""
+    if headers is None:
+        # 304のシナリオでは最初にETagを取得しておく
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        headers = {"If-None-Match": response.getheader("ETag")}
+        conn.close()
+
+    def client(index):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        latencies = []
+        received = 0
+        for i in range(requests_per_client):
+            body = make_body(index, i) if make_body else None
+            start = time.perf_counter()
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            received += len(response.read())
+            if response.status >= 400:
+                raise RuntimeError(f"{method} {path}: {response.status}")
+            latencies.append(time.perf_counter() - start)
+        conn.close()
+        return latencies, received
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        outcomes = list(executor.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for outcome in outcomes for latency in outcome[0])
+    total_bytes = sum(outcome[1] for outcome in outcomes)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    return {
+        "median": percentile(0.5),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "requests_per_second": len(latencies) / elapsed,
+        "megabytes_per_second": total_bytes / elapsed / 1e6,
+        "requests": len(latencies),
+    }
+
+def bench_scores(workdir, args):
+    from http.server import ThreadingHTTPServer
+    import chart_api
+    import score_api
+    from simple_server import FastHTTPRequestHandler
+
+    charts_dir = os.path.join(workdir, "score_charts")
+    os.makedirs(charts_dir, exist_ok=True)
+    for difficulty in ("normal", "big"):
+        with open(os.path.join(charts_dir, f"bench_{difficulty}.json"), "w", encoding="utf-8") as f:
+            json.dump(synthetic_chart(2000), f, ensure_ascii=False)
+    db_path = os.path.join(workdir, "scores.db")
+    store = score_api.ScoreStore(db_path)
+    saved = chart_api.store, score_api.store
+    chart_api.store, score_api.store = chart_api.ChartStore(charts_dir), store
+    rng = random.Random(0)
+    results = {}
+
+    # ストアに直接、複数スレッドから投稿する（HTTPを除いた書き込みの性能）
+    per_thread = max(args.requests, 200)
+    for threads in args.clients:
+        def submitter(index):
+            latencies = []
+            for i in range(per_thread):
+                start = time.perf_counter()
+                store.submit("bench", "direct", f"p{index}-{i}", rng.randrange(2_000_000), 100)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = sorted(x for outcome in executor.map(submitter, range(threads)) for x in outcome)
+        elapsed = time.perf_counter() - start
+        results[f"store_submit/{threads}threads"] = {
+            "median": latencies[len(latencies) // 2],
+            "p99": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+            "submissions_per_second": len(latencies) / elapsed,
+            "submissions": len(latencies),
+        }
+
+    # 大きなランキングでの上位取得・順位取得（キャッシュ済み）
+    with store.lock:
+        store.boards.pop(("bench", "big"), None)
+    rows = [("bench", "big", f"player{i}", rng.randrange(2_000_000), 0, None, float(i))
+            for i in range(LEADERBOARD_PLAYERS)]
+    with store.writer:
+        store.writer.executemany(score_api.INSERT_SCORE, rows)
+        store.writer.executemany(score_api.UPSERT_BEST, [row[:5] + row[6:] for row in rows])
+    results[f"leaderboard_load/{LEADERBOARD_PLAYERS}"] = measure(
+        lambda: (store.boards.pop(("bench", "big"), None), store.leaderboard("bench", "big")), repeat=args.repeat)
+    players = [f"player{rng.randrange(LEADERBOARD_PLAYERS)}" for _ in range(1000)]
+    results[f"leaderboard_top10_rank/{LEADERBOARD_PLAYERS}x1000"] = measure(
+        lambda: [store.leaderboard("bench", "big", 10, player) for player in players], repeat=args.repeat)
+
+    class QuietHandler(FastHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=workdir))
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    def submission(index, i):
+        return json.dumps({"songId": "bench", "difficulty": "normal", "player": f"c{index}-{i % 50}",
+                           "score": rng.randrange(2_000_000), "maxCombo": 100}).encode()
+    try:
+        for clients in args.clients:
+            results[f"http_submit/{clients}clients"] = run_clients(
+                port, score_api.SUBMIT_PATH, {"Content-Type": "application/json"}, clients, args.requests,
+                method="POST", make_body=submission)
+            results[f"http_leaderboard/{clients}clients"] = run_clients(
+                port, "/api/leaderboard/bench/big?limit=10&player=player1", {}, clients, args.requests)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        store.close()
+        chart_api.store, score_api.store = saved
+    return results
+
+def compare(results, baseline, threshold):
+    """ベースラインとの比較表を表示し、閾値を超えて遅くなった項目を返す"""
+    regressions = []
+    print(f"\n{'項目':<60} {'ベースライン':>12} {'今回':>12} {'変化':>8}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<60} {'-':>12} {result['median'] * 1000:>10.2f}ms {'新規':>8}")
+            continue
+        change = result["median"] / base["median"] - 1 if base["median"] else 0.0
+        mark = ""
+        if change > threshold:
+            regressions.append(name)
+            mark = " ← 遅くなった"
+        print(f"{name:<60} {base['median'] * 1000:>10.2f}ms {result['median'] * 1000:>10.2f}ms "
+              f"{change:>+7.1%}{mark}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="譜面ツールとサーバーのベンチマーク")
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"実行するスイート（{','.join(SUITES)}）")
+    parser.add_argument("--sizes", help="合成譜面のノーツ数（カンマ区切り）")
+    parser.add_argument("--quick", action="store_true", help="小さいサイズと少ない回数で実行する")
+    parser.add_argument("--repeat", type=int, default=None, help="各項目の計測回数")
+    parser.add_argument("--clients", default="1,8,32", help="サーバーの同時接続数（カンマ区切り）")
+    parser.add_argument("--requests", type=int, default=200, help="1接続あたりのリクエスト数")
+    parser.add_argument("--output", default=root_path("bench_results.json"), help="結果の保存先")
+    parser.add_argument("--compare", help="比較するベースラインの結果ファイル")
+    parser.add_argument("--threshold", type=float, default=0.10, help="遅くなったとみなす割合")
+    args = parser.parse_args()
+
+    args.sizes = (tuple(int(s) for s in args.sizes.split(",")) if args.sizes
+                  else QUICK_CHART_SIZES if args.quick else CHART_SIZES)
+    args.repeat = args.repeat or (3 if args.quick else 5)
+    args.clients = tuple(int(c) for c in args.clients.split(","))
+    if args.quick:
+        args.requests = min(args.requests, 50)
+
+    suites = [suite.strip() for suite in args.suites.split(",") if suite.strip()]
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for suite in suites:
+            print(f"[{suite}] 計測中...")
+            suite_results = globals()[f"bench_{suite}"](workdir, args)
+            for name, result in suite_results.items():
+                line = f"  {name}: {result['median'] * 1000:.2f}ms"
+                if "onsets_off" in result:
+                    line += (f"（オンセット {result['onsets']}/{result['reference_onsets']}、"
+                             f"通常の分析と2フレームより離れたもの {result['onsets_off']}）")
+                print(line)
+            results.update({f"{suite}/{name}": result for name, result in suite_results.items()})
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "suites": suites,
+            "sizes": list(args.sizes),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n結果を保存しました: {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)}項目が{args.threshold:.0%}以上遅くなりました")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
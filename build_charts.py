@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+譜面の差分ビルド
+
+出力する譜面ごとに「入力の指紋」（元の音楽ファイル・記録データの内容、生成パラメータ、シード、
+生成スクリプトのソース）を assets/charts/.build_state.json に記録し、
+指紋が変わった・出力が消えた・出力が手で書き換えられた譜面だけを並列で作り直す。
+1曲だけ差し替えたときは、その曲の譜面だけが再生成される。
+
+ターゲット:
+    gozen4ji             create_chart.py の全難易度（6鍵+スクラッチに変換して出力）
+    cryinggirl_another   cryinggirl_raw_recording.json から generate_another_chart.py で生成
+    <曲ID>               引数で渡した音楽ファイル・ディレクトリの曲（analyze.py で全難易度を生成）
+
+使い方:
+    python build_charts.py                       # 組み込みのターゲットを差分ビルド
+    python build_charts.py songs/ --workers 8    # 楽曲フォルダの曲も含めて差分ビルド
+    python build_charts.py --dry-run             # 作り直す譜面を表示するだけ
+    python build_charts.py --force gozen4ji      # 指定したターゲットを強制的に作り直す
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from chart_transform import apply_operations, write_json_atomic
+from paths import root_path
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CHARTS_DIR = root_path("assets", "charts")
+STATE_NAME = ".build_state.json"
+# 指紋の計算方法を変えたらここを上げて全ターゲットを作り直す
+STATE_VERSION = 1
+# シードを省略してもビルド結果が毎回同じになるように固定値を使う
+DEFAULT_SEED = 42
+RAW_RECORDING = "cryinggirl_raw_recording.json"
+
+# ターゲットの種類ごとに、出力に影響するソースファイル
+SOURCES = {
+    "create_chart": ["create_chart.py", "chart_engine.py", "update_charts.py", "chart_transform.py",
+                     "chart_model.py", "build_charts.py", "audio_prep.py"],
+    "generate_another": ["generate_another_chart.py", "chart_engine.py", "chart_transform.py",
+                         "chart_model.py", "build_charts.py", "audio_prep.py"],
+    "analyze": ["analyze.py", "chart_engine.py", "structure.py", "analysis_cache.py", "instrument.py",
+                "update_charts.py", "chart_transform.py", "chart_model.py", "build_charts.py", "audio_prep.py"],
+}
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FileHashes:
+    """mtimeとサイズが前回と同じファイルはハッシュを再計算しない"""
+    def __init__(self, known):
+        self.known = known
+        self.current = {}
+
+    def get(self, path):
+        path = os.path.normpath(path)
+        if path not in self.current:
+            st = os.stat(path)
+            old = self.known.get(path)
+            if old and old["mtime_ns"] == st.st_mtime_ns and old["size"] == st.st_size:
+                self.current[path] = old
+            else:
+                self.current[path] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": sha256_file(path)}
+        return self.current[path]["sha256"]
+
+def load_state(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {"inputs": {}, "outputs": {}}
+    if state.get("version") != STATE_VERSION:
+        return {"inputs": {}, "outputs": {}}
+    return state
+
+class Target:
+    """1回の生成でまとめて作られる譜面の組"""
+    def __init__(self, name, kind, outputs, inputs, params, build, args):
+        self.name = name
+        self.kind = kind
+        self.outputs = outputs
+        self.inputs = inputs
+        self.params = params
+        self.build = build
+        self.args = args
+
+    def fingerprint(self, hashes):
+        key = {
+            "kind": self.kind,
+            "params": self.params,
+            "inputs": {os.path.basename(path): hashes.get(path) for path in self.inputs},
+            "sources": {name: hashes.get(os.path.join(ROOT, name)) for name in SOURCES[self.kind]},
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def write_outputs(charts, operations=()):
+    """{出力パス: 譜面} を書き出し、出力ごとのハッシュを返す"""
+    from audio_prep import resolve_audio_file
+    written = {}
+    for path, chart in charts.items():
+        chart = apply_operations(chart, operations)
+        # audio_prep.pyで配信用の音声を作ってあればそちらを指す
+        if "audioFile" in chart:
+            chart["audioFile"] = resolve_audio_file(chart["audioFile"])
+        write_json_atomic(path, chart)
+        written[path] = sha256_file(path)
+    return written
+
+def build_gozen4ji(outputs, seed):
+    import create_chart
+    from update_charts import LANE_UPDATE_OPERATIONS
+    charts = create_chart.generate_difficulties(seed)
+    return write_outputs({outputs[name]: chart for name, chart in charts.items()}, LANE_UPDATE_OPERATIONS)
+
+def build_another(raw_path, output, seed):
+    import generate_another_chart
+    raw_data = generate_another_chart.load_raw_recording(raw_path)
+    return write_outputs({output: generate_another_chart.generate_another_chart(raw_data, seed)})
+
+def build_song(entry, outputs, seed, streaming, cache_dir):
+    import analyze
+    from update_charts import LANE_UPDATE_OPERATIONS
+    analysis = analyze.analyze_audio_cached(entry["file"], cache_dir, verbose=False, streaming=streaming)
+    charts = {path: analyze.create_chart_from_analysis(analysis, difficulty, entry["title"], entry["audioFile"], seed)
+              for difficulty, path in outputs.items()}
+    return write_outputs(charts, LANE_UPDATE_OPERATIONS)
+
+def builtin_targets(charts_dir, seed):
+    outputs = {name: os.path.join(charts_dir, f"gozen4ji_{name.lower()}.json")
+               for name in ("BEGINNER", "NORMAL", "HYPER", "ANOTHER")}
+    targets = [Target("gozen4ji", "create_chart", list(outputs.values()), [], {"seed": seed},
+                      build_gozen4ji, (outputs, seed))]
+    raw_path = os.path.join(charts_dir, RAW_RECORDING)
+    if os.path.exists(raw_path):
+        output = os.path.join(charts_dir, "cryinggirl_another.json")
+        targets.append(Target("cryinggirl_another", "generate_another", [output], [raw_path], {"seed": seed},
+                              build_another, (raw_path, output, seed)))
+    return targets
+
+def song_targets(inputs, manifest, charts_dir, seed, difficulties, streaming, cache_dir):
+    import analysis_cache
+    from importlib import metadata
+    from analyze import ANALYSIS_PARAMS, collect_audio_files
+    if cache_dir is None:
+        cache_dir = analysis_cache.CACHE_DIR
+    targets = []
+    for entry in collect_audio_files(inputs, manifest):
+        outputs = {d: os.path.join(charts_dir, f"{entry['id']}_{d.lower()}.json") for d in difficulties}
+        params = {
+            "seed": seed,
+            "difficulties": difficulties,
+            "title": entry["title"],
+            "audioFile": entry["audioFile"],
+            "analysis": dict(ANALYSIS_PARAMS, librosa=metadata.version("librosa"), streaming=streaming),
+        }
+        targets.append(Target(entry["id"], "analyze", list(outputs.values()), [entry["file"]], params,
+                              build_song, (entry, outputs, seed, streaming, cache_dir)))
+    return targets
+
+def stale_reason(target, fingerprint, state, hashes, force):
+    """作り直す理由（最新ならNone）"""
+    if force:
+        return "強制"
+    for path in target.outputs:
+        record = state["outputs"].get(os.path.normpath(path))
+        if record is None:
+            return "未ビルド"
+        if not os.path.exists(path):
+            return "出力なし"
+        if record["fingerprint"] != fingerprint:
+            return "入力の変更"
+        if hashes.get(path) != record["sha256"]:
+            return "出力が書き換えられた"
+    return None
+
+def _run_target(build, args):
+    start = time.perf_counter()
+    return build(*args), time.perf_counter() - start
+
+def build(targets, charts_dir=CHARTS_DIR, workers=None, force=(), dry_run=False):
+    """古くなったターゲットだけを並列で作り直し、(作り直した数, 失敗した数) を返す"""
+    state_path = os.path.join(charts_dir, STATE_NAME)
+    state = load_state(state_path)
+    hashes = FileHashes(state["inputs"])
+
+    stale = []
+    for target in targets:
+        fingerprint = target.fingerprint(hashes)
+        reason = stale_reason(target, fingerprint, state, hashes, target.name in force or "all" in force)
+        if reason:
+            stale.append((target, fingerprint))
+            print(f"[{reason}] {target.name}")
+    print(f"{len(targets)}ターゲット中 {len(stale)}件を作り直します")
+    if dry_run or not stale:
+        return len(stale), 0
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    failures = 0
+    workers = min(workers or os.cpu_count() or 1, len(stale))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_run_target, target.build, target.args): (target, fingerprint)
+                   for target, fingerprint in stale}
+        for future in as_completed(futures):
+            target, fingerprint = futures[future]
+            try:
+                written, elapsed = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"[失敗] {target.name}: {e}")
+                continue
+            for path, digest in written.items():
+                state["outputs"][os.path.normpath(path)] = {
+                    "target": target.name, "fingerprint": fingerprint, "sha256": digest,
+                }
+            print(f"[{elapsed:6.2f}秒] {target.name}: {len(written)}ファイル")
+
+    # 出力のハッシュは書き出したときの値で記録済みなので、入力のハッシュだけ引き継ぐ
+    inputs = {path: info for path, info in hashes.current.items() if path not in state["outputs"]}
+    write_json_atomic(state_path, {"version": STATE_VERSION, "inputs": inputs, "outputs": state["outputs"]})
+    return len(stale), failures
+
+def main():
+    parser = argparse.ArgumentParser(description="入力が変わった譜面だけを作り直す")
+    parser.add_argument("inputs", nargs="*", help="音楽ファイルまたはディレクトリ（曲ごとにターゲットを作る）")
+    parser.add_argument("--manifest", help="楽曲一覧（analyze.pyと同じ形式）")
+    parser.add_argument("--charts-dir", default=CHARTS_DIR)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="譜面生成の乱数シード")
+    parser.add_argument("--difficulties", default="BEGINNER,NORMAL,HYPER,ANOTHER",
+                        help="楽曲から生成する難易度（カンマ区切り）")
+    parser.add_argument("--streaming", action="store_true", help="楽曲をブロック単位で分析する")
+    parser.add_argument("--cache-dir", help="分析結果のキャッシュ先（既定: analysis_cacheと同じ）")
+    parser.add_argument("--workers", type=int, help="並列プロセス数")
+    parser.add_argument("--force", action="append", default=[], metavar="TARGET",
+                        help="指定したターゲットを強制的に作り直す（allで全て）")
+    parser.add_argument("--dry-run", action="store_true", help="作り直すターゲットを表示するだけ")
+    args = parser.parse_args()
+
+    targets = builtin_targets(args.charts_dir, args.seed)
+    if args.inputs or args.manifest:
+        difficulties = [d.strip().upper() for d in args.difficulties.split(",") if d.strip()]
+        targets += song_targets(args.inputs, args.manifest, args.charts_dir, args.seed, difficulties,
+                                args.streaming, args.cache_dir)
+
+    start = time.perf_counter()
+    rebuilt, failures = build(targets, args.charts_dir, args.workers, set(args.force), args.dry_run)
+    if not args.dry_run:
+        print(f"完了: {rebuilt - failures}件を作り直しました（失敗 {failures}件, {time.perf_counter() - start:.2f}秒）")
+    if failures:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
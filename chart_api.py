@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+譜面API（server.py / simple_server.py から使う）
+
+    GET /api/charts/<曲ID>
+        全難易度のメタデータ（ノーツ数・最初と最後のノーツの時刻を含む、ノーツ本体は含まない）
+    GET /api/charts/<曲ID>/<難易度>?from=30&to=60
+        メタデータと、from <= time < to のノーツ（from/to は省略可）。
+        返り値は譜面JSONと同じ形に "window"（範囲・件数・続きがあるか）を加えたもの
+    GET /api/charts/<曲ID>/normal,hyper?from=0&to=30
+        複数の難易度をまとめて返す（{"songId", "charts": {難易度: 上と同じ形}}）
+
+譜面はファイルのmtime・サイズが変わるまでメモリに保持し、ノーツは時刻順に並べて
+1件ずつJSONエンコード済みの文字列と時刻の配列（二分探索用）として持つ。
+リクエストごとにJSONを解析・エンコードし直さず、範囲の文字列を連結するだけで応答を作る。
+"""
+import glob
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from bisect import bisect_left
+from urllib.parse import parse_qs, urlsplit
+
+CHARTS_DIR = "assets/charts"
+API_PREFIX = "/api/charts/"
+# パスの要素は英数字・アンダースコア・ハイフンのみ（ディレクトリの外を指せないように）
+NAME_PATTERN = re.compile(r"^[\w-]+$")
+# これより小さい応答は圧縮しない
+GZIP_MIN_BYTES = 1024
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def content_length(header, max_bytes):
+    """POSTのContent-Lengthを検証して返す（ないときは411、max_bytesを超えるときは413）"""
+    if header is None:
+        raise ApiError(411, "Content-Lengthが必要です")
+    try:
+        length = int(header)
+    except ValueError:
+        raise ApiError(411, "Content-Lengthが不正です")
+    if length < 0 or length > max_bytes:
+        raise ApiError(413, f"本文は{max_bytes}バイト以内にしてください")
+    return length
+
+def parse_accept_encoding(header):
+    """Accept-Encodingからq=0でない形式の集合を取り出す（qが数値でなければ指定なしとみなす）"""
+    accepted = set()
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip().replace(" ", "")
+        if q.startswith("q="):
+            try:
+                if float(q[2:] or 0) == 0:
+                    continue
+            except ValueError:
+                pass
+        if name.strip():
+            accepted.add(name.strip().lower())
+    return accepted
+
+def coded_etag(etag, encoding):
+    """圧縮形式ごとの強いETag（同じ内容でも表現が違えば別のETagにする）"""
+    return etag if encoding == "identity" else f'{etag[:-1]}-{encoding}"'
+
+def base_etag(tag):
+    """ETagから W/ と圧縮形式の接尾辞を除いたもの"""
+    tag = tag.strip().removeprefix("W/")
+    for name in ("gzip", "br"):
+        if tag.endswith(f'-{name}"'):
+            return tag[:-len(name) - 2] + '"'
+    return tag
+
+def etag_matches(header, etag):
+    """If-None-Matchの比較（弱い比較なので W/ と圧縮形式の違いは無視する）"""
+    if header.strip() == "*":
+        return True
+    return any(base_etag(tag) == base_etag(etag) for tag in header.split(","))
+
+def json_response(status, data):
+    """(ステータス, ヘッダーのdict, 本文のbytes) の形のJSON応答"""
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return status, {"Content-Type": "application/json; charset=utf-8"}, body
+
+def note_time(note):
+    # 旧形式の譜面は time の代わりに timing を持つ
+    return note.get("time", note.get("timing"))
+
+class IndexedChart:
+    """1譜面分のメタデータ・時刻の索引・エンコード済みノーツ"""
+    def __init__(self, stat, chart):
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        notes = [note for note in chart.get("notes", []) if isinstance(note_time(note), (int, float))]
+        notes.sort(key=note_time)
+        self.times = [note_time(note) for note in notes]
+        self.encoded = [json.dumps(note, ensure_ascii=False, separators=(",", ":")) for note in notes]
+        self.meta = {key: value for key, value in chart.items() if key != "notes"}
+        meta_json = json.dumps(self.meta, ensure_ascii=False, separators=(",", ":"))
+        # 後ろに "window" と "notes" を続けられるよう閉じ括弧を外しておく
+        self.prefix = meta_json[:-1] + ("," if self.meta else "")
+
+    def summary(self):
+        return dict(self.meta, noteCount=len(self.times),
+                    firstNote=self.times[0] if self.times else None,
+                    lastNote=self.times[-1] if self.times else None)
+
+    def render(self, start=None, end=None):
+        """start <= time < end のノーツを含む譜面JSON（文字列）"""
+        i = 0 if start is None else bisect_left(self.times, start)
+        j = len(self.times) if end is None else max(i, bisect_left(self.times, end))
+        window = {"from": start, "to": end, "count": j - i, "total": len(self.times), "hasMore": j < len(self.times)}
+        return (f'{self.prefix}"window":{json.dumps(window)},'
+                f'"notes":[{",".join(self.encoded[i:j])}]}}')
+
+class ChartStore:
+    """ファイルが変わると読み直す譜面のキャッシュ（スレッドセーフ）"""
+    def __init__(self, charts_dir=CHARTS_DIR):
+        self.charts_dir = charts_dir
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def path(self, song_id, difficulty):
+        return os.path.join(self.charts_dir, f"{song_id}_{difficulty}.json")
+
+    def get(self, song_id, difficulty):
+        path = self.path(song_id, difficulty)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise ApiError(404, f"譜面がありません: {song_id}_{difficulty}")
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                return entry
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                chart = json.load(f)
+        except ValueError as e:
+            raise ApiError(500, f"譜面を読み込めません: {song_id}_{difficulty} ({e})")
+        if not isinstance(chart, dict) or "notes" not in chart:
+            raise ApiError(404, f"譜面ではありません: {song_id}_{difficulty}")
+        entry = IndexedChart(stat, chart)
+        with self.lock:
+            self.entries[path] = entry
+        return entry
+
+    def difficulties(self, song_id):
+        prefix = f"{song_id}_"
+        names = []
+        for path in sorted(glob.glob(os.path.join(self.charts_dir, f"{glob.escape(song_id)}_*.json"))):
+            name = os.path.splitext(os.path.basename(path))[0][len(prefix):]
+            if NAME_PATTERN.match(name) and "_" not in name:
+                names.append(name)
+        return names
+
+def parse_time(query, key):
+    values = query.get(key)
+    if not values:
+        return None
+    try:
+        value = float(values[0])
+    except ValueError:
+        raise ApiError(400, f"{key}は秒数で指定してください: {values[0]}")
+    if not math.isfinite(value):
+        raise ApiError(400, f"{key}は有限の値で指定してください")
+    return value
+
+def render_request(store, url):
+    """APIのURLから応答本文（JSON文字列）を作る"""
+    parts = urlsplit(url)
+    names = parts.path[len(API_PREFIX):].strip("/").split("/")
+    if len(names) > 2 or not NAME_PATTERN.match(names[0]):
+        raise ApiError(404, "不明なAPIです")
+    song_id = names[0]
+
+    if len(names) == 1:
+        difficulties = store.difficulties(song_id)
+        summaries = {}
+        for difficulty in difficulties:
+            try:
+                summaries[difficulty] = store.get(song_id, difficulty).summary()
+            except ApiError:
+                # 記録データなど譜面でないファイルは一覧に含めない
+                continue
+        if not summaries:
+            raise ApiError(404, f"曲がありません: {song_id}")
+        return json.dumps({"songId": song_id, "difficulties": summaries}, ensure_ascii=False, separators=(",", ":"))
+
+    query = parse_qs(parts.query)
+    start, end = parse_time(query, "from"), parse_time(query, "to")
+    requested = [name.strip().lower() for name in names[1].split(",") if name.strip()]
+    if not requested or not all(NAME_PATTERN.match(name) for name in requested):
+        raise ApiError(404, "不明な難易度です")
+    if len(requested) == 1:
+        return store.get(song_id, requested[0]).render(start, end)
+    charts = ",".join(f"{json.dumps(name)}:{store.get(song_id, name).render(start, end)}" for name in requested)
+    return f'{{"songId":{json.dumps(song_id, ensure_ascii=False)},"charts":{{{charts}}}}}'
+
+def respond(store, url, accept_encoding=None, if_none_match=None):
+    """(ステータス, ヘッダーのdict, 本文のbytes) を返す"""
+    try:
+        body = render_request(store, url).encode("utf-8")
+        status = 200
+    except ApiError as e:
+        body = json.dumps({"error": str(e)}, ensure_ascii=False).encode("utf-8")
+        status = e.status
+
+    headers = {"Content-Type": "application/json; charset=utf-8", "Vary": "Accept-Encoding"}
+    encoding = "identity"
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in parse_accept_encoding(accept_encoding):
+        encoding = "gzip"
+    if status == 200:
+        etag = coded_etag('"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"', encoding)
+        headers["ETag"] = etag
+        if if_none_match and etag_matches(if_none_match, etag):
+            return 304, headers, b""
+    if encoding == "gzip":
+        body = gzip.compress(body, compresslevel=6, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    return status, headers, body
+
+store = ChartStore()
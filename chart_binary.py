@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+譜面のバイナリ形式（.otc）の読み書きと、JSON譜面からの変換ツール
+
+レイアウト（リトルエンディアン）:
+    magic       4バイト  b"OTC1"
+    note_count  uint32
+    header_len  uint32   メタデータ（notes以外のキー）のUTF-8 JSONのバイト数
+    header      header_len バイト（4バイト境界までゼロ埋め）
+    time        float32 × note_count
+    duration    float32 × note_count   （NaN = durationなし）
+    lane        uint8   × note_count
+    type        uint8   × note_count   （255 = typeキーなし）
+
+列ごとに連続して並ぶので、読み込みは memoryview / numpy.frombuffer でコピーせずに行える。
+時刻はfloat32なので、JSONに戻すときは小数4桁に丸める（3桁で書かれた既存譜面は元の値に戻る）。
+それより細かい値（記録データそのままの時刻など）は約0.1ミリ秒の精度になる。
+
+使い方:
+    python chart_binary.py convert [譜面JSON ...]   # 既定は assets/charts/*.json
+    python chart_binary.py dump 譜面.otc
+"""
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from chart_model import NO_TYPE, TYPE_NAMES, NoteArray
+from paths import root_path
+
+MAGIC = b"OTC1"
+PREAMBLE = struct.Struct("<4sII")
+EXTENSION = ".otc"
+
+def _padded(length):
+    return (length + 3) & ~3
+
+def _float32_le(column):
+    values = array("f", column)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+def encode_chart(chart):
+    """譜面dictをバイナリ形式のbytesにする（time/lane形式でないノーツがあればValueError）"""
+    notes = NoteArray.from_notes(chart.get("notes", []))
+    n = len(notes)
+    meta = {key: value for key, value in chart.items() if key != "notes"}
+    header = json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    # 列はそのままバイト列にする（uint8の列は変換なし）
+    times = _float32_le(notes.times)
+    durations = _float32_le(notes.durations)
+    lanes = notes.lanes.tobytes()
+    types = notes.types.tobytes()
+
+    return b"".join([
+        PREAMBLE.pack(MAGIC, n, len(header)),
+        header.ljust(_padded(len(header)), b"\0"),
+        times, durations, lanes, types,
+    ])
+
+def write_chart(chart, path):
+    data = encode_chart(chart)
+    with open(path, "wb") as f:
+        f.write(data)
+    return len(data)
+
+class BinaryChart:
+    """バイナリ譜面のビュー。各列はバッファを共有する（コピーしない）"""
+    def __init__(self, buffer, owner=None):
+        self.buffer = memoryview(buffer)
+        self._owner = owner
+        magic, n, header_len = PREAMBLE.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("バイナリ譜面ではありません")
+        self.note_count = n
+        offset = PREAMBLE.size
+        self.meta = json.loads(bytes(self.buffer[offset:offset + header_len]).decode("utf-8"))
+        offset += _padded(header_len)
+        self.offsets = {
+            "time": offset,
+            "duration": offset + 4 * n,
+            "lane": offset + 8 * n,
+            "type": offset + 9 * n,
+        }
+        if len(self.buffer) < offset + 10 * n:
+            raise ValueError("バイナリ譜面が途中で切れています")
+
+    def _column(self, name, itemsize, fmt):
+        start = self.offsets[name]
+        view = self.buffer[start:start + itemsize * self.note_count]
+        if itemsize > 1 and sys.byteorder != "little":
+            # ビッグエンディアン環境ではmemoryviewのcastが使えないので展開する
+            return struct.unpack(f"<{self.note_count}{fmt}", view)
+        return view.cast(fmt)
+
+    @property
+    def times(self):
+        return self._column("time", 4, "f")
+
+    @property
+    def durations(self):
+        return self._column("duration", 4, "f")
+
+    @property
+    def lanes(self):
+        return self._column("lane", 1, "B")
+
+    @property
+    def types(self):
+        return self._column("type", 1, "B")
+
+    def to_numpy(self):
+        """NumPy配列（バッファを共有）として列を返す"""
+        import numpy as np
+        n = self.note_count
+        return {
+            "time": np.frombuffer(self.buffer, dtype="<f4", count=n, offset=self.offsets["time"]),
+            "duration": np.frombuffer(self.buffer, dtype="<f4", count=n, offset=self.offsets["duration"]),
+            "lane": np.frombuffer(self.buffer, dtype=np.uint8, count=n, offset=self.offsets["lane"]),
+            "type": np.frombuffer(self.buffer, dtype=np.uint8, count=n, offset=self.offsets["type"]),
+        }
+
+    def to_json_chart(self, decimals=4):
+        """既存のJSON譜面と同じ形のdictに戻す"""
+        notes = []
+        for time, lane, type_code, duration in zip(self.times, self.lanes, self.types, self.durations):
+            note = {"time": round(time, decimals), "lane": lane}
+            if type_code != NO_TYPE:
+                note["type"] = TYPE_NAMES[type_code]
+            if not math.isnan(duration):
+                note["duration"] = round(duration, decimals)
+            notes.append(note)
+        return dict(self.meta, notes=notes)
+
+    def close(self):
+        """列のビューやto_numpyの配列を使い終わってから呼ぶ"""
+        self.buffer.release()
+        if self._owner is not None:
+            self._owner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_chart(path):
+    """バイナリ譜面をmmapで開く（列はファイルのページを直接参照する）"""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return BinaryChart(mapped, owner=mapped)
+
+def convert_charts(paths):
+    """JSON譜面をバイナリ形式に変換し、サイズを比較して表示する"""
+    total_json = total_binary = 0
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            chart = json.load(f)
+        if "notes" not in chart:
+            # 記録データ（recordedTimings）などは対象外
+            continue
+        output = os.path.splitext(path)[0] + EXTENSION
+        try:
+            size = write_chart(chart, output)
+        except ValueError as e:
+            print(f"{path}: time/lane形式でないノーツを含むためスキップします（{e}）")
+            continue
+        json_size = os.path.getsize(path)
+        total_json += json_size
+        total_binary += size
+        print(f"{path} -> {output}: {json_size:,} -> {size:,} バイト ({json_size / size:.1f}分の1)")
+    if total_binary:
+        print(f"合計: {total_json:,} -> {total_binary:,} バイト ({total_json / total_binary:.1f}分の1)")
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("convert", "dump"):
+        print(__doc__)
+        return
+    if sys.argv[1] == "convert":
+        convert_charts(sys.argv[2:] or sorted(glob.glob(root_path("assets", "charts", "*.json"))))
+    else:
+        for path in sys.argv[2:]:
+            with read_chart(path) as chart:
+                print(json.dumps(chart.meta, ensure_ascii=False))
+                print(f"ノーツ数: {chart.note_count}")
+                for i, note in enumerate(chart.to_json_chart()["notes"][:10]):
+                    print(f"  {i}: {note}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""
+譜面の差分と3方向マージ
+
+indent=2 のJSONを行単位で比べても、数千ノーツの譜面では何が変わったか読めない。
+ノーツを (時刻, レーン) で対応付け、以下に分類して区間（SECTION_BARS 小節ごと）別に数える。
+- moved: 時刻が tolerance 秒以内でずれた、または同じ時刻で別のレーンに移った
+- changed: 同じ位置で種類・長さが変わった
+- added / removed: 対応するノーツがない
+
+対応付けはレーンごとに時刻順に並べた列どうしで「互いに最も近いノーツ」を searchsorted で求め、
+残ったノーツで繰り返す（重複したノーツも1回に1組ずつ対応する）。計算量は O(n log n)。
+レーンをまたぐ移動は、同じレーンで対応しなかったノーツどうしを時刻だけで対応付けて求める。
+
+3方向マージは、共通の元（BASE）から手で編集した譜面（OURS、chart-editor.js の出力など）と
+作り直した譜面（THEIRS）への変更を合わせる。同じノーツを両方が違うように変えた所は衝突として
+--prefer の側を採用し、終了コード1で知らせる。メタデータ（notes以外のキー）もキーごとに同じ規則で合わせる。
+
+使い方:
+    python chart_diff.py old.json new.json
+    python chart_diff.py --rev HEAD assets/charts/*.json          # 作り直した譜面をコミット済みのものと比べる
+    python chart_diff.py old_charts/ assets/charts/               # ディレクトリどうし（同じファイル名を比べる）
+    python chart_diff.py --merge base.json edited.json regenerated.json --output merged.json
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from chart_model import NO_TYPE, TYPE_NAMES, Chart, NoteArray
+from chart_transform import write_json_atomic
+
+# これ以下の時刻の差は同じ位置とみなす（譜面の時刻は3桁に丸めて書かれる）
+SAME_TIME = 0.0005
+# これ以下の時刻の差は「移動」、これより大きければ削除＋追加とみなす
+DEFAULT_TOLERANCE = 0.1
+# 区間の長さ（小節数、bpmがなければ DEFAULT_BPM で数える）
+SECTION_BARS = 8
+DEFAULT_BPM = 120
+KINDS = ("moved", "changed", "added", "removed")
+# メタデータのキーがないことを表す値
+MISSING = object()
+
+def _view(column, dtype):
+    import numpy as np
+    return np.frombuffer(column, dtype=dtype) if len(column) else np.zeros(0, dtype=dtype)
+
+def columns(notes):
+    """NoteArray を (時刻, レーン, 種類, 長さ) のNumPy配列にする（レーン以外はコピーしない）"""
+    import numpy as np
+    return (_view(notes.times, np.float64), _view(notes.lanes, np.uint8).astype(np.int64),
+            _view(notes.types, np.uint8), _view(notes.durations, np.float64))
+
+def nearest(sorted_values, values):
+    """各valuesに最も近いsorted_valuesの番号（同じ距離なら小さい方）"""
+    import numpy as np
+    if len(sorted_values) == 1:
+        return np.zeros(len(values), dtype=np.int64)
+    i = np.clip(np.searchsorted(sorted_values, values), 1, len(sorted_values) - 1)
+    left, right = sorted_values[i - 1], sorted_values[i]
+    return np.where(values - left <= right - values, i - 1, i)
+
+def match_sorted(a, b, tolerance):
+    """昇順の列a・bで、互いに最も近く差がtolerance以下の組を対応付ける。戻り値は (aの番号, bの番号)"""
+    import numpy as np
+    a_left, b_left = np.arange(len(a)), np.arange(len(b))
+    pairs_a, pairs_b = [], []
+    while len(a_left) and len(b_left):
+        av, bv = a[a_left], b[b_left]
+        to_b = nearest(bv, av)
+        to_a = nearest(av, bv)
+        found_a = np.flatnonzero(to_a[to_b] == np.arange(len(av)))
+        found_b = to_b[found_a]
+        close = np.abs(av[found_a] - bv[found_b]) <= tolerance
+        found_a, found_b = found_a[close], found_b[close]
+        if len(found_a) == 0:
+            break
+        pairs_a.append(a_left[found_a])
+        pairs_b.append(b_left[found_b])
+        a_left = np.delete(a_left, found_a)
+        b_left = np.delete(b_left, found_b)
+    if not pairs_a:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+def match_keyed(times_a, keys_a, times_b, keys_b, tolerance):
+    """同じキー（レーン）どうしで時刻を対応付ける。キーごとに時刻をずらして1本の列にまとめて1回で求める"""
+    import numpy as np
+    if len(times_a) == 0 or len(times_b) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    low = min(times_a.min(), times_b.min())
+    span = max(times_a.max(), times_b.max()) - low + 2 * tolerance + 1.0
+    shifted_a = times_a - low + keys_a * span
+    shifted_b = times_b - low + keys_b * span
+    order_a = np.argsort(shifted_a, kind="stable")
+    order_b = np.argsort(shifted_b, kind="stable")
+    pa, pb = match_sorted(shifted_a[order_a], shifted_b[order_b], tolerance)
+    return order_a[pa], order_b[pb]
+
+def align(old, new, tolerance=DEFAULT_TOLERANCE):
+    """2つの NoteArray のノーツを対応付ける。戻り値は {"pairs": (旧の番号, 新の番号), "removed", "added"}"""
+    import numpy as np
+    old_time, old_lane, _, _ = columns(old)
+    new_time, new_lane, _, _ = columns(new)
+    old_index, new_index = match_keyed(old_time, old_lane, new_time, new_lane, tolerance)
+    # 同じレーンで対応しなかったノーツどうしを、同じ時刻ならレーンの移動とみなす
+    rest_old = np.setdiff1d(np.arange(len(old)), old_index)
+    rest_new = np.setdiff1d(np.arange(len(new)), new_index)
+    zeros_old, zeros_new = np.zeros(len(rest_old), dtype=np.int64), np.zeros(len(rest_new), dtype=np.int64)
+    cross_old, cross_new = match_keyed(old_time[rest_old], zeros_old, new_time[rest_new], zeros_new, SAME_TIME)
+    old_index = np.concatenate([old_index, rest_old[cross_old]])
+    new_index = np.concatenate([new_index, rest_new[cross_new]])
+    order = np.argsort(old_index, kind="stable")
+    return {
+        "pairs": (old_index[order], new_index[order]),
+        "removed": np.setdiff1d(np.arange(len(old)), old_index),
+        "added": np.setdiff1d(np.arange(len(new)), new_index),
+    }
+
+def same_duration(a, b):
+    import numpy as np
+    return (np.isnan(a) & np.isnan(b)) | (np.abs(a - b) <= SAME_TIME)
+
+def classify_pairs(old, new, old_index, new_index):
+    """対応した組を moved（時刻・レーン）/ changed（種類・長さ）/ 変化なし に分けたマスクを返す"""
+    import numpy as np
+    old_time, old_lane, old_type, old_duration = columns(old)
+    new_time, new_lane, new_type, new_duration = columns(new)
+    moved = ((np.abs(old_time[old_index] - new_time[new_index]) > SAME_TIME)
+             | (old_lane[old_index] != new_lane[new_index]))
+    changed = ~moved & ((old_type[old_index] != new_type[new_index])
+                        | ~same_duration(old_duration[old_index], new_duration[new_index]))
+    return moved, changed
+
+def section_seconds(chart):
+    bpm = chart.meta.get("bpm")
+    bpm = bpm if isinstance(bpm, (int, float)) and bpm > 0 else DEFAULT_BPM
+    return SECTION_BARS * 4 * 60.0 / bpm
+
+def diff_charts(old, new, tolerance=DEFAULT_TOLERANCE):
+    """2つの Chart の差分（種類ごとの数、区間ごとの数、メタデータの変更、各ノーツの変更）"""
+    import numpy as np
+    alignment = align(old.notes, new.notes, tolerance)
+    old_index, new_index = alignment["pairs"]
+    moved, changed = classify_pairs(old.notes, new.notes, old_index, new_index)
+    old_time, new_time = columns(old.notes)[0], columns(new.notes)[0]
+    events = {
+        "moved": (old_index[moved], new_index[moved]),
+        "changed": (old_index[changed], new_index[changed]),
+        "added": (np.zeros(0, dtype=np.int64), alignment["added"]),
+        "removed": (alignment["removed"], np.zeros(0, dtype=np.int64)),
+    }
+    # 区間は新しい譜面のbpmで数える（削除は元の時刻、それ以外は新しい時刻の区間）
+    length = section_seconds(new)
+    section_of = {kind: np.maximum((old_time[o] if kind == "removed" else new_time[n]) // length, 0).astype(np.int64)
+                  for kind, (o, n) in events.items()}
+    count = max([int(s.max()) + 1 for s in section_of.values() if len(s)], default=0)
+    per_kind = {kind: np.bincount(s, minlength=count) for kind, s in section_of.items()}
+    sections = [{"start": round(i * length, 3), "end": round((i + 1) * length, 3),
+                 **{kind: int(per_kind[kind][i]) for kind in KINDS}}
+                for i in range(count) if any(per_kind[kind][i] for kind in KINDS)]
+    meta_keys = list(dict.fromkeys(list(old.meta) + list(new.meta)))
+    return {
+        "counts": {"unchanged": int(len(old_index) - moved.sum() - changed.sum()),
+                   **{kind: len(events[kind][0]) or len(events[kind][1]) for kind in KINDS}},
+        "sections": sections,
+        "meta": [key for key in meta_keys if old.meta.get(key, MISSING) != new.meta.get(key, MISSING)],
+        "events": events,
+    }
+
+def describe_note(notes, i):
+    time, lane, code, duration = notes.times[i], notes.lanes[i], notes.types[i], notes.durations[i]
+    text = f"{time:.3f}秒 レーン{lane}"
+    if code != NO_TYPE:
+        text += f" {TYPE_NAMES[code]}"
+    if duration == duration:
+        text += f" 長さ{duration:g}"
+    return text
+
+def print_diff(name, old, new, result, verbose=False):
+    counts = result["counts"]
+    if not any(counts[kind] for kind in KINDS) and not result["meta"]:
+        print(f"{name}: 変更なし（{counts['unchanged']}ノーツ）")
+        return
+    print(f"{name}: 変化なし {counts['unchanged']} / 移動 {counts['moved']} / 種類・長さ {counts['changed']} "
+          f"/ 追加 {counts['added']} / 削除 {counts['removed']}")
+    for key in result["meta"]:
+        print(f"  {key}: {json.dumps(old.meta.get(key), ensure_ascii=False)} -> "
+              f"{json.dumps(new.meta.get(key), ensure_ascii=False)}")
+    for section in result["sections"]:
+        parts = [f"{label}{section[kind]}" for kind, label in zip(KINDS, ("~", "*", "+", "-")) if section[kind]]
+        print(f"  {section['start']:8.2f}〜{section['end']:8.2f}秒: {' '.join(parts)}")
+    if verbose:
+        for kind, (old_index, new_index) in result["events"].items():
+            for i in range(max(len(old_index), len(new_index))):
+                before = describe_note(old.notes, old_index[i]) if len(old_index) else ""
+                after = describe_note(new.notes, new_index[i]) if len(new_index) else ""
+                print(f"    {kind:<8} {before}{' -> ' if before and after else ''}{after}")
+
+class Skipped(str):
+    """比べなかったファイルの説明（譜面でない・旧形式など。変更のあったファイルとして数えない）"""
+
+def load(path, rev=None):
+    """譜面を読み込む（revを指定するとgitのそのリビジョンの内容）。なければNone"""
+    if rev is None:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    else:
+        result = subprocess.run(["git", "show", f"{rev}:./{os.path.basename(path)}"], capture_output=True,
+                                cwd=os.path.dirname(os.path.abspath(path)))
+        if result.returncode != 0:
+            return None
+        data = json.loads(result.stdout.decode("utf-8"))
+    return Chart.from_dict(data)
+
+def diff_files(old_path, new_path, tolerance=DEFAULT_TOLERANCE, rev=None):
+    """2ファイル（revがあれば new_path のそのリビジョンと現在）を比べる
+
+    片方にしかないファイルは文字列、譜面でない・旧形式のファイル（index.json、記録データなど）は Skipped を返す
+    """
+    try:
+        old = load(new_path if rev else old_path, rev)
+        new = load(new_path)
+    except (ValueError, UnicodeDecodeError) as e:
+        return None, None, Skipped(f"time/lane形式の譜面ではないので比べません（{e}）")
+    if old is None and new is None:
+        return None, None, Skipped(f"ファイルがありません（{rev}にもありません）" if rev else "ファイルがありません")
+    if old is None or new is None:
+        return old, new, "新しいファイルです" if old is None else "削除されたファイルです"
+    return old, new, diff_charts(old, new, tolerance)
+
+def _diff_files_args(args):
+    old, new, result = diff_files(*args)
+    if isinstance(result, dict):
+        # events の番号はプロセス間で渡さず、表示に使う分だけ返す
+        result = dict(result, events={kind: (o.tolist(), n.tolist()) for kind, (o, n) in result["events"].items()})
+    return old, new, result
+
+def file_pairs(paths, rev):
+    """比べるファイルの組（表示名, 旧, 新）"""
+    # 旧・新の順序を保つ（globの結果だけ並べ替える）
+    paths = list(dict.fromkeys(path for pattern in paths for path in (sorted(glob.glob(pattern)) or [pattern])))
+    if rev:
+        return [(path, path, path) for path in paths]
+    if len(paths) != 2:
+        raise SystemExit("比べる2つのファイル（またはディレクトリ）を指定してください")
+    old, new = paths if os.path.isdir(paths[0]) == os.path.isdir(paths[1]) else (None, None)
+    if old is None:
+        raise SystemExit("ファイルとディレクトリは比べられません")
+    if not os.path.isdir(old):
+        missing = [path for path in (old, new) if not os.path.exists(path)]
+        if missing:
+            raise SystemExit(f"ファイルがありません: {', '.join(missing)}")
+        return [(f"{old} -> {new}", old, new)]
+    names = sorted({name for directory in (old, new) for name in os.listdir(directory) if name.endswith(".json")})
+    return [(name, os.path.join(old, name), os.path.join(new, name)) for name in names]
+
+def run_diff(paths, rev=None, tolerance=DEFAULT_TOLERANCE, workers=None, verbose=False):
+    """差分を表示し、変更のあったファイル数を返す"""
+    import numpy as np
+    pairs = file_pairs(paths, rev)
+    jobs = [(old, new, tolerance, rev) for _, old, new in pairs]
+    workers = min(workers or os.cpu_count() or 1, len(jobs) or 1)
+    if workers == 1:
+        results = [_diff_files_args(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_diff_files_args, jobs))
+    changed = skipped = 0
+    for (name, _, _), (old, new, result) in zip(pairs, results):
+        if isinstance(result, Skipped):
+            print(f"{name}: {result}")
+            skipped += 1
+            continue
+        if isinstance(result, str):
+            print(f"{name}: {result}")
+            changed += 1
+            continue
+        result["events"] = {kind: (np.asarray(o, dtype=np.int64), np.asarray(n, dtype=np.int64))
+                            for kind, (o, n) in result["events"].items()}
+        print_diff(name, old, new, result, verbose)
+        changed += bool(any(result["counts"][kind] for kind in KINDS) or result["meta"])
+    note = f"（{skipped}ファイルは比べていません）" if skipped else ""
+    print(f"\n{len(pairs) - skipped}ファイル中 {changed}ファイルに変更があります{note}")
+    return changed
+
+def same_notes(a, i, b, j):
+    """2つのノーツが同じ位置・同じ種類・同じ長さか"""
+    da, db = a.durations[i], b.durations[j]
+    return (abs(a.times[i] - b.times[j]) <= SAME_TIME and a.lanes[i] == b.lanes[j] and a.types[i] == b.types[j]
+            and ((da != da and db != db) or abs(da - db) <= SAME_TIME))
+
+def merge_value(base, ours, theirs, prefer):
+    """3方向マージの1値分。戻り値は (採用する値, 衝突したか)"""
+    if ours == theirs or theirs == base:
+        return ours, False
+    if ours == base:
+        return theirs, False
+    return (ours if prefer == "ours" else theirs), True
+
+def merge_charts(base, ours, theirs, tolerance=DEFAULT_TOLERANCE, prefer="ours"):
+    """3方向マージ。戻り値は (マージした Chart, 衝突の説明のリスト)"""
+    import numpy as np
+    conflicts = []
+    sides = {"ours": ours, "theirs": theirs}
+    # 元の各ノーツに対する各側の結果（対応するノーツの番号、削除ならNone）
+    outcome = {}
+    added = {}
+    for side, chart in sides.items():
+        alignment = align(base.notes, chart.notes, tolerance)
+        mapping = [None] * len(base.notes)
+        for i, j in zip(*(index.tolist() for index in alignment["pairs"])):
+            mapping[i] = j
+        outcome[side] = mapping
+        added[side] = alignment["added"]
+
+    picked = []
+    for i in range(len(base.notes)):
+        o, t = outcome["ours"][i], outcome["theirs"][i]
+        ours_changed = o is None or not same_notes(base.notes, i, ours.notes, o)
+        theirs_changed = t is None or not same_notes(base.notes, i, theirs.notes, t)
+        agree = (o is None and t is None) or (o is not None and t is not None
+                                              and same_notes(ours.notes, o, theirs.notes, t))
+        if not theirs_changed or agree:
+            choice = ("ours", o)
+        elif not ours_changed:
+            choice = ("theirs", t)
+        else:
+            choice = (prefer, o if prefer == "ours" else t)
+            conflicts.append(f"{describe_note(base.notes, i)}: 両方で変更"
+                             f"（ours: {describe_note(ours.notes, o) if o is not None else '削除'}、"
+                             f"theirs: {describe_note(theirs.notes, t) if t is not None else '削除'}）")
+        if choice[1] is not None:
+            picked.append(choice)
+
+    # 追加したノーツは両方とも入れる（同じ位置に両方が追加したものは1つにまとめる）
+    ours_added, theirs_added = added["ours"], added["theirs"]
+    ours_time, ours_lane = columns(ours.notes)[:2]
+    theirs_time, theirs_lane = columns(theirs.notes)[:2]
+    pa, pb = match_keyed(ours_time[ours_added], ours_lane[ours_added],
+                         theirs_time[theirs_added], theirs_lane[theirs_added], SAME_TIME)
+    for a, b in zip(ours_added[pa].tolist(), theirs_added[pb].tolist()):
+        if same_notes(ours.notes, a, theirs.notes, b):
+            picked.append(("ours", a))
+        else:
+            conflicts.append(f"{describe_note(ours.notes, a)}: 両方で違うノーツを追加"
+                             f"（theirs: {describe_note(theirs.notes, b)}）")
+            picked.append((prefer, a if prefer == "ours" else b))
+    picked += [("ours", j) for j in np.delete(ours_added, pa).tolist()]
+    picked += [("theirs", j) for j in np.delete(theirs_added, pb).tolist()]
+
+    notes = build_notes(sides, picked)
+    meta = {}
+    for key in dict.fromkeys(list(ours.meta) + list(theirs.meta) + list(base.meta)):
+        value, conflict = merge_value(base.meta.get(key, MISSING), ours.meta.get(key, MISSING),
+                                      theirs.meta.get(key, MISSING), prefer)
+        if conflict:
+            conflicts.append(f"メタデータ {key}: 両方で変更")
+        if value is not MISSING:
+            meta[key] = value
+    return Chart(meta, notes, min(ours.notes_at, len(meta))), conflicts
+
+def build_notes(sides, picked):
+    """(側, ノーツ番号) のリストから、時刻順（同時刻は元の順序）の NoteArray を作る"""
+    rows = sorted(((sides[side].notes.times[j], k, side, j) for k, (side, j) in enumerate(picked)))
+    columns_out = {name: array(getattr(NoteArray(), name).typecode) for name in NoteArray.__slots__}
+    for _, _, side, j in rows:
+        for name in NoteArray.__slots__:
+            columns_out[name].append(getattr(sides[side].notes, name)[j])
+    return NoteArray(*(columns_out[name] for name in NoteArray.__slots__))
+
+def main():
+    parser = argparse.ArgumentParser(description="譜面の差分（ノーツを時刻・レーンで対応付ける）と3方向マージ")
+    parser.add_argument("paths", nargs="+",
+                        help="比べる2つのファイルかディレクトリ、--rev なら譜面ファイル、--merge なら BASE OURS THEIRS")
+    parser.add_argument("--rev", help="gitのリビジョン（指定すると各ファイルをその版と比べる）")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="移動とみなす時刻の差（秒）")
+    parser.add_argument("--verbose", "-v", action="store_true", help="変わったノーツを全て表示する")
+    parser.add_argument("--workers", type=int, help="並列プロセス数")
+    parser.add_argument("--merge", action="store_true", help="3方向マージを行う")
+    parser.add_argument("--output", help="マージ結果の出力先（既定は OURS を上書き）")
+    parser.add_argument("--prefer", choices=("ours", "theirs"), default="ours", help="衝突したときに採用する側")
+    args = parser.parse_args()
+
+    if not args.merge:
+        run_diff(args.paths, args.rev, args.tolerance, args.workers, args.verbose)
+        return
+    if len(args.paths) != 3:
+        parser.error("--merge には BASE OURS THEIRS の3ファイルを指定してください")
+    try:
+        base, ours, theirs = (load(path) for path in args.paths)
+    except (ValueError, UnicodeDecodeError) as e:
+        parser.error(f"マージできない譜面です: {e}")
+    missing = [path for path, chart in zip(args.paths, (base, ours, theirs)) if chart is None]
+    if missing:
+        parser.error(f"ファイルがありません: {', '.join(missing)}")
+    merged, conflicts = merge_charts(base, ours, theirs, args.tolerance, args.prefer)
+    output = args.output or args.paths[1]
+    write_json_atomic(output, merged)
+    print(f"マージ結果: {output}（{len(merged.notes)}ノーツ）")
+    for conflict in conflicts:
+        print(f"  衝突: {conflict}")
+    if conflicts:
+        print(f"{len(conflicts)}件の衝突は{args.prefer}の側を採用しました")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
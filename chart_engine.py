@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+譜面生成の共通エンジン
+ノーツを1つずつdictで作るのではなく、時刻・レーン・種類・長さをNumPy配列でまとめて計算する。
+乱数は1つの numpy.random.Generator から引くので、同じシードなら同じ譜面になる。
+dictへの変換は書き出す直前に to_notes で1回だけ行う。
+"""
+import numpy as np
+
+# ノーツ種類のコード
+TAP, HOLD, SCRATCH = 0, 1, 2
+TYPE_NAMES = ("tap", "hold", "scratch")
+
+def make_rng(seed=None):
+    """シード（またはGenerator）から乱数生成器を作る"""
+    if isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+def columns(time, lane, type_=TAP, duration=np.nan):
+    """ノーツ列（列ごとの配列の辞書）を作る。type_とdurationはスカラーなら全ノーツ共通"""
+    time = np.asarray(time, dtype=np.float64)
+    n = len(time)
+    return {
+        "time": time,
+        "lane": np.broadcast_to(np.asarray(lane, dtype=np.int64), (n,)).copy(),
+        "type": np.broadcast_to(np.asarray(type_, dtype=np.int8), (n,)).copy(),
+        "duration": np.broadcast_to(np.asarray(duration, dtype=np.float64), (n,)).copy(),
+    }
+
+def empty():
+    return columns([], [])
+
+def concat(*parts):
+    """複数のノーツ列を連結"""
+    return {key: np.concatenate([part[key] for part in parts]) for key in ("time", "lane", "type", "duration")}
+
+def take(cols, index):
+    """インデックスまたは真偽値マスクでノーツを選ぶ"""
+    return {key: value[index] for key, value in cols.items()}
+
+def sort_by_time(cols):
+    """時刻で安定ソート（同時刻は元の順序を保つ）"""
+    return take(cols, np.argsort(cols["time"], kind="stable"))
+
+def subdivision_grid(beat_times, beat_interval, divisor, end_time):
+    """end_timeより前の各ビートをdivisor分割した時刻と、ビート番号・分割番号を返す"""
+    beats = np.asarray(beat_times, dtype=np.float64)
+    # 元の実装と同じく、end_time以降のビートが出た時点で打ち切る
+    late = np.nonzero(beats >= end_time)[0]
+    if len(late):
+        beats = beats[:late[0]]
+    sub = np.arange(divisor)
+    times = (beats[:, None] + sub[None, :] * (beat_interval / divisor)).ravel()
+    beat_index = np.repeat(np.arange(len(beats)), divisor)
+    sub_index = np.tile(sub, len(beats))
+    return times, beat_index, sub_index
+
+def walk_lanes(rng, n, lane_count):
+    """直前と同じレーンが続かないランダムなレーン列（各ノーツは直前以外から一様に選ぶ）"""
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if lane_count < 2:
+        return np.zeros(n, dtype=np.int64)
+    steps = rng.integers(1, lane_count, size=n)
+    steps[0] = rng.integers(0, lane_count)
+    return np.cumsum(steps) % lane_count
+
+def random_lanes(rng, n, lanes):
+    """lanesから一様にn個選ぶ"""
+    lanes = np.asarray(lanes)
+    return lanes[rng.integers(0, len(lanes), size=n)]
+
+def chance(rng, n, probability):
+    """確率probabilityでTrueになるマスク"""
+    return rng.random(n) < probability
+
+def chord_sizes(rng, n, sizes=(1, 2, 3), probabilities=(0.7, 0.2, 0.1)):
+    """各タイミングの同時押し数"""
+    return rng.choice(np.asarray(sizes), size=n, p=np.asarray(probabilities))
+
+def chord_lanes(rng, sizes, lanes):
+    """各タイミングにsizes[i]個の重複しないレーンを割り当てる
+
+    戻り値は (タイミング番号, レーン) の配列の組。同じタイミング内ではレーンの昇順に並ぶ。
+    """
+    lanes = np.asarray(lanes)
+    sizes = np.asarray(sizes)
+    if len(sizes) == 0:
+        return np.zeros(0, dtype=np.int64), lanes[:0]
+    width = int(sizes.max())
+    # 行ごとのランダムな並び替えの先頭sizes[i]個を使う
+    order = np.argsort(rng.random((len(sizes), len(lanes))), axis=1)[:, :width]
+    rows, cols = np.nonzero(np.arange(width)[None, :] < sizes[:, None])
+    chosen = lanes[order[rows, cols]]
+    ordering = np.lexsort((chosen, rows))
+    return rows[ordering], chosen[ordering]
+
+def thin_min_gap(times, gap):
+    """昇順の時刻列から、直前に採用した時刻とgap以上離れたものだけを残すマスク"""
+    times = np.asarray(times, dtype=np.float64)
+    keep = np.ones(len(times), dtype=bool)
+    if len(times) < 2 or np.all(np.diff(times) >= gap):
+        return keep
+    last = -np.inf
+    for i, t in enumerate(times.tolist()):
+        if t - last < gap:
+            keep[i] = False
+        else:
+            last = t
+    return keep
+
+def near_any(sorted_times, times, window):
+    """各timesについて、ソート済みのsorted_timesに差がwindow未満のものがあるか"""
+    sorted_times = np.asarray(sorted_times, dtype=np.float64)
+    times = np.asarray(times, dtype=np.float64)
+    if len(sorted_times) == 0:
+        return np.zeros(len(times), dtype=bool)
+    i = np.searchsorted(sorted_times, times)
+    right = sorted_times[np.minimum(i, len(sorted_times) - 1)]
+    left = sorted_times[np.maximum(i - 1, 0)]
+    return (np.abs(right - times) < window) | (np.abs(left - times) < window)
+
+def cap_peak_density(times, priority, max_notes, window=1.0):
+    """時刻順のノーツから、幅windowの区間に max_notes 個より多く入らないよう優先度の低いノーツを除くマスク
+
+    残したノーツで「i番目と i+max_notes 番目の差が window 未満」の所を求め、重ならない所ごとに max_notes+1 個の中で
+    優先度が最も低いノーツをまとめて除く。超えている所がなくなるまで繰り返す（1回ごとに全体を配列演算で処理する）。
+    重なる所からも同時に除くと、1個除けば足りる所で2個除いてしまうので、1回に除くのは重ならない所だけにする
+    """
+    times = np.asarray(times, dtype=np.float64)
+    priority = np.asarray(priority, dtype=np.float64)
+    keep = np.ones(len(times), dtype=bool)
+    kept = np.arange(len(times))
+    while len(kept) > max_notes:
+        t = times[kept]
+        crowded = np.flatnonzero(t[max_notes:] - t[:-max_notes] < window)
+        if len(crowded) == 0:
+            break
+        # 続いている所の先頭から max_notes+1 個おきに選ぶ
+        run_start = np.maximum.accumulate(np.where(np.diff(crowded, prepend=-max_notes - 2) > 1, crowded, 0))
+        crowded = crowded[(crowded - run_start) % (max_notes + 1) == 0]
+        windows = np.lib.stride_tricks.sliding_window_view(priority[kept], max_notes + 1)[crowded]
+        drop = np.unique(crowded + windows.argmin(axis=1))
+        keep[kept[drop]] = False
+        kept = np.delete(kept, drop)
+    return keep
+
+def keep_highest(priority, count, mask=None):
+    """mask が True のノーツのうち、優先度の高い順に count 個だけ残すマスク"""
+    priority = np.asarray(priority, dtype=np.float64)
+    mask = np.ones(len(priority), dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    candidates = np.flatnonzero(mask)
+    if count >= len(candidates):
+        return mask.copy()
+    keep = np.zeros(len(priority), dtype=bool)
+    if count > 0:
+        keep[candidates[np.argpartition(-priority[candidates], count - 1)[:count]]] = True
+    return keep
+
+def thin_to_targets(times, priority, note_count, peak_nps, window=1.0):
+    """時刻順のノーツを、最大密度（window秒あたり peak_nps × window 個）とノーツ数の目標まで優先度の低い順に減らすマスク
+
+    最大密度を先に満たしてから全体を note_count 個に減らす（減らしても密度は上がらない）。
+    密度の上限で note_count を下回ったときはそのまま返す
+    """
+    keep = cap_peak_density(times, priority, max(int(peak_nps * window), 1), window)
+    return keep_highest(priority, note_count, keep)
+
+def to_notes(cols, decimals=3, with_type=True):
+    """ノーツ列を譜面JSONのノーツdictのリストに変換する
+
+    decimalsがNoneなら時刻を丸めない。durationがNaNのノーツにはdurationキーを付けない。
+    """
+    times = cols["time"] if decimals is None else np.round(cols["time"], decimals)
+    durations = cols["duration"] if decimals is None else np.round(cols["duration"], decimals)
+    times = times.tolist()
+    lanes = cols["lane"].tolist()
+    types = cols["type"].tolist()
+    has_duration = (~np.isnan(cols["duration"])).tolist()
+    durations = durations.tolist()
+
+    notes = []
+    for time, lane, type_, has, duration in zip(times, lanes, types, has_duration, durations):
+        note = {"time": time, "lane": lane}
+        if with_type:
+            note["type"] = TYPE_NAMES[type_]
+        if has:
+            note["duration"] = duration
+        notes.append(note)
+    return notes
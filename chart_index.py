@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+譜面の統計と検証を行い、マニフェスト（assets/charts/index.json）にまとめるツール
+
+譜面ごとに以下を記録する:
+- ノーツ数、曲中の範囲、スライディングウィンドウ（1/2/5秒）での最大ノーツ密度
+- 同時押し数の分布、レーンごとのノーツ数、ホールド・スクラッチの割合
+- 検証エラー（6鍵+スクラッチの範囲外のレーン、ホールドの重なりなど）
+
+マニフェストはファイルのmtime・サイズ・ハッシュで差分更新するので、変わった譜面だけを読み直す。
+ゲームの曲選択やQAは、全譜面を取得する代わりにこのファイルだけを読めばよい。
+
+使い方:
+    python chart_index.py            # マニフェストを更新してサマリーを表示
+    python chart_index.py --check    # 検証エラーがあれば終了コード1
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+from collections import Counter
+from datetime import datetime, timezone
+
+from chart_transform import write_json_atomic
+from paths import root_path
+
+CHARTS_DIR = root_path("assets", "charts")
+MANIFEST_NAME = "index.json"
+# 統計の計算方法を変えたらここを上げて全譜面を読み直す
+MANIFEST_VERSION = 1
+
+# 6鍵（0〜5）+ スクラッチ（6）
+SCRATCH_LANE = 6
+LANE_COUNT = 7
+NOTE_TYPES = ("tap", "hold", "scratch")
+NPS_WINDOWS = (1.0, 2.0, 5.0)
+# 同じレーンでこれより近いノーツは重複とみなす
+DUPLICATE_WINDOW = 0.001
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def peak_notes_in_window(times, window):
+    """ソート済みの時刻列で、幅windowの区間に入る最大ノーツ数（尺取り法）"""
+    peak = 0
+    start = 0
+    for end, time in enumerate(times):
+        while time - times[start] >= window:
+            start += 1
+        peak = max(peak, end - start + 1)
+    return peak
+
+def validate_notes(notes):
+    """ノーツ列の検証エラーを列挙する"""
+    errors = []
+    malformed = [i for i, note in enumerate(notes)
+                 if not isinstance(note.get("time"), (int, float)) or not isinstance(note.get("lane"), int)]
+    if malformed:
+        errors.append(f"time/laneが数値でないノーツが{len(malformed)}個あります（最初: #{malformed[0]}）")
+        return errors
+
+    previous_time = None
+    hold_end = {}
+    last_in_lane = {}
+    for i, note in enumerate(notes):
+        time, lane, note_type = note["time"], note["lane"], note.get("type", "tap")
+        if time < 0:
+            errors.append(f"#{i}: 時刻が負の値です ({time})")
+        if previous_time is not None and time < previous_time:
+            errors.append(f"#{i}: 時刻順に並んでいません ({previous_time} -> {time})")
+        previous_time = time
+
+        if not 0 <= lane < LANE_COUNT:
+            errors.append(f"#{i}: レーン{lane}は範囲外です（0〜{LANE_COUNT - 1}）")
+        if note_type not in NOTE_TYPES:
+            errors.append(f"#{i}: 不明なノーツ種類です ({note_type})")
+        if note_type == "scratch" and lane != SCRATCH_LANE:
+            errors.append(f"#{i}: スクラッチノーツがスクラッチレーン以外（{lane}）にあります")
+        if note_type == "hold" and not note.get("duration", 0) > 0:
+            errors.append(f"#{i}: ホールドノーツの長さがありません")
+
+        if lane in hold_end and time < hold_end[lane]:
+            errors.append(f"#{i}: レーン{lane}のホールド中（{hold_end[lane]:.3f}秒まで）にノーツがあります")
+        if lane in last_in_lane and abs(time - last_in_lane[lane]) < DUPLICATE_WINDOW:
+            errors.append(f"#{i}: レーン{lane}の{time}秒にノーツが重複しています")
+        last_in_lane[lane] = time
+        if note_type == "hold":
+            hold_end[lane] = max(hold_end.get(lane, 0), time + note.get("duration", 0))
+    return errors
+
+def chart_stats(chart):
+    """1譜面分の統計と検証結果"""
+    notes = chart["notes"]
+    errors = validate_notes(notes)
+    valid = [note for note in notes if isinstance(note.get("time"), (int, float))]
+    times = sorted(note["time"] for note in valid)
+    count = len(valid)
+    span = times[-1] - times[0] if count > 1 else 0.0
+
+    types = Counter(note.get("type", "tap") for note in valid)
+    chords = Counter(Counter(times).values())
+    lanes = Counter(note.get("lane") for note in valid)
+    difficulty = chart.get("difficulty") or {}
+
+    return {
+        "title": chart.get("title"),
+        "artist": chart.get("artist"),
+        "bpm": chart.get("bpm"),
+        "audioFile": chart.get("audioFile"),
+        "difficulty": difficulty.get("name"),
+        "level": difficulty.get("level"),
+        "noteCount": count,
+        "firstNote": times[0] if times else None,
+        "lastNote": times[-1] if times else None,
+        "nps": {
+            "average": round(count / span, 3) if span else float(count),
+            **{f"peak{window:g}s": round(peak_notes_in_window(times, window) / window, 3)
+               for window in NPS_WINDOWS},
+        },
+        "chords": {str(size): chords[size] for size in sorted(chords)},
+        "lanes": {str(lane): lanes[lane] for lane in sorted(lanes, key=str)},
+        "holdRatio": round(types["hold"] / count, 4) if count else 0.0,
+        "scratchRatio": round(types["scratch"] / count, 4) if count else 0.0,
+        "errors": errors,
+    }
+
+def load_manifest(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest.get("charts", {})
+
+def build_manifest(charts_dir=CHARTS_DIR, output=None):
+    """マニフェストを差分更新して書き出す。戻り値は (譜面ごとの情報, 読み直した譜面数)"""
+    output = output or os.path.join(charts_dir, MANIFEST_NAME)
+    previous = load_manifest(output)
+    entries = {}
+    rescanned = 0
+
+    for path in sorted(glob.glob(os.path.join(charts_dir, "*.json"))):
+        name = os.path.basename(path)
+        if os.path.abspath(path) == os.path.abspath(output):
+            continue
+        st = os.stat(path)
+        old = previous.get(name)
+        if old and old["mtime_ns"] == st.st_mtime_ns and old["size"] == st.st_size:
+            entries[name] = old
+            continue
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = file_hash(data)
+        if old and old["sha256"] == digest:
+            # 内容が同じなら統計は再計算しない（touchされただけ）
+            entries[name] = dict(old, mtime_ns=st.st_mtime_ns, size=st.st_size)
+            continue
+
+        rescanned += 1
+        try:
+            chart = json.loads(data)
+            error = None if isinstance(chart, dict) else "譜面のオブジェクトではありません"
+        except (ValueError, UnicodeDecodeError) as e:
+            chart, error = None, f"JSONとして読み込めません: {e}"
+        stem = os.path.splitext(name)[0]
+        song_id, _, _ = stem.rpartition("_")
+        entry = {
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "sha256": digest,
+            "songId": song_id or stem,
+        }
+        if error:
+            # 壊れたファイルも譜面として記録し、検証エラーとして報告する（他の譜面の索引は続ける）
+            entry.update(kind="chart", **chart_stats({"notes": []}))
+            entry["errors"] = [error]
+        elif "notes" in chart:
+            entry.update(kind="chart", **chart_stats(chart))
+        else:
+            # 記録データ（recordedTimings）などは譜面ではないので件数だけ記録する
+            entry.update(kind="recording", timingCount=len(chart.get("recordedTimings", [])))
+        entries[name] = entry
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "generatedAt": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "charts": entries,
+    }
+    if entries != previous or not os.path.exists(output):
+        write_json_atomic(output, manifest)
+    return entries, rescanned
+
+def charts_only(entries):
+    return {name: entry for name, entry in entries.items() if entry["kind"] == "chart"}
+
+def print_summary(entries):
+    for name, entry in charts_only(entries).items():
+        nps = entry["nps"]
+        print(f"{name}: {entry['noteCount']}ノーツ / 平均{nps['average']} 最大{nps['peak1s']}ノーツ/秒 "
+              f"/ ホールド{entry['holdRatio']:.1%} スクラッチ{entry['scratchRatio']:.1%}")
+        for error in entry["errors"][:5]:
+            print(f"  エラー: {error}")
+        if len(entry["errors"]) > 5:
+            print(f"  ...他{len(entry['errors']) - 5}件")
+
+def main():
+    parser = argparse.ArgumentParser(description="譜面の統計・検証マニフェストを作成する")
+    parser.add_argument("--charts-dir", default=CHARTS_DIR)
+    parser.add_argument("--output", help="マニフェストの出力先（既定: <charts-dir>/index.json）")
+    parser.add_argument("--check", action="store_true", help="検証エラーがあれば終了コード1で終わる")
+    args = parser.parse_args()
+
+    entries, rescanned = build_manifest(args.charts_dir, args.output)
+    print_summary(entries)
+    entries = charts_only(entries)
+    invalid = [name for name, entry in entries.items() if entry["errors"]]
+    print(f"\n{len(entries)}譜面（再解析 {rescanned}） / エラーのある譜面: {len(invalid)}")
+    if args.check and invalid:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+譜面のメモリ効率のよい表現（Chart / NoteArray）
+
+ノーツを1つずつdictで持つと1ノーツあたり数百バイトかかるので、時刻・レーン・種類・長さを
+標準ライブラリの array の列として持つ（1ノーツあたり19バイト）。NumPyは使わないので、
+起動の軽さが大事なツール（chart_transform / chart_binary）からも使える。
+
+- 絞り込み・レーンの付け替え・時刻のずらし・並べ替えは列ごとにまとめて行い、ノーツごとのdictは作らない
+  （レーン・種類の条件は bytes.translate による256要素の表引き、選択は itertools.compress）
+- 操作は新しい NoteArray を返し、元の列は変更しない（変わらない列は共有する）
+- JSONとの相互変換は可逆。整数で書かれた時刻・長さは整数のまま、キーは time, lane, type, duration の順
+  （type と duration は省略可）。この形に収まらないノーツ（旧形式の timing/lanes など）を含む譜面は
+  from_notes が ValueError を送出するので、呼び出し側はdictのまま扱う
+"""
+import json
+import math
+from array import array
+from itertools import compress
+from operator import le
+
+# chart_engine / chart_binary と同じノーツ種類コード
+TYPE_NAMES = ("tap", "hold", "scratch")
+TYPE_CODES = {name: code for code, name in enumerate(TYPE_NAMES)}
+NO_TYPE = 255
+# flags のビット（JSONに整数で書かれていた値）
+TIME_INT = 1
+DURATION_INT = 2
+NOTE_KEYS = frozenset([
+    ("time", "lane"),
+    ("time", "lane", "type"),
+    ("time", "lane", "duration"),
+    ("time", "lane", "type", "duration"),
+])
+
+# typeキーの値 → 種類コード（キーがなければNone）
+_TYPE_LOOKUP = {None: NO_TYPE, **TYPE_CODES}
+_NUMBER_TYPES = frozenset([int, float])
+
+def _first(values, predicate):
+    return next(i for i, value in enumerate(values) if predicate(value))
+
+def _check_numbers(values, what):
+    """JSONの数値（boolは除く、floatに正確に変換できる整数）の列か検証する"""
+    if not set(map(type, values)) <= _NUMBER_TYPES:
+        i = _first(values, lambda value: type(value) not in _NUMBER_TYPES)
+        raise ValueError(f"#{i}: {what}が数値ではありません ({values[i]!r})")
+    if not all(float(value) == value for value in values if type(value) is int):
+        i = _first(values, lambda value: type(value) is int and float(value) != value)
+        raise ValueError(f"#{i}: {what}はfloatで表せない整数です ({values[i]!r})")
+
+def _and_masks(a, b):
+    """0/1のバイト列どうしの論理積"""
+    return (int.from_bytes(a, "little") & int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+class NoteArray:
+    """ノーツ列。times・durations は float64、lanes・types・flags は uint8 の列（durationなしはNaN）"""
+    __slots__ = ("times", "lanes", "types", "durations", "flags")
+
+    def __init__(self, times=None, lanes=None, types=None, durations=None, flags=None):
+        self.times = array("d") if times is None else times
+        self.lanes = array("B") if lanes is None else lanes
+        self.types = array("B") if types is None else types
+        self.durations = array("d") if durations is None else durations
+        self.flags = array("B") if flags is None else flags
+
+    @classmethod
+    def from_notes(cls, notes):
+        """JSONのノーツdictのリストから作る（収まらない形のノーツがあればValueError）"""
+        # ノーツごとに分岐するループの代わりに、列ごとにまとめて取り出して検証する
+        if not all(type(note) is dict for note in notes) or not set(map(tuple, notes)) <= NOTE_KEYS:
+            i = _first(notes, lambda note: type(note) is not dict or tuple(note) not in NOTE_KEYS)
+            raise ValueError(f"#{i}: time/lane形式のノーツではありません")
+
+        times = [note["time"] for note in notes]
+        _check_numbers(times, "time")
+        lanes = [note["lane"] for note in notes]
+        if not set(map(type, lanes)) <= {int} or (lanes and not 0 <= min(lanes) <= max(lanes) < 256):
+            i = _first(lanes, lambda lane: type(lane) is not int or not 0 <= lane < 256)
+            raise ValueError(f"#{i}: laneが0〜255の整数ではありません ({lanes[i]!r})")
+        codes = [_TYPE_LOOKUP.get(note.get("type")) for note in notes]
+        if None in codes:
+            i = codes.index(None)
+            raise ValueError(f"#{i}: 不明なノーツ種類です ({notes[i]['type']!r})")
+        durations = [note["duration"] for note in notes if "duration" in note]
+        _check_numbers(durations, "duration")
+        if any(duration != duration for duration in durations):
+            raise ValueError("durationにNaNがあります")
+
+        flags = array("B", [TIME_INT if type(time) is int else 0 for time in times])
+        if durations:
+            durations = [note.get("duration", math.nan) for note in notes]
+            for i, duration in enumerate(durations):
+                if type(duration) is int:
+                    flags[i] |= DURATION_INT
+        else:
+            durations = [math.nan] * len(notes)
+        return cls(array("d", times), array("B", lanes), array("B", codes), array("d", durations), flags)
+
+    def to_notes(self):
+        """JSONのノーツdictのリストに戻す（from_notesの入力と同じ値・同じキー順）"""
+        notes = []
+        for time, lane, code, duration, flag in zip(self.times, self.lanes, self.types, self.durations, self.flags):
+            note = {"time": int(time) if flag & TIME_INT else time, "lane": lane}
+            if code != NO_TYPE:
+                note["type"] = TYPE_NAMES[code]
+            if duration == duration:
+                note["duration"] = int(duration) if flag & DURATION_INT else duration
+            notes.append(note)
+        return notes
+
+    def to_json_lines(self, indent=2, level=1):
+        """json.dumps(self.to_notes(), indent=indent) の各ノーツ部分と同じ文字列を、dictを作らずに作る
+        （levelはノーツのリストの入れ子の深さ）。NaN・無限大を含むときはNone"""
+        if not all(map(math.isfinite, self.times)):
+            return None
+        outer = " " * (indent * (level + 1))
+        inner = " " * (indent * (level + 2))
+        head, sep = f"{outer}{{\n{inner}", f",\n{inner}"
+        tail = f"\n{outer}}}"
+        parts = []
+        for time, lane, code, duration, flag in zip(self.times, self.lanes, self.types, self.durations, self.flags):
+            text = f'{head}"time": {int(time) if flag & TIME_INT else time!r}{sep}"lane": {lane}'
+            if code != NO_TYPE:
+                text += f'{sep}"type": "{TYPE_NAMES[code]}"'
+            if duration == duration:
+                if math.isinf(duration):
+                    return None
+                text += f'{sep}"duration": {int(duration) if flag & DURATION_INT else duration!r}'
+            parts.append(text + tail)
+        return parts
+
+    def __len__(self):
+        return len(self.times)
+
+    def __eq__(self, other):
+        if not isinstance(other, NoteArray):
+            return NotImplemented
+        # NaN（durationなし）どうしも等しく扱うためバイト列で比べる
+        return all(getattr(self, name).tobytes() == getattr(other, name).tobytes() for name in self.__slots__)
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in (getattr(self, name) for name in self.__slots__))
+
+    def select(self, mask):
+        """mask（ノーツごとに0/1のバイト列）が1のノーツだけを残す"""
+        if b"\0" not in mask:
+            return self
+        return NoteArray(*(array(getattr(self, name).typecode, compress(getattr(self, name), mask))
+                           for name in self.__slots__))
+
+    def filter(self, min_lane=None, max_lane=None, exclude_types=()):
+        """chart_transform.NoteFilter と同じ条件で絞り込む"""
+        lane_table = bytes((min_lane is None or lane >= min_lane) and (max_lane is None or lane <= max_lane)
+                           for lane in range(256))
+        mask = self.lanes.tobytes().translate(lane_table)
+        excluded = {TYPE_CODES[name] for name in exclude_types if name in TYPE_CODES}
+        if excluded:
+            type_table = bytes(code not in excluded for code in range(256))
+            mask = _and_masks(mask, self.types.tobytes().translate(type_table))
+        return self.select(mask)
+
+    def remap_lanes(self, mapping):
+        """レーン番号を付け替える（mappingにないレーンはそのまま）"""
+        table = bytearray(range(256))
+        for src, dst in mapping.items():
+            if 0 <= src < 256:
+                if not 0 <= dst < 256:
+                    raise ValueError(f"レーン{dst}は0〜255の範囲外です")
+                table[src] = dst
+        lanes = array("B")
+        lanes.frombytes(self.lanes.tobytes().translate(table))
+        return NoteArray(self.times, lanes, self.types, self.durations, self.flags)
+
+    def shift(self, seconds, decimals=None):
+        """全ノーツの時刻をずらす（decimalsを指定すると丸める）"""
+        seconds = float(seconds)
+        if decimals is None:
+            times = array("d", map(seconds.__add__, self.times))
+        else:
+            times = array("d", (round(time + seconds, decimals) for time in self.times))
+        flags = self.flags
+        if not seconds.is_integer():
+            # ずらした後の時刻は整数とは限らないので、整数で書き出す印を消す
+            flags = array("B")
+            flags.frombytes(self.flags.tobytes().translate(bytes(flag & ~TIME_INT for flag in range(256))))
+        return NoteArray(times, self.lanes, self.types, self.durations, flags)
+
+    def with_times(self, times, durations=None):
+        """時刻（と長さ）の列を差し替える。整数の印は値が整数のものだけ残す"""
+        times = array("d", times)
+        durations = self.durations if durations is None else array("d", durations)
+        flags = array("B", [flag & ~TIME_INT if not time.is_integer() else flag
+                            for time, flag in zip(times, self.flags)])
+        if durations is not self.durations:
+            for i, duration in enumerate(durations):
+                if flags[i] & DURATION_INT and not duration.is_integer():
+                    flags[i] &= ~DURATION_INT
+        return NoteArray(times, self.lanes, self.types, durations, flags)
+
+    def is_sorted(self):
+        return all(map(le, self.times, self.times[1:]))
+
+    def sort(self):
+        """時刻で安定ソート（同時刻は元の順序を保つ）"""
+        if self.is_sorted():
+            return self
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        return NoteArray(*(array(getattr(self, name).typecode, map(getattr(self, name).__getitem__, order))
+                           for name in self.__slots__))
+
+class Chart:
+    """メタデータ（notes以外のキー）とノーツ列。to_dict でキーの順序まで元に戻る"""
+    __slots__ = ("meta", "notes", "notes_at")
+
+    def __init__(self, meta, notes, notes_at=None):
+        self.meta = meta
+        self.notes = notes
+        self.notes_at = len(meta) if notes_at is None else notes_at
+
+    @classmethod
+    def from_dict(cls, data):
+        if "notes" not in data:
+            raise ValueError("notesがありません")
+        keys = list(data)
+        meta = {key: value for key, value in data.items() if key != "notes"}
+        return cls(meta, NoteArray.from_notes(data["notes"]), keys.index("notes"))
+
+    def to_dict(self):
+        items = list(self.meta.items())
+        items.insert(self.notes_at, ("notes", self.notes.to_notes()))
+        return dict(items)
+
+    def to_json(self):
+        """json.dumps(self.to_dict(), indent=2, ensure_ascii=False) と同じ文字列（ノーツのdictは作らない）"""
+        parts = self.notes.to_json_lines()
+        if parts is None:
+            return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+        # メタデータ部分はjsonに任せ、notesの値だけ差し込む
+        placeholder = "\ue000notes\ue000"
+        items = list(self.meta.items())
+        items.insert(self.notes_at, ("notes", placeholder))
+        text = json.dumps(dict(items), indent=2, ensure_ascii=False)
+        notes = "[\n" + ",\n".join(parts) + "\n  ]" if parts else "[]"
+        return text.replace(f'"notes": "{placeholder}"', f'"notes": {notes}', 1)
+
+    def with_notes(self, notes):
+        return Chart(self.meta, notes, self.notes_at)
+
+    def with_meta(self, **fields):
+        return Chart(dict(self.meta, **fields), self.notes, self.notes_at)
+
+    def __eq__(self, other):
+        if not isinstance(other, Chart):
+            return NotImplemented
+        return self.meta == other.meta and self.notes_at == other.notes_at and self.notes == other.notes
+
+def load_chart(path):
+    """譜面JSONを読み込む（Chartに収まらない譜面はValueError）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return Chart.from_dict(json.load(f))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+譜面ファイルの一括変換エンジン
+レーンの付け替え・ノーツの絞り込み・メタデータの書き換えを組み合わせ、
+1ファイルにつき1回の読み込みと1回の書き込みでまとめて適用する。
+
+- 複数ファイルはプロセスプールで並列に処理する
+- 書き込みは一時ファイル＋renameで行うので、途中で止まっても壊れたファイルが残らない
+- 変換しても内容が変わらないファイルは書き込まない
+- ノーツはdictのリストではなく chart_model.NoteArray の列に変換してから操作する
+  （旧形式など列に収まらない譜面だけdictのまま操作する）
+
+使い方:
+    python chart_transform.py --max-lane 7 --lane-map 7:6,6:5 assets/charts/gozen4ji_*.json
+    python chart_transform.py --max-lane 5 assets/charts/gozen4ji_*.json
+    python chart_transform.py --set audioFile=assets/sounds/cryinggirl.wav assets/charts/cryinggirl_*.json
+    python chart_transform.py --shift 0.05 assets/charts/cryinggirl_*.json
+"""
+import argparse
+import glob
+import json
+import os
+import stat
+import tempfile
+
+import instrument
+from chart_model import Chart
+
+# 各変換は譜面のdictとChartのどちらも受け取り、同じ型で返す
+
+class LaneRemap:
+    """レーン番号を付け替える（mappingにないレーンはそのまま）"""
+    def __init__(self, mapping):
+        self.mapping = dict(mapping)
+
+    def __call__(self, chart):
+        if isinstance(chart, Chart):
+            return chart.with_notes(chart.notes.remap_lanes(self.mapping))
+        notes = [dict(note, lane=self.mapping[note["lane"]]) if note.get("lane") in self.mapping else note
+                 for note in chart["notes"]]
+        return dict(chart, notes=notes)
+
+class NoteFilter:
+    """条件に合うノーツだけを残す"""
+    def __init__(self, min_lane=None, max_lane=None, exclude_types=()):
+        self.min_lane = min_lane
+        self.max_lane = max_lane
+        self.exclude_types = frozenset(exclude_types)
+
+    def in_range(self, lane):
+        return ((self.min_lane is None or lane >= self.min_lane) and
+                (self.max_lane is None or lane <= self.max_lane))
+
+    def keep(self, note):
+        # laneが整数でないノーツ（壊れたノーツ）はレーンでは除かない
+        lane = note.get("lane")
+        if isinstance(lane, int) and not self.in_range(lane):
+            return False
+        return note.get("type") not in self.exclude_types
+
+    def filter_legacy(self, note):
+        """旧形式（timing/lanes）のノーツは範囲外のレーンだけを除く（レーンが残らなければNone）"""
+        lanes = note["lanes"]
+        kept = [lane for lane in lanes if not isinstance(lane, int) or self.in_range(lane)]
+        if not kept:
+            return None
+        return note if len(kept) == len(lanes) else dict(note, lanes=kept)
+
+    def __call__(self, chart):
+        if isinstance(chart, Chart):
+            return chart.with_notes(chart.notes.filter(self.min_lane, self.max_lane, self.exclude_types))
+        notes = []
+        for note in chart["notes"]:
+            if "lane" not in note and isinstance(note.get("lanes"), list):
+                note = self.filter_legacy(note)
+            if note is not None and self.keep(note):
+                notes.append(note)
+        return dict(chart, notes=notes)
+
+class TimeShift:
+    """全ノーツの時刻をずらす（浮動小数点の誤差が出ないようdecimals桁に丸める）"""
+    def __init__(self, seconds, decimals=6):
+        self.seconds = seconds
+        self.decimals = decimals
+
+    def __call__(self, chart):
+        if isinstance(chart, Chart):
+            return chart.with_notes(chart.notes.shift(self.seconds, self.decimals))
+        notes = []
+        for note in chart["notes"]:
+            # 旧形式の譜面は time の代わりに timing を持つ
+            key = "time" if "time" in note else "timing"
+            notes.append(dict(note, **{key: round(note[key] + self.seconds, self.decimals)}) if key in note else note)
+        return dict(chart, notes=notes)
+
+class SortNotes:
+    """ノーツを時刻順に並べ替える（同時刻は元の順序を保つ）"""
+    def __call__(self, chart):
+        if isinstance(chart, Chart):
+            return chart.with_notes(chart.notes.sort())
+        return dict(chart, notes=sorted(chart["notes"], key=lambda note: note.get("time", note.get("timing", 0))))
+
+class MetadataPatch:
+    """notes以外のキーを書き換える"""
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __call__(self, chart):
+        if isinstance(chart, Chart):
+            return chart.with_meta(**self.fields)
+        return dict(chart, **self.fields)
+
+def apply_operations(chart, operations):
+    """変換を順に適用する（元のdictは変更しない）"""
+    for operation in operations:
+        if isinstance(chart, dict) and "notes" not in chart and not isinstance(operation, MetadataPatch):
+            continue
+        chart = operation(chart)
+    return chart
+
+def write_json_atomic(path, data):
+    """一時ファイルに書いてからrenameで置き換える（パーミッションは元のファイルを引き継ぐ）。
+    dataがChartならノーツのdictを作らずに同じ内容を書き出す"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            if isinstance(data, Chart):
+                f.write(data.to_json())
+            else:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            # 新規作成なら通常のopenと同じくumaskに従う
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def transform_file(path, operations, dry_run=False):
+    """1ファイルを読み込み、全ての変換を適用し、変わっていれば書き戻す"""
+    with instrument.span("transform.load", file=path):
+        with open(path, 'r', encoding='utf-8') as f:
+            chart = json.load(f)
+    with instrument.span("transform.apply", file=path):
+        try:
+            # ノーツのdictはここで手放し、以降は列で扱う
+            chart = Chart.from_dict(chart)
+        except ValueError:
+            pass
+        result = apply_operations(chart, operations)
+        changed = result != chart
+    if changed and not dry_run:
+        with instrument.span("transform.write", file=path):
+            write_json_atomic(path, result)
+    return {
+        "path": path,
+        "changed": changed,
+        "notes_before": note_count(chart),
+        "notes_after": note_count(result),
+    }
+
+def note_count(chart):
+    return len(chart.notes) if isinstance(chart, Chart) else len(chart.get("notes", []))
+
+def _transform_file_args(args):
+    return transform_file(*args)
+
+def transform_charts(paths, operations, workers=None, dry_run=False):
+    """複数ファイルに変換を並列で適用し、ファイルごとの結果を返す"""
+    paths = list(paths)
+    workers = min(workers or os.cpu_count() or 1, len(paths) or 1)
+    jobs = [(path, operations, dry_run) for path in paths]
+    if workers == 1:
+        return [transform_file(*job) for job in jobs]
+    # プロセスプールの読み込み（約20ms）は並列で処理するときだけ
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_transform_file_args, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+def report(results):
+    for result in results:
+        if result["changed"]:
+            print(f"更新: {result['path']} ({result['notes_before']} -> {result['notes_after']}ノーツ)")
+        else:
+            print(f"変更なし: {result['path']}")
+    changed = sum(1 for result in results if result["changed"])
+    print(f"{len(results)}ファイル中 {changed}ファイルを更新しました")
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def main():
+    parser = argparse.ArgumentParser(description="譜面ファイルに変換をまとめて適用する")
+    parser.add_argument("paths", nargs="+", help="譜面ファイル（globパターン可）")
+    parser.add_argument("--min-lane", type=int, help="これより小さいレーンのノーツを削除")
+    parser.add_argument("--max-lane", type=int, help="これより大きいレーンのノーツを削除")
+    parser.add_argument("--drop-type", action="append", default=[], help="指定した種類のノーツを削除")
+    parser.add_argument("--lane-map", help="レーンの付け替え（例: 7:6,6:5）")
+    parser.add_argument("--shift", type=float, help="全ノーツの時刻をずらす秒数")
+    parser.add_argument("--sort", action="store_true", help="ノーツを時刻順に並べ替える")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="メタデータを書き換える（値はJSONとして解釈、できなければ文字列）")
+    parser.add_argument("--workers", type=int, help="並列プロセス数")
+    parser.add_argument("--dry-run", action="store_true", help="書き込まずに結果だけ表示")
+    args = parser.parse_args()
+
+    # 絞り込み → 付け替え → 時刻のずらし → 並べ替え → メタデータの順に適用する
+    operations = []
+    if args.min_lane is not None or args.max_lane is not None or args.drop_type:
+        operations.append(NoteFilter(args.min_lane, args.max_lane, args.drop_type))
+    if args.lane_map:
+        pairs = (item.split(":") for item in args.lane_map.split(","))
+        operations.append(LaneRemap({int(src): int(dst) for src, dst in pairs}))
+    if args.shift:
+        operations.append(TimeShift(args.shift))
+    if args.sort:
+        operations.append(SortNotes())
+    if args.set:
+        fields = dict(item.split("=", 1) for item in args.set)
+        operations.append(MetadataPatch(**{key: parse_value(value) for key, value in fields.items()}))
+
+    paths = sorted({path for pattern in args.paths for path in (glob.glob(pattern) or [pattern])})
+    report(transform_charts(paths, operations, args.workers, args.dry_run))
+
+if __name__ == "__main__":
+    main()
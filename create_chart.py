@@ -2,197 +2,246 @@
 """
 手動で「午前四時の宮殿」の譜面を作成するスクリプト
 楽曲の構造とリズムに基づいて作成
+
+--audio で音楽ファイルを渡すと、BPM・オフセット・構造（区間の境界と密度）を分析結果（structure.py）から求める。
+渡さなければ下の推定値の表を使う。
 """
+import argparse
 import json
-import random
 
-def create_gozen4ji_chart():
-    """午前四時の宮殿の譜面データを作成"""
-    
-    # 楽曲情報（推定値）
-    bpm = 134  # 一般的なJ-POPのBPM
-    offset = 1.0  # イントロ開始までの時間
-    
-    # 楽曲構造（4分間の楽曲と仮定）
-    structure = [
-        {"name": "intro", "start": 0, "end": 16, "density": 0.3},
-        {"name": "verse1", "start": 16, "end": 48, "density": 0.5},
-        {"name": "chorus1", "start": 48, "end": 80, "density": 0.8},
-        {"name": "verse2", "start": 80, "end": 112, "density": 0.6},
-        {"name": "chorus2", "start": 112, "end": 144, "density": 0.9},
-        {"name": "bridge", "start": 144, "end": 176, "density": 0.4},
-        {"name": "final_chorus", "start": 176, "end": 220, "density": 1.0},
-        {"name": "outro", "start": 220, "end": 248, "density": 0.3}
-    ]
-    
-    notes = []
+import numpy as np
+
+import analysis_cache
+import chart_engine
+from paths import root_path
+
+# 楽曲情報（推定値）
+BPM = 134  # 一般的なJ-POPのBPM
+OFFSET = 1.0  # イントロ開始までの時間
+
+# 楽曲構造（4分間の楽曲と仮定。--audio を渡さないときに使う）
+STRUCTURE = [
+    {"name": "intro", "start": 0, "end": 16, "density": 0.3},
+    {"name": "verse1", "start": 16, "end": 48, "density": 0.5},
+    {"name": "chorus1", "start": 48, "end": 80, "density": 0.8},
+    {"name": "verse2", "start": 80, "end": 112, "density": 0.6},
+    {"name": "chorus2", "start": 112, "end": 144, "density": 0.9},
+    {"name": "bridge", "start": 144, "end": 176, "density": 0.4},
+    {"name": "final_chorus", "start": 176, "end": 220, "density": 1.0},
+    {"name": "outro", "start": 220, "end": 248, "density": 0.3}
+]
+# エンディングの特別パターンは最後の区間の終わりのこの秒数前から
+ENDING_LEAD_SECONDS = 8.0
+
+# 難易度ごとの目標（ノーツ数は REFERENCE_SECONDS の長さの曲のもの、peak_nps は1秒あたりの最大ノーツ数）
+REFERENCE_SECONDS = 248
+DIFFICULTIES = {
+    "BEGINNER": {"level": 3, "notes": 435, "peak_nps": 5, "no_holds": True, "chords": False},
+    "NORMAL": {"level": 5, "notes": 907, "peak_nps": 8, "no_holds": False, "chords": False},
+    "HYPER": {"level": 8, "notes": 1209, "peak_nps": 11, "no_holds": False, "chords": False},
+    "ANOTHER": {"level": 11, "notes": 1755, "peak_nps": 16, "no_holds": False, "chords": True},
+}
+
+def generate_gozen4ji_notes(rng, bpm=BPM, structure=STRUCTURE):
+    """楽曲構造に沿ったノーツ列（時刻順）を作る"""
     beat_interval = 60.0 / bpm  # 1拍の長さ（秒）
-    
-    # パターンライブラリ
-    patterns = {
-        "basic_4beat": [0, 0, 0, 0],  # 4つ打ち
-        "syncopated": [0, 0, 1, 0, 2, 0, 1, 0],  # シンコペーション
-        "fill": [0, 1, 2, 3, 4, 5, 6],  # フィル
-        "scratch_pattern": [7, 7],  # スクラッチパターン
-        "chord": [(0, 2, 4), (1, 3, 5)],  # コード
-    }
+    parts = []
     
     for section in structure:
         section_start = section["start"]
         section_end = section["end"]
-        density = section["density"]
         
-        # セクション内の拍数
+        # セクション内の16分刻みの時刻
         beats_in_section = int((section_end - section_start) / beat_interval * 4)
+        beat = np.arange(beats_in_section)
+        times = section_start + (beat * beat_interval / 4)
+        in_section = times < section_end
+        beat, times = beat[in_section], times[in_section]
+        
+        # 密度に基づいてノーツ配置判定
+        placed = chart_engine.chance(rng, len(times), section["density"])
+        
+        # セクションに応じたパターン選択
+        if section["name"] in ["intro", "outro"]:
+            # 簡単なパターン：1拍目だけ
+            t = times[placed & (beat % 4 == 0)]
+            parts.append(chart_engine.columns(t, chart_engine.random_lanes(rng, len(t), [0, 2, 4, 6])))
         
-        for beat in range(beats_in_section):
-            time = section_start + (beat * beat_interval / 4)
+        elif section["name"].startswith("verse"):
+            # 中程度のパターン：2拍ごと、10%でホールド
+            t = times[placed & (beat % 2 == 0)]
+            notes = chart_engine.columns(t, chart_engine.random_lanes(rng, len(t), range(7)))
+            hold = chart_engine.chance(rng, len(t), 0.1)
+            notes["type"][hold] = chart_engine.HOLD
+            notes["duration"][hold] = beat_interval
+            parts.append(notes)
+        
+        elif "chorus" in section["name"]:
+            # 複雑なパターン：全拍にメイン音、同時押しとスクラッチを重ねる
+            t = times[placed]
+            main_lanes = np.array([0, 2, 4, 6])
+            main = rng.integers(0, len(main_lanes), size=len(t))
+            parts.append(chart_engine.columns(t, main_lanes[main]))
+            
+            # 同時押し（メイン音以外のレーンから選ぶ）
+            chord = chart_engine.chance(rng, len(t), 0.3)
+            second = (main + rng.integers(1, len(main_lanes), size=len(t))) % len(main_lanes)
+            parts.append(chart_engine.columns(t[chord], main_lanes[second[chord]]))
             
-            if time >= section_end:
-                break
-                
-            # 密度に基づいてノーツ配置判定
-            if random.random() < density:
-                # セクションに応じたパターン選択
-                if section["name"] in ["intro", "outro"]:
-                    # 簡単なパターン
-                    if beat % 4 == 0:  # 1拍目
-                        lane = random.choice([0, 2, 4, 6])
-                        notes.append({"time": round(time, 3), "lane": lane, "type": "tap"})
-                        
-                elif section["name"] in ["verse1", "verse2"]:
-                    # 中程度のパターン
-                    if beat % 2 == 0:  # 2拍ごと
-                        lane = random.choice(range(7))
-                        note_type = "tap"
-                        if random.random() < 0.1:  # 10%でホールド
-                            note_type = "hold"
-                        notes.append({
-                            "time": round(time, 3), 
-                            "lane": lane, 
-                            "type": note_type,
-                            **({"duration": beat_interval} if note_type == "hold" else {})
-                        })
-                        
-                elif "chorus" in section["name"]:
-                    # 複雑なパターン
-                    if beat % 1 == 0:  # 全拍
-                        # メイン音
-                        main_lanes = [0, 2, 4, 6]
-                        lane = random.choice(main_lanes)
-                        notes.append({"time": round(time, 3), "lane": lane, "type": "tap"})
-                        
-                        # 同時押し
-                        if random.random() < 0.3:
-                            second_lane = random.choice([l for l in main_lanes if l != lane])
-                            notes.append({"time": round(time, 3), "lane": second_lane, "type": "tap"})
-                        
-                        # スクラッチ
-                        if random.random() < 0.15:
-                            notes.append({"time": round(time, 3), "lane": 7, "type": "scratch"})
-                            
-                elif section["name"] == "bridge":
-                    # ブリッジセクション
-                    if beat % 8 == 0:  # 2小節ごと
-                        # ホールドノーツ中心
-                        lane = random.choice(range(6))
-                        notes.append({
-                            "time": round(time, 3), 
-                            "lane": lane, 
-                            "type": "hold",
-                            "duration": beat_interval * 4
-                        })
+            # スクラッチ
+            scratch = chart_engine.chance(rng, len(t), 0.15)
+            parts.append(chart_engine.columns(t[scratch], 7, chart_engine.SCRATCH))
+        
+        elif section["name"] == "bridge":
+            # ブリッジセクション：2小節ごとのホールドノーツ中心
+            t = times[placed & (beat % 8 == 0)]
+            parts.append(chart_engine.columns(t, chart_engine.random_lanes(rng, len(t), range(6)),
+                                              chart_engine.HOLD, beat_interval * 4))
     
     # 特別なパターンを追加
-    add_special_patterns(notes, structure, beat_interval)
-    
-    # 時間でソート
-    notes.sort(key=lambda x: x["time"])
+    parts.append(add_special_patterns(structure, beat_interval))
     
+    # 時間でソート（短い曲ではエンディングのパターンも0秒より前に出うるので、負の時刻のノーツは除く）
+    notes = chart_engine.concat(*parts)
+    notes = chart_engine.take(notes, notes["time"] >= 0)
+    return chart_engine.sort_by_time(notes)
+
+def song_from_analysis(analysis):
+    """分析結果（analyze.analyze_audio_cached）から BPM・オフセット・構造を求める"""
+    import structure
+    beat_times = analysis["beat_times"]
+    return {
+        "bpm": analysis["bpm"],
+        "offset": round(beat_times[0], 3) if beat_times else OFFSET,
+        "structure": structure.sections_from_analysis(analysis),
+    }
+
+DEFAULT_SONG = {"bpm": BPM, "offset": OFFSET, "structure": STRUCTURE}
+
+def create_gozen4ji_chart(seed=None, song=DEFAULT_SONG):
+    """午前四時の宮殿の譜面データを作成（同じseedなら同じ譜面になる）"""
+    notes = generate_gozen4ji_notes(chart_engine.make_rng(seed), song["bpm"], song["structure"])
+    return chart_document(chart_engine.to_notes(notes), "NORMAL", 7, song)
+
+def chart_document(notes, difficulty, level, song=DEFAULT_SONG):
+    """譜面JSONの形にまとめる"""
     return {
         "title": "午前四時の宮殿",
         "artist": "Unknown",
-        "bpm": bpm,
-        "offset": offset,
+        "bpm": round(song["bpm"]),
+        "offset": song["offset"],
         "audioFile": "assets/sounds/gozen4ji.mp3",
         "difficulty": {
-            "name": "NORMAL",
-            "level": 7
+            "name": difficulty,
+            "level": level
         },
         "notes": notes
     }
 
-def add_special_patterns(notes, structure, beat_interval):
-    """特別なパターンを追加"""
+def add_special_patterns(structure, beat_interval):
+    """特別なパターンのノーツ列を作る"""
     
-    # サビ前のビルドアップ
-    for section in structure:
-        if "chorus" in section["name"]:
-            buildup_time = section["start"] - beat_interval * 4
-            # スクラッチラッシュ
-            for i in range(8):
-                time = buildup_time + (i * beat_interval / 4)
-                if i % 2 == 0:
-                    notes.append({"time": round(time, 3), "lane": 7, "type": "scratch"})
+    # サビ前のビルドアップ：スクラッチラッシュ（8分刻みで4回）。曲の頭から始まるサビには付けない
+    buildups = np.array([section["start"] - beat_interval * 4
+                         for section in structure if "chorus" in section["name"]], dtype=np.float64)
+    buildups = buildups[buildups >= 0]
+    steps = np.arange(0, 8, 2) * beat_interval / 4
+    scratch_times = (buildups[:, None] + steps[None, :]).ravel()
+    scratches = chart_engine.columns(scratch_times, 7, chart_engine.SCRATCH)
     
     # エンディング部分の特別パターン
-    ending_start = 240
-    for i in range(16):
-        time = ending_start + (i * beat_interval / 8)
-        lane = i % 7
-        notes.append({"time": round(time, 3), "lane": lane, "type": "tap"})
-
-def create_multiple_difficulties():
-    """複数の難易度を作成"""
-    base_chart = create_gozen4ji_chart()
+    ending_start = structure[-1]["end"] - ENDING_LEAD_SECONDS
+    i = np.arange(16)
+    ending = chart_engine.columns(ending_start + (i * beat_interval / 8), i % 7)
     
-    difficulties = {
-        "BEGINNER": {"level": 3, "note_reduction": 0.3, "no_holds": True},
-        "NORMAL": {"level": 5, "note_reduction": 0.6, "no_holds": False},
-        "HYPER": {"level": 8, "note_reduction": 0.8, "no_holds": False},
-        "ANOTHER": {"level": 11, "note_reduction": 1.0, "no_holds": False}
-    }
+    return chart_engine.concat(scratches, ending)
+
+def note_priority(rng, notes, structure, beat_interval):
+    """難易度を作るときに残す優先度（拍の頭ほど高い。同じ強さの中の順序は乱数で決める）
+
+    区間の開始からの16分の位置で、小節の頭・拍の頭・8分の頭のそれぞれに1点、ホールドとスクラッチに1点
+    """
+    starts = np.array([section["start"] for section in structure], dtype=np.float64)
+    section = np.clip(np.searchsorted(starts, notes["time"], side="right") - 1, 0, len(starts) - 1)
+    step = (notes["time"] - starts[section]) / (beat_interval / 4)
+    position = np.rint(step).astype(np.int64)
+    on_grid = np.abs(step - position) < 1e-6
+    strength = on_grid * ((position % 16 == 0).astype(np.int64) + (position % 4 == 0) + (position % 2 == 0))
+    strength += notes["type"] != chart_engine.TAP
+    return strength + rng.random(len(notes["time"]))
+
+def chord_candidates(rng, notes, priority):
+    """ANOTHER用に同時押しの候補（元のノーツ＋2〜3レーン隣のノーツ、優先度は元より1低い）を加え、時刻順に並べる"""
+    source = np.flatnonzero(notes["lane"] < 6)
+    lanes = (notes["lane"][source] + rng.choice([2, 3], size=len(source))) % 7
+    # 同じ時刻・同じレーンにすでにあるノーツは加えない
+    existing = set(zip(np.round(notes["time"], 3).tolist(), notes["lane"].tolist()))
+    new = np.array([(time, lane) not in existing
+                    for time, lane in zip(np.round(notes["time"][source], 3).tolist(), lanes.tolist())], dtype=bool)
+    extra = chart_engine.columns(notes["time"][source][new], lanes[new])
+    combined = chart_engine.concat(notes, extra)
+    weights = np.concatenate([priority, priority[source][new] - 1])
+    order = np.argsort(combined["time"], kind="stable")
+    return chart_engine.take(combined, order), weights[order]
+
+def generate_difficulties(seed=None, song=DEFAULT_SONG):
+    """全難易度の譜面を作る（戻り値は 難易度名 -> 譜面dict）
+
+    元のノーツ列から、難易度ごとの目標（ノーツ数・1秒あたりの最大ノーツ数）まで優先度の低いノーツを除く。
+    ノーツ数の目標は REFERENCE_SECONDS の長さの曲のもので、曲の長さに比例させる
+    """
+    rng = chart_engine.make_rng(seed)
+    base_notes = generate_gozen4ji_notes(rng, song["bpm"], song["structure"])
+    base_priority = note_priority(rng, base_notes, song["structure"], 60.0 / song["bpm"])
+    scale = song["structure"][-1]["end"] / REFERENCE_SECONDS
     
-    for diff_name, config in difficulties.items():
-        chart = base_chart.copy()
-        chart["difficulty"] = {"name": diff_name, "level": config["level"]}
-        
-        # ノーツ数調整
-        note_count = int(len(chart["notes"]) * config["note_reduction"])
-        selected_notes = random.sample(chart["notes"], note_count)
+    charts = {}
+    for diff_name, config in DIFFICULTIES.items():
+        # take は配列をコピーするので、ここでの変更は他の難易度に影響しない
+        notes, priority = chart_engine.take(base_notes, slice(None)), base_priority
         
         # BEGINNER向けの調整
         if config["no_holds"]:
-            selected_notes = [note for note in selected_notes if note["type"] != "hold"]
-            for note in selected_notes:
-                if note["type"] == "scratch":
-                    note["type"] = "tap"
-                    note["lane"] = random.choice(range(7))
+            tap = notes["type"] != chart_engine.HOLD
+            notes, priority = chart_engine.take(notes, tap), priority[tap]
+            scratch = notes["type"] == chart_engine.SCRATCH
+            notes["type"][scratch] = chart_engine.TAP
+            notes["lane"][scratch] = rng.integers(0, 7, size=int(scratch.sum()))
         
-        # ANOTHERの場合、追加のノーツを配置
-        if diff_name == "ANOTHER":
-            additional_notes = []
-            for note in selected_notes[:]:
-                # 同時押しを増やす
-                if random.random() < 0.2 and note["lane"] < 6:
-                    additional_lane = (note["lane"] + random.choice([2, 3])) % 7
-                    additional_notes.append({
-                        "time": note["time"],
-                        "lane": additional_lane,
-                        "type": "tap"
-                    })
-            selected_notes.extend(additional_notes)
-        
-        selected_notes.sort(key=lambda x: x["time"])
-        chart["notes"] = selected_notes
+        # ANOTHERは同時押しの候補を加えてから選ぶ
+        if config["chords"]:
+            notes, priority = chord_candidates(rng, notes, priority)
         
+        keep = chart_engine.thin_to_targets(notes["time"], priority, round(config["notes"] * scale),
+                                            config["peak_nps"])
+        notes = chart_engine.to_notes(chart_engine.take(notes, keep))
+        charts[diff_name] = chart_document(notes, diff_name, config["level"], song)
+    return charts
+
+def create_multiple_difficulties(seed=None, song=DEFAULT_SONG):
+    """複数の難易度を作成"""
+    for diff_name, chart in generate_difficulties(seed, song).items():
         # ファイル出力
-        filename = f"assets/charts/gozen4ji_{diff_name.lower()}.json"
+        filename = root_path("assets", "charts", f"gozen4ji_{diff_name.lower()}.json")
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump(chart, f, indent=2, ensure_ascii=False)
         
-        print(f"譜面作成完了: {filename} (ノーツ数: {len(selected_notes)})")
+        print(f"譜面作成完了: {filename} (ノーツ数: {len(chart['notes'])})")
+
+def main():
+    parser = argparse.ArgumentParser(description="午前四時の宮殿の全難易度の譜面を作成する")
+    parser.add_argument("--seed", type=int, default=None, help="乱数シード（同じ値なら同じ譜面）")
+    parser.add_argument("--audio", help="音楽ファイル（BPM・構造を分析結果から求める）")
+    parser.add_argument("--cache-dir", default=analysis_cache.CACHE_DIR, help="分析結果のキャッシュ先")
+    args = parser.parse_args()
+    song = DEFAULT_SONG
+    if args.audio:
+        import analyze
+        song = song_from_analysis(analyze.analyze_audio_cached(args.audio, args.cache_dir, verbose=False))
+        for section in song["structure"]:
+            print(f"{section['start']:7.2f}〜{section['end']:7.2f}秒 {section['name']} (密度 {section['density']})")
+    create_multiple_difficulties(args.seed, song)
+    print("全ての譜面が作成されました！")
 
 if __name__ == "__main__":
-    create_multiple_difficulties()
-    print("全ての譜面が作成されました！")
\ No newline at end of file
+    main()
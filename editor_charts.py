@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+譜面エディタ（js/chart-editor.js）の譜面生成のPython版
+
+記録データ（recordedTimings）から、難易度ごとの密度でタイミングを等間隔に間引き、
+同時押しの頻度に応じて重複しないレーンを割り当てる。生成規則はエディタと同じで、
+乱数は chart_engine の Generator から引くので同じシードなら同じ譜面になる。
+
+使い方:
+    python editor_charts.py assets/charts/cryinggirl_raw_recording.json --song-id cryinggirl
+"""
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+
+import chart_engine
+from chart_transform import write_json_atomic
+from paths import root_path
+
+DIFFICULTIES = ("beginner", "normal", "hyper", "another")
+LANES = (0, 1, 2, 3, 4, 5)
+
+# chart-editor.html の初期値（密度%・同時押しの選択肢）
+DEFAULT_SETTINGS = {
+    "beginner": {"density": 30, "chordLevel": 0},
+    "normal": {"density": 60, "chordLevel": 0},
+    "hyper": {"density": 85, "chordLevel": 1},
+    "another": {"density": 100, "chordLevel": 2},
+}
+LEVELS = {"beginner": 3, "normal": 5, "hyper": 8, "another": 11}
+
+# 同時押しの選択肢ごとの (同時押し数, 確率)（chart-editor.js の getChordSize と同じ）
+CHORD_LEVELS = {
+    0: ((1,), (1.0,)),                    # なし
+    1: ((1, 2), (0.9, 0.1)),              # 稀に2個
+    2: ((1, 2), (0.8, 0.2)),              # 時々2個
+    3: ((1, 2, 3), (0.7, 0.2, 0.1)),      # 時々3個
+    4: ((1, 2, 3), (0.5, 0.3, 0.2)),      # 頻繁に3個
+}
+
+def validate_recording(raw):
+    """記録データとして使えなければValueErrorを送出する"""
+    if not isinstance(raw, dict):
+        raise ValueError("記録データはJSONオブジェクトで送ってください")
+    timings = raw.get("recordedTimings")
+    if not isinstance(timings, list) or not timings:
+        raise ValueError("recordedTimingsがありません")
+    if not all(isinstance(t, (int, float)) and not isinstance(t, bool) and math.isfinite(t) and t >= 0
+               for t in timings):
+        raise ValueError("recordedTimingsは0以上の秒数の配列で指定してください")
+    if not isinstance(raw.get("audioFile"), str) or not raw["audioFile"].strip():
+        raise ValueError("audioFileがありません")
+
+def resolve_settings(settings=None):
+    """難易度ごとの設定を初期値で補い、範囲を検証する"""
+    resolved = {}
+    for difficulty in DIFFICULTIES:
+        config = dict(DEFAULT_SETTINGS[difficulty])
+        config.update((settings or {}).get(difficulty) or {})
+        density, chord_level = config["density"], config["chordLevel"]
+        if not isinstance(density, (int, float)) or not 0 < density <= 100:
+            raise ValueError(f"{difficulty}のdensityは1〜100で指定してください")
+        if chord_level not in CHORD_LEVELS:
+            raise ValueError(f"{difficulty}のchordLevelは0〜{max(CHORD_LEVELS)}で指定してください")
+        resolved[difficulty] = {"density": density, "chordLevel": chord_level}
+    return resolved
+
+def select_timings(timings, count):
+    """count個を等間隔に選ぶ（selectTimingsと同じ添字。countが0以下なら空）"""
+    if count <= 0:
+        return timings[:0]
+    if count >= len(timings):
+        return timings
+    return timings[np.floor(np.arange(count) * (len(timings) / count)).astype(np.int64)]
+
+def generate_difficulty_chart(raw, difficulty, config, rng):
+    timings = np.asarray(raw["recordedTimings"], dtype=np.float64)
+    selected = select_timings(timings, int(len(timings) * (config["density"] / 100)))
+    sizes, probabilities = CHORD_LEVELS[config["chordLevel"]]
+    rows, lanes = chart_engine.chord_lanes(rng, chart_engine.chord_sizes(rng, len(selected), sizes, probabilities),
+                                           LANES)
+    cols = chart_engine.sort_by_time(chart_engine.columns(selected[rows], lanes))
+    return {
+        "title": raw.get("title") or "Untitled",
+        "artist": raw.get("artist") or "Unknown",
+        "bpm": raw.get("bpm", 120),
+        "offset": raw.get("offset", 0),
+        "audioFile": f"assets/sounds/{os.path.basename(raw['audioFile'])}",
+        "difficulty": {"name": difficulty.upper(), "level": LEVELS[difficulty]},
+        "notes": chart_engine.to_notes(cols),
+    }
+
+def generate_charts(raw, settings=None, seed=None):
+    """記録データから全難易度の譜面を作る。戻り値は {難易度: 譜面}"""
+    validate_recording(raw)
+    settings = resolve_settings(settings)
+    rng = chart_engine.make_rng(seed)
+    return {difficulty: generate_difficulty_chart(raw, difficulty, settings[difficulty], rng)
+            for difficulty in DIFFICULTIES}
+
+def main():
+    parser = argparse.ArgumentParser(description="記録データから譜面エディタと同じ規則で全難易度の譜面を作る")
+    parser.add_argument("recording", help="*_raw_recording.json")
+    parser.add_argument("--song-id", required=True, help="出力ファイル名に使う曲ID")
+    parser.add_argument("--output-dir", default=root_path("assets", "charts"))
+    parser.add_argument("--seed", type=int, default=42, help="乱数シード（同じシードなら同じ譜面）")
+    args = parser.parse_args()
+
+    with open(args.recording, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+    for difficulty, chart in generate_charts(raw, raw.get("settings"), args.seed).items():
+        path = os.path.join(args.output_dir, f"{args.song_id}_{difficulty}.json")
+        write_json_atomic(path, chart)
+        print(f"{path}: {len(chart['notes'])}ノーツ")
+
+if __name__ == "__main__":
+    main()
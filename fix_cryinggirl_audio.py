@@ -1,24 +1,23 @@
 #!/usr/bin/env python3
-import json
+import argparse
 import glob
 
+from chart_transform import MetadataPatch, transform_charts
+from paths import root_path
+
 def fix_audio_path():
-    chart_files = glob.glob("assets/charts/クライングガール_*.json")
+    chart_files = glob.glob(root_path("assets", "charts", "クライングガール_*.json"))
+    
+    # 音楽ファイルパスを修正
+    results = transform_charts(chart_files, [MetadataPatch(audioFile="assets/sounds/cryinggirl.wav")])
     
-    for chart_file in chart_files:
-        print(f"修正中: {chart_file}")
-        
-        with open(chart_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        # 音楽ファイルパスを修正
-        data["audioFile"] = "assets/sounds/cryinggirl.wav"
-        
-        with open(chart_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        
-        print(f"完了: {chart_file}")
+    for result in results:
+        print(f"{'完了' if result['changed'] else '修正不要'}: {result['path']}")
 
-if __name__ == "__main__":
+def main():
+    argparse.ArgumentParser(description="クライングガールの譜面の音楽ファイルパスを修正する").parse_args()
     fix_audio_path()
-    print("全てのクライングガール譜面の音楽ファイルパスを修正しました！")
\ No newline at end of file
+    print("全てのクライングガール譜面の音楽ファイルパスを修正しました！")
+
+if __name__ == "__main__":
+    main()
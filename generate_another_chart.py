@@ -4,59 +4,67 @@ Generate ANOTHER difficulty chart for cryinggirl
 - Uses all 431 recorded timings (100% density)
 - Generates appropriate chord patterns (70% single, 20% double, 10% triple)
 - Random lane assignments with no duplicates per timing
+- Optionally snaps the recorded timings to a beat grid first (see quantize.py)
 """
 
+import argparse
 import json
-import random
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence
+
+import numpy as np
+
+import chart_engine
+from paths import root_path
+
+# Chord sizes and their probabilities (70% single, 20% double, 10% triple)
+CHORD_SIZES = (1, 2, 3)
+CHORD_PROBABILITIES = (0.7, 0.2, 0.1)
+DEFAULT_LANES = (0, 1, 2, 3, 4, 5)
+# Default paths are resolved against the project root, not the working directory
+DEFAULT_INPUT = root_path("assets", "charts", "cryinggirl_raw_recording.json")
+DEFAULT_OUTPUT = root_path("assets", "charts", "cryinggirl_another.json")
 
 def load_raw_recording(file_path: str) -> Dict[str, Any]:
     """Load the raw recording data."""
     with open(file_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def generate_chord(lanes: List[int] = [0, 1, 2, 3, 4, 5]) -> List[int]:
-    """Generate a chord with appropriate distribution."""
-    # 70% single notes, 20% double notes, 10% triple notes
-    rand = random.random()
-    
-    if rand < 0.7:
-        # Single note
-        return [random.choice(lanes)]
-    elif rand < 0.9:
-        # Double note
-        selected_lanes = random.sample(lanes, 2)
-        return sorted(selected_lanes)
-    else:
-        # Triple note
-        selected_lanes = random.sample(lanes, 3)
-        return sorted(selected_lanes)
+def generate_chord(lanes: Sequence[int] = DEFAULT_LANES, rng: Optional[np.random.Generator] = None) -> List[int]:
+    """Generate a single chord with the appropriate size distribution."""
+    rng = chart_engine.make_rng(rng)
+    sizes = chart_engine.chord_sizes(rng, 1, CHORD_SIZES, CHORD_PROBABILITIES)
+    _, chosen = chart_engine.chord_lanes(rng, sizes, lanes)
+    return chosen.tolist()
 
-def generate_another_chart(raw_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Generate ANOTHER difficulty chart from raw recording data."""
+def generate_another_chart(raw_data: Dict[str, Any], seed: Any = None,
+                           divisor: Optional[int] = None) -> Dict[str, Any]:
+    """Generate ANOTHER difficulty chart from raw recording data.
+
+    All chord sizes and lanes are drawn as whole arrays from one generator,
+    so the same seed always produces the same chart. With a divisor, the
+    timings are quantized to that beat subdivision and the fitted BPM is used.
+    """
+    rng = chart_engine.make_rng(seed)
+    tempo = {"bpm": 120}
+    if divisor:
+        import quantize
+        raw_data, result = quantize.quantize_recording(raw_data, divisor=divisor)
+        tempo = quantize.tempo_metadata(result["segments"])
     
     # Extract timings
-    timings = raw_data["recordedTimings"]
+    timings = np.asarray(raw_data["recordedTimings"], dtype=np.float64)
     
-    # Generate notes for all timings
-    notes = []
-    for timing in timings:
-        # Generate chord for this timing
-        lanes = generate_chord()
-        
-        # Create note objects for each lane
-        for lane in lanes:
-            note = {
-                "time": timing,
-                "lane": lane
-            }
-            notes.append(note)
+    # Generate a chord for every timing, lanes sorted within each chord
+    sizes = chart_engine.chord_sizes(rng, len(timings), CHORD_SIZES, CHORD_PROBABILITIES)
+    rows, lanes = chart_engine.chord_lanes(rng, sizes, DEFAULT_LANES)
+    notes = chart_engine.to_notes(chart_engine.columns(timings[rows], lanes),
+                                  decimals=None, with_type=False)
     
     # Create the chart structure
     chart = {
         "title": "クライングガール",
         "artist": "Unknown", 
-        "bpm": 120,
+        **tempo,
         "offset": 0,
         "audioFile": "assets/sounds/cryinggirl.wav",
         "difficulty": {
@@ -68,10 +76,9 @@ def generate_another_chart(raw_data: Dict[str, Any]) -> Dict[str, Any]:
     
     return chart
 
-def main():
+def main(seed: Optional[int] = 42, divisor: Optional[int] = None,
+         input_file: str = DEFAULT_INPUT, output_file: str = DEFAULT_OUTPUT):
     """Main function to generate and save the chart."""
-    input_file = "/Users/hayatoikeda/Desktop/開発/otogame/beatmania-game/assets/charts/cryinggirl_raw_recording.json"
-    output_file = "/Users/hayatoikeda/Desktop/開発/otogame/beatmania-game/assets/charts/cryinggirl_another.json"
     
     print("Loading raw recording data...")
     raw_data = load_raw_recording(input_file)
@@ -79,10 +86,8 @@ def main():
     print(f"Found {len(raw_data['recordedTimings'])} timings")
     print("Generating ANOTHER difficulty chart...")
     
-    # Set random seed for consistent results (can be removed for truly random)
-    random.seed(42)
-    
-    chart = generate_another_chart(raw_data)
+    # Fixed seed for consistent results (pass --seed to change it)
+    chart = generate_another_chart(raw_data, seed, divisor)
     
     print(f"Generated {len(chart['notes'])} notes")
     
@@ -116,5 +121,16 @@ def main():
     print(f"- Total timings: {total_timings}")
     print(f"- Density: 100% (all recorded timings used)")
 
+def cli(argv: Optional[Sequence[str]] = None):
+    """Parse command-line options and run main()."""
+    parser = argparse.ArgumentParser(description="Generate the ANOTHER chart for cryinggirl")
+    parser.add_argument("--seed", type=int, default=42, help="random seed (same seed, same chart)")
+    parser.add_argument("--quantize", type=int, metavar="DIVISOR",
+                        help="snap timings to this beat subdivision (2 = 8th notes) and fit the BPM")
+    parser.add_argument("--input", default=DEFAULT_INPUT, help="raw recording JSON to read")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="chart JSON to write")
+    args = parser.parse_args(argv)
+    main(args.seed, args.quantize, args.input, args.output)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+オプトインの計測ツール（環境変数 OTOGAME_PROFILE または各ツールの --profile で有効化）
+
+OTOGAME_PROFILE にカンマ区切りでモードを指定する:
+    spans        処理段階（デコード・リサンプル・ビート検出・譜面生成・書き出しなど）の所要時間を
+                 <出力先>/spans.jsonl に1行1件のJSONで追記する（"1" でも同じ）
+    cprofile     profiled() で囲んだ処理ごとに <出力先>/<名前>.prof を書き出す
+    tracemalloc  profiled() で囲んだ処理ごとにメモリ確保の上位と最大使用量を <名前>.tracemalloc.txt に書き出す
+出力先は OTOGAME_PROFILE_DIR（既定: profile）。
+
+サーバーでは、リクエストごとの遅延のヒストグラム・送信バイト数・キャッシュのヒット率を集計し、
+終了時に <出力先>/server-stats-<pid>.json に書き出す。
+
+無効のときは span() が何もしないコンテキストを返すだけなので、計測コードを残したままでよい。
+
+使い方:
+    OTOGAME_PROFILE=spans python analyze.py songs/
+    python analyze.py --profile spans,cprofile songs/
+    python instrument.py profile/spans.jsonl      # 段階ごとの合計時間を表示
+"""
+import argparse
+import atexit
+import bisect
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from paths import root_path
+
+ENV_MODES = "OTOGAME_PROFILE"
+ENV_DIR = "OTOGAME_PROFILE_DIR"
+DEFAULT_DIR = root_path("profile")
+MODES = ("spans", "cprofile", "tracemalloc")
+
+# 遅延ヒストグラムの境界（ミリ秒）
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+TRACEMALLOC_TOP = 30
+
+_NULL_PROFILE = nullcontext()
+_write_lock = threading.Lock()
+modes = frozenset()
+output_dir = DEFAULT_DIR
+
+def configure(requested=None, directory=None):
+    """計測モードを設定する。環境変数にも反映するので、後から作るワーカープロセスにも引き継がれる
+
+    requestedで指定した不明なモードはValueError。環境変数の不明なモードは警告して無視する
+    （import時に読むので、例外にすると全てのツールが引数を解析する前に止まってしまう）
+    """
+    global modes, output_dir
+    from_env = requested is None
+    if from_env:
+        requested = os.environ.get(ENV_MODES, "")
+    if directory is None:
+        directory = os.environ.get(ENV_DIR, DEFAULT_DIR)
+    names = {name.strip().lower() for name in requested.split(",") if name.strip()}
+    if names & {"1", "true", "on"}:
+        names = (names - {"1", "true", "on"}) | {"spans"}
+    if "all" in names:
+        names = set(MODES)
+    unknown = names - set(MODES)
+    if unknown and from_env:
+        print(f"警告: {ENV_MODES}の不明な計測モードを無視します: {', '.join(sorted(unknown))}（{', '.join(MODES)}）",
+              file=sys.stderr)
+        names -= unknown
+    elif unknown:
+        raise ValueError(f"不明な計測モードです: {', '.join(sorted(unknown))}（{', '.join(MODES)}）")
+
+    modes = frozenset(names)
+    output_dir = directory
+    if modes:
+        os.environ[ENV_MODES] = ",".join(sorted(modes))
+        os.environ[ENV_DIR] = directory
+    else:
+        os.environ.pop(ENV_MODES, None)
+
+def enabled(mode="spans"):
+    return mode in modes
+
+def _output_path(name):
+    os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(output_dir, name)
+
+def write_event(event):
+    """spans.jsonl に1件追記する（複数プロセスから追記しても行が混ざらないよう1回のwriteで書く）"""
+    line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+    with _write_lock:
+        with open(_output_path("spans.jsonl"), "a", encoding="utf-8") as f:
+            f.write(line)
+
+@contextmanager
+def _span(name, fields):
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        write_event({
+            "ts": round(time.time(), 6),
+            "pid": os.getpid(),
+            "span": name,
+            "seconds": round(time.perf_counter() - start, 6),
+            **fields,
+        })
+
+def span(name, **fields):
+    """処理段階の所要時間を計測する。with内で返り値のdictに項目を追加すると一緒に記録される"""
+    if "spans" not in modes:
+        return nullcontext({})
+    return _span(name, fields)
+
+def _safe_name(name):
+    return re.sub(r"[^\w.-]+", "_", name).strip("_") or "run"
+
+@contextmanager
+def _profiled(name):
+    stem = f"{_safe_name(name)}-{os.getpid()}"
+    profiler = None
+    if "tracemalloc" in modes:
+        import tracemalloc
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    if "cprofile" in modes:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(_output_path(f"{stem}.prof"))
+        if "tracemalloc" in modes:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            with open(_output_path(f"{stem}.tracemalloc.txt"), "w", encoding="utf-8") as f:
+                f.write(f"current: {current / 1e6:.1f} MB / peak: {peak / 1e6:.1f} MB\n")
+                for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                    f.write(f"{stat}\n")
+
+def profiled(name):
+    """cprofile / tracemalloc モードのとき、囲んだ処理のプロファイルをファイルに書き出す"""
+    if not modes & {"cprofile", "tracemalloc"}:
+        return _NULL_PROFILE
+    return _profiled(name)
+
+class ServerStats:
+    """リクエストの遅延ヒストグラム・送信バイト数・キャッシュのヒット数（スレッドセーフ）"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = defaultdict(lambda: {
+            "requests": 0,
+            "bytes": 0,
+            "seconds": 0.0,
+            "status": defaultdict(int),
+            "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        })
+        self.counters = defaultdict(int)
+        self.started = time.time()
+        self._registered = False
+
+    def record(self, route, status, seconds, nbytes):
+        with self.lock:
+            stats = self.routes[route]
+            stats["requests"] += 1
+            stats["bytes"] += nbytes
+            stats["seconds"] += seconds
+            stats["status"][str(status)] += 1
+            stats["histogram"][bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+            self._register()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+            self._register()
+
+    def _register(self):
+        if not self._registered:
+            self._registered = True
+            atexit.register(self.dump)
+
+    def snapshot(self):
+        with self.lock:
+            labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+            routes = {}
+            for route, stats in sorted(self.routes.items()):
+                routes[route] = {
+                    "requests": stats["requests"],
+                    "bytes": stats["bytes"],
+                    "meanMs": round(stats["seconds"] / stats["requests"] * 1000, 3),
+                    "status": dict(stats["status"]),
+                    "histogram": dict(zip(labels, stats["histogram"])),
+                }
+            hits, misses = self.counters["body_cache.hit"], self.counters["body_cache.miss"]
+            return {
+                "since": self.started,
+                "until": time.time(),
+                "routes": routes,
+                "counters": dict(self.counters),
+                "bodyCacheHitRate": round(hits / (hits + misses), 4) if hits + misses else None,
+            }
+
+    def dump(self):
+        path = _output_path(f"server-stats-{os.getpid()}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2, ensure_ascii=False)
+        print(f"サーバーの計測結果を保存しました: {path}")
+
+server_stats = ServerStats()
+
+def summarize(paths):
+    """spans.jsonl を読み、段階ごとの回数・合計・平均・最大を合計時間の多い順に表示する"""
+    totals = defaultdict(list)
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    event = json.loads(line)
+                    totals[event["span"]].append(event["seconds"])
+    grand = sum(sum(values) for values in totals.values()) or 1.0
+    print(f"{'段階':<28} {'回数':>6} {'合計(秒)':>10} {'平均(ms)':>10} {'最大(ms)':>10} {'割合':>7}")
+    for name, values in sorted(totals.items(), key=lambda item: -sum(item[1])):
+        total = sum(values)
+        print(f"{name:<28} {len(values):>6} {total:>10.3f} {total / len(values) * 1000:>10.2f} "
+              f"{max(values) * 1000:>10.2f} {total / grand:>7.1%}")
+
+configure()
+
+def main():
+    parser = argparse.ArgumentParser(description="計測結果（spans.jsonl）を段階ごとに集計する")
+    parser.add_argument("paths", nargs="*", help=f"spans.jsonl（既定: {output_dir}/spans.jsonl）")
+    args = parser.parse_args()
+    summarize(args.paths or [os.path.join(output_dir, "spans.jsonl")])
+
+if __name__ == "__main__":
+    main()
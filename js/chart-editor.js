@@ -47,6 +47,7 @@ class ChartEditor {
         document.getElementById('generate-btn').addEventListener('click', () => this.generateCharts());
         document.getElementById('preview-btn').addEventListener('click', () => this.showPreview());
         document.getElementById('download-btn').addEventListener('click', () => this.downloadCharts());
+        document.getElementById('publish-btn').addEventListener('click', () => this.publishCharts());
         
         // モーダル制御
         document.querySelector('.close').addEventListener('click', () => this.closeModal());
@@ -72,6 +73,12 @@ class ChartEditor {
         this.audio.src = url;
         this.songData.audioFile = file.name;
         
+        // 曲IDの初期値はファイル名から作る
+        const songIdInput = document.getElementById('song-id');
+        if (!songIdInput.value) {
+            songIdInput.value = file.name.replace(/\.[^.]+$/, '').replace(/[^\p{L}\p{N}-]+/gu, '-');
+        }
+        
         document.getElementById('record-btn').disabled = false;
         
         console.log('楽曲ファイルを読み込みました:', file.name);
@@ -91,6 +98,7 @@ class ChartEditor {
         document.getElementById('record-btn').disabled = true;
         document.getElementById('stop-record-btn').disabled = false;
         document.getElementById('generate-btn').disabled = true;
+        document.getElementById('publish-btn').disabled = true;
         
         // 楽曲を開始位置にセット
         this.audio.currentTime = 0;
@@ -120,6 +128,7 @@ class ChartEditor {
         document.getElementById('record-btn').disabled = false;
         document.getElementById('stop-record-btn').disabled = true;
         document.getElementById('generate-btn').disabled = this.recordedTimings.length === 0;
+        document.getElementById('publish-btn').disabled = this.recordedTimings.length === 0;
         
         console.log(`記録停止。${this.recordedTimings.length}個のタイミングを記録しました。`);
         this.updateStatus(`記録完了！ ${this.recordedTimings.length}個のタイミングを記録しました。`);
@@ -131,6 +140,7 @@ class ChartEditor {
         document.getElementById('generate-btn').disabled = true;
         document.getElementById('preview-btn').disabled = true;
         document.getElementById('download-btn').disabled = true;
+        document.getElementById('publish-btn').disabled = true;
         
         console.log('記録をクリアしました');
         this.updateStatus('記録をクリアしました。');
@@ -351,16 +361,7 @@ class ChartEditor {
         }
         
         // 完全な記録データを保存
-        const rawRecording = {
-            title: this.songData.title || 'Untitled',
-            artist: this.songData.artist || 'Unknown',
-            bpm: this.songData.bpm,
-            offset: this.songData.offset,
-            audioFile: this.songData.audioFile,
-            recordedTimings: this.recordedTimings,
-            recordedAt: new Date().toISOString(),
-            totalTimings: this.recordedTimings.length
-        };
+        const rawRecording = this.buildRawRecording();
         
         const rawDataStr = JSON.stringify(rawRecording, null, 2);
         const rawDataBlob = new Blob([rawDataStr], {type: 'application/json'});
@@ -386,6 +387,73 @@ class ChartEditor {
         this.updateStatus('譜面ファイルと完全な記録データをダウンロードしました！');
     }
     
+    buildRawRecording() {
+        return {
+            title: this.songData.title || 'Untitled',
+            artist: this.songData.artist || 'Unknown',
+            bpm: this.songData.bpm,
+            offset: this.songData.offset,
+            audioFile: this.songData.audioFile,
+            recordedTimings: this.recordedTimings,
+            recordedAt: new Date().toISOString(),
+            totalTimings: this.recordedTimings.length
+        };
+    }
+    
+    async publishCharts() {
+        const songId = document.getElementById('song-id').value.trim();
+        if (!songId) {
+            alert('曲IDを入力してください。');
+            return;
+        }
+        
+        // 記録データと難易度設定を送り、譜面の生成はサーバーのワーカーに任せる
+        const rawRecording = this.buildRawRecording();
+        rawRecording.settings = {};
+        ['beginner', 'normal', 'hyper', 'another'].forEach(difficulty => {
+            rawRecording.settings[difficulty] = this.getDifficultyConfig(difficulty);
+        });
+        
+        const button = document.getElementById('publish-btn');
+        button.disabled = true;
+        try {
+            this.updateStatus('記録データを送信中...');
+            const response = await fetch(`/api/uploads?songId=${encodeURIComponent(songId)}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(rawRecording)
+            });
+            let job = await response.json();
+            if (!response.ok) {
+                throw new Error(job.error || response.status);
+            }
+            
+            while (job.status === 'queued' || job.status === 'running') {
+                this.updateStatus(`サーバーで譜面を生成中... (${job.status})`);
+                await new Promise(resolve => setTimeout(resolve, 500));
+                const statusResponse = await fetch(`/api/uploads/${job.jobId}`);
+                job = await statusResponse.json();
+                if (!statusResponse.ok) {
+                    throw new Error(job.error || statusResponse.status);
+                }
+            }
+            if (job.status === 'failed') {
+                throw new Error(job.error);
+            }
+            
+            const summary = Object.entries(job.charts)
+                .map(([difficulty, chart]) => `${difficulty.toUpperCase()} ${chart.noteCount}ノーツ`)
+                .join(' / ');
+            console.log('譜面を公開しました:', job);
+            this.updateStatus(`公開完了！ ${songId}: ${summary}`);
+        } catch (error) {
+            console.error('公開エラー:', error);
+            this.updateStatus(`公開に失敗しました: ${error.message}`);
+        } finally {
+            button.disabled = false;
+        }
+    }
+    
     updateStatus(message) {
         document.getElementById('generation-status').textContent = message;
     }
@@ -9,6 +9,9 @@ class BeatmaniaGame {
         this.score = 0;
         this.combo = 0;
         this.maxCombo = 0;
+        this.judgments = {};
+        this.songId = null;
+        this.difficultyKey = null;
         this.noteSpeed = 3;
         this.customCharts = {};
         this.judgmentTiming = {
@@ -57,6 +60,7 @@ class BeatmaniaGame {
     initEventListeners() {
         document.getElementById('start-btn').addEventListener('click', () => this.startGame());
         document.getElementById('stop-btn').addEventListener('click', () => this.stopGame());
+        this.audio.addEventListener('ended', () => this.finishGame());
         
         document.addEventListener('keydown', (e) => this.handleKeyDown(e));
         document.addEventListener('keyup', (e) => this.handleKeyUp(e));
@@ -138,6 +142,8 @@ class BeatmaniaGame {
                 // カスタム譜面を使用
                 if (this.customCharts[difficulty]) {
                     this.chartData = this.customCharts[difficulty];
+                    // カスタム譜面のスコアはランキングに送らない
+                    this.songId = null;
                     console.log(`カスタム譜面読み込み完了: ${this.chartData.difficulty.name} (${this.chartData.notes.length}ノーツ)`);
                 } else {
                     throw new Error(`${difficulty}の難易度が見つかりません`);
@@ -161,6 +167,8 @@ class BeatmaniaGame {
                 console.log(`Response first 100 chars: ${text.substring(0, 100)}`);
                 
                 this.chartData = JSON.parse(text);
+                this.songId = songId;
+                this.difficultyKey = difficulty;
                 console.log('JSONパース完了');
                 this.audio.src = this.chartData.audioFile;
                 
@@ -273,10 +281,43 @@ class BeatmaniaGame {
         this.clearNotes();
     }
     
+    async finishGame() {
+        if (!this.isPlaying) return;
+        this.stopGame();
+        await this.submitScore();
+    }
+    
+    async submitScore() {
+        if (!this.songId) return;
+        const player = localStorage.getItem('playerName') || 'GUEST';
+        try {
+            const response = await fetch('/api/scores', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    songId: this.songId,
+                    difficulty: this.difficultyKey,
+                    player: player,
+                    score: this.score,
+                    maxCombo: this.maxCombo,
+                    judgments: this.judgments
+                })
+            });
+            const result = await response.json();
+            if (!response.ok) {
+                throw new Error(result.error || response.status);
+            }
+            console.log(`スコア送信完了: 自己ベスト ${result.best} (${result.rank}位 / ${result.total}人)`);
+        } catch (error) {
+            console.error('スコア送信エラー:', error);
+        }
+    }
+    
     reset() {
         this.score = 0;
         this.combo = 0;
         this.maxCombo = 0;
+        this.judgments = {};
         this.notes = [];
         this.updateScore();
         this.updateCombo();
@@ -457,6 +498,7 @@ class BeatmaniaGame {
         }
         
         this.score += points;
+        this.judgments[judgment] = (this.judgments[judgment] || 0) + 1;
         this.updateScore();
         
         if (judgment !== 'POOR') {
@@ -472,6 +514,7 @@ class BeatmaniaGame {
     }
     
     missNote(note) {
+        this.judgments.POOR = (this.judgments.POOR || 0) + 1;
         this.combo = 0;
         this.updateCombo();
         this.showJudgment('POOR');
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+譜面ツールの共通の入口
+
+サブコマンドごとに対応するスクリプトの main() を呼ぶ。スクリプトのモジュールはサブコマンドが
+決まってから読み込むので、JSONだけを扱うコマンド（transform・index・binary など）の起動時に
+librosa や NumPy は読み込まれない。サブコマンド以降の引数はそのままスクリプトに渡る。
+
+コマンドラインで渡したパスは作業ディレクトリからの相対パスのまま。既定の入出力先（assets/charts など）は
+プロジェクトのディレクトリを基準にする（paths.py）。--root（または環境変数 OTOGAME_ROOT）で
+別の場所のプロジェクトを指定できる。既定はこのファイルのあるディレクトリ。
+
+使い方:
+    python otogame.py                              # サブコマンドの一覧
+    python otogame.py index --check                # 譜面の検証
+    python otogame.py analyze songs/ --workers 8   # 楽曲フォルダを分析して譜面を生成
+    python otogame.py diff old.json new.json       # 譜面の差分
+    python otogame.py --root ~/otogame build       # 別の場所のプロジェクトを差分ビルド
+    python otogame.py <サブコマンド> --help        # サブコマンドの使い方
+"""
+import argparse
+import importlib
+import os
+import sys
+
+from paths import ENV_ROOT
+
+# サブコマンド -> (モジュール, 呼び出す関数, 説明)
+COMMANDS = {
+    "analyze": ("analyze", "main", "楽曲を分析して全難易度の譜面を生成する"),
+    "structure": ("structure", "main", "楽曲の構成（区間の境界と密度）を推定して表示する"),
+    "create-chart": ("create_chart", "main", "午前四時の宮殿の全難易度の譜面を作成する"),
+    "another": ("generate_another_chart", "cli", "クライングガールのANOTHER譜面を記録データから作成する"),
+    "editor-charts": ("editor_charts", "main", "記録データから譜面エディタと同じ規則で全難易度の譜面を作る"),
+    "quantize": ("quantize", "main", "記録データ・譜面の時刻をBPMのグリッドに揃える"),
+    "update-charts": ("update_charts", "main", "午前四時の宮殿の譜面を6鍵+スクラッチのレーン配置に更新する"),
+    "remove-scratch": ("remove_scratch", "main", "午前四時の宮殿の譜面からスクラッチノーツを削除する"),
+    "fix-audio": ("fix_cryinggirl_audio", "main", "クライングガールの譜面の音楽ファイルパスを修正する"),
+    "transform": ("chart_transform", "main", "譜面ファイルに変換をまとめて適用する"),
+    "index": ("chart_index", "main", "譜面の統計・検証マニフェストを作成する"),
+    "binary": ("chart_binary", "main", "譜面をバイナリ形式に変換・表示する（convert / dump）"),
+    "diff": ("chart_diff", "main", "譜面の差分と3方向マージ"),
+    "simulate": ("simulate", "main", "譜面を game.js と同じ判定で試しプレイして集計する"),
+    "build": ("build_charts", "main", "入力が変わった譜面だけを作り直す"),
+    "audio": ("audio_prep", "main", "配信用の音声と波形ピークを作る"),
+    "serve": ("server", "main", "ゲームと譜面・スコアAPIを配信する開発用サーバーを起動する"),
+    "serve-fast": ("simple_server", "main", "圧縮・キャッシュ付きの静的ファイルサーバーを起動する"),
+    "bench": ("benchmark", "main", "譜面ツールとサーバーのベンチマーク"),
+    "profile": ("instrument", "main", "計測結果（spans.jsonl）を段階ごとに集計する"),
+}
+
+def command_list():
+    width = max(len(name) for name in COMMANDS)
+    lines = ["サブコマンド:"]
+    lines += [f"  {name:<{width}}  {description}" for name, (_, _, description) in COMMANDS.items()]
+    return "\n".join(lines)
+
+def run(name, args, root=None):
+    """サブコマンドnameを引数argsで実行する（スクリプトからは sys.argv[1:] が args に見える）"""
+    module_name, function_name, _ = COMMANDS[name]
+    # 既定のパスはモジュールの読み込み時に決まるので、読み込む前に設定する（ワーカープロセスにも引き継がれる）
+    if root:
+        os.environ[ENV_ROOT] = os.path.abspath(root)
+    module = importlib.import_module(module_name)
+    sys.argv = [f"otogame {name}", *args]
+    return getattr(module, function_name)()
+
+def main():
+    parser = argparse.ArgumentParser(prog="otogame", description="譜面ツールの共通の入口",
+                                     epilog=command_list(), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", help=f"プロジェクトのディレクトリ（既定: 環境変数{ENV_ROOT}、なければこのファイルの場所）")
+    parser.add_argument("command", nargs="?", choices=COMMANDS, metavar="サブコマンド")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="サブコマンドに渡す引数")
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        return
+    run(args.command, args.args, args.root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+"""
+プロジェクトのディレクトリ（assets/ などがある場所）を基準にしたパス
+
+ツールの既定の入出力先（assets/charts など）は、どのディレクトリから実行しても
+プロジェクトのファイルを指すよう、作業ディレクトリではなくこのディレクトリを基準にする。
+コマンドラインで渡したパスは今までどおり作業ディレクトリからの相対パス。
+環境変数 OTOGAME_ROOT で別の場所のプロジェクトを指定できる（otogame.py --root も同じ）。
+"""
+import os
+
+ENV_ROOT = "OTOGAME_ROOT"
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def root_dir():
+    """プロジェクトのディレクトリ（環境変数 OTOGAME_ROOT、なければこのファイルの場所）"""
+    return os.path.abspath(os.environ.get(ENV_ROOT) or ROOT)
+
+def root_path(*parts):
+    """プロジェクトのディレクトリからの相対パスを絶対パスにする"""
+    return os.path.join(root_dir(), *parts)
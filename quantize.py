@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+記録したタイミングのビートグリッドへのクオンタイズ
+
+譜面エディタの記録データ（recordedTimings）は人が叩いた時刻そのままで、bpmも仮の120が入っている。
+記録からBPM・拍の位置・テンポの変化を推定し、指定した分割（16分なら4）のグリッドに時刻を揃える。
+
+1. 記録をWINDOW_NOTES個ずつの窓に分け、窓ごとに候補の周期のグリッドとの一致度
+   （各時刻の位相の揃い具合、0〜1）が最大になる周期を粗い候補→細かい候補の2段階で求める。
+   候補は周波数（1/周期）の等間隔にとり、exp(2πi t f) を候補ごとに計算せず掛け算で順に求める
+2. 周期がほぼ同じ窓をつなげてテンポ区間にする
+3. 区間ごとに、隣り合う時刻の間隔をグリッド何個分かに丸めて通し番号を付け、
+   時刻 = 原点 + 番号 × 周期 を最小二乗法で当てはめる（外れ値を除いて番号を付け直し、数回繰り返す）
+4. 各時刻を区間のグリッドの最も近い点に寄せ、元の時刻とのずれ（残差）を報告する
+
+窓ごとの候補数は一定なので、計算量はノーツ数に比例する。
+倍・半分のテンポは区別できないので、BPMは bpm_range（既定90〜180の1オクターブ）の中から選ぶ。
+違うときは --bpm-range か --bpm で指定する。手で叩いた記録はずれが大きいので、分割が細かすぎると
+テンポを取り違える（グリッド外のノーツが多いときは --divisor を小さくする）。
+
+譜面の offset は game.js では再生開始のずらし量なので変更しない。推定したBPMは bpm に、
+テンポが変わる曲では区間ごとの {"time", "bpm"} を bpmChanges に書く。
+
+使い方:
+    python quantize.py assets/charts/cryinggirl_raw_recording.json --divisor 2
+    python quantize.py assets/charts/cryinggirl_raw_recording.json --divisor 2 --output /tmp/cryinggirl_quantized.json
+    python quantize.py assets/charts/cryinggirl_another.json --bpm 150 --in-place
+"""
+import argparse
+import json
+import math
+
+import numpy as np
+
+from chart_model import Chart
+from chart_transform import write_json_atomic
+
+DEFAULT_DIVISOR = 4
+DEFAULT_BPM_RANGE = (90.0, 180.0)
+# テンポ推定の窓のノーツ数
+WINDOW_NOTES = 32
+# 一度に計算する窓の数（メモリ使用量の上限）
+WINDOW_BATCH = 256
+# 粗い候補の数（bpm_rangeのグリッド周波数を等間隔に分割）と、その1刻みを細かく分ける数
+COARSE_CANDIDATES = 96
+FINE_CANDIDATES = 17
+# これより一致度の低い窓はテンポの推定に使わない
+MIN_COHERENCE = 0.3
+# 周期が区間の最初の窓（TEMPO_REFERENCE_WINDOWS個の中央値）からこの割合以上変わったら別のテンポ区間にする
+TEMPO_TOLERANCE = 0.015
+TEMPO_REFERENCE_WINDOWS = 8
+# 当てはめの繰り返し回数と、当てはめから除く外れ値（グリッド間隔に対する残差の割合）
+REFINE_ITERATIONS = 4
+OUTLIER_FRACTION = 0.25
+# グリッド外のノーツがこの割合を超えたら分割が合っていないと警告する
+OFF_GRID_WARNING = 0.2
+DECIMALS = 6
+
+def coherence(windows, weights, first, step, count):
+    """窓（行）ごと・候補周波数 first + k × step（k < count）ごとの一致度 |平均 exp(2πi t f)|
+
+    windows, weights は (窓数, ノーツ数)、first, step は窓ごとの周波数の配列。戻り値は (窓数, count)
+    """
+    phase = 2j * np.pi * windows
+    rotation = np.empty((len(windows), count, windows.shape[1]), dtype=np.complex128)
+    rotation[:, 0] = np.exp(phase * first[:, None]) * weights
+    rotation[:, 1:] = np.exp(phase * step[:, None])[:, None, :]
+    np.cumprod(rotation, axis=1, out=rotation)
+    return np.abs(rotation.sum(axis=2)) / np.maximum(weights.sum(axis=1), 1)[:, None]
+
+def window_periods(times, divisor, bpm_range):
+    """WINDOW_NOTES個ずつの窓ごとに、最も一致するグリッド周期とその一致度を返す"""
+    low = bpm_range[0] * divisor / 60.0
+    high = bpm_range[1] * divisor / 60.0
+    coarse_step = (high - low) / COARSE_CANDIDATES
+    fine_step = 2 * coarse_step / (FINE_CANDIDATES - 1)
+
+    count = -(-len(times) // WINDOW_NOTES)
+    padded = np.zeros(count * WINDOW_NOTES)
+    padded[:len(times)] = times
+    weights = np.zeros(count * WINDOW_NOTES)
+    weights[:len(times)] = 1.0
+    padded = padded.reshape(count, WINDOW_NOTES)
+    weights = weights.reshape(count, WINDOW_NOTES)
+    # 窓の先頭からの時刻にして、長い曲でも位相の計算の桁落ちを防ぐ
+    padded = (padded - padded[:, :1]) * weights
+
+    periods = np.empty(count)
+    scores = np.empty(count)
+    for start in range(0, count, WINDOW_BATCH):
+        block = slice(start, start + WINDOW_BATCH)
+        t, w = padded[block], weights[block]
+        rows = np.arange(len(t))
+        best = low + coherence(t, w, np.full(len(t), low), np.full(len(t), coarse_step),
+                               COARSE_CANDIDATES).argmax(axis=1) * coarse_step
+        # 粗い候補の前後1刻みを細かく調べる
+        first = np.clip(best - coarse_step, low, high - 2 * coarse_step)
+        score = coherence(t, w, first, np.full(len(t), fine_step), FINE_CANDIDATES)
+        index = score.argmax(axis=1)
+        periods[block] = 1.0 / (first + index * fine_step)
+        scores[block] = score[rows, index]
+    return periods, scores
+
+def tempo_sections(times, divisor, bpm_range):
+    """テンポ区間の (開始index, 終了index, 初期周期) のリスト"""
+    periods, scores = window_periods(times, divisor, bpm_range)
+    reliable = scores >= MIN_COHERENCE
+    if len(reliable) > 1 and len(times) % WINDOW_NOTES and len(times) % WINDOW_NOTES < WINDOW_NOTES // 2:
+        # ノーツの少ない最後の窓は、たまたまグリッドに合う周期が見つかりやすいので使わない
+        reliable[-1] = False
+    if not reliable.any():
+        # どの窓もグリッドに合わないときは、最もましな窓の周期で全体を1区間にする
+        return [(0, len(times), float(periods[scores.argmax()]))]
+    # 信頼できない窓は直前（先頭なら最初）の信頼できる窓の周期を使う
+    index = np.where(reliable, np.arange(len(periods)), 0)
+    np.maximum.accumulate(index, out=index)
+    index[:np.argmax(reliable)] = np.argmax(reliable)
+    log_periods = np.log(periods[index])
+    # 1窓だけの揺れで区間を割らないよう、前後の窓との中央値をとる
+    if len(log_periods) >= 3:
+        log_periods[1:-1] = np.median(np.stack([log_periods[:-2], log_periods[1:-1], log_periods[2:]]), axis=0)
+
+    sections = []
+    first = 0
+    reference = log_periods[0]
+    for window in range(1, len(log_periods) + 1):
+        if window == len(log_periods) or abs(log_periods[window] - reference) > TEMPO_TOLERANCE:
+            period = float(np.exp(np.median(log_periods[first:first + TEMPO_REFERENCE_WINDOWS])))
+            sections.append((first * WINDOW_NOTES, min(window * WINDOW_NOTES, len(times)), period))
+            first = window
+        if window < len(log_periods) and window - first < TEMPO_REFERENCE_WINDOWS:
+            reference = np.median(log_periods[first:window + 1])
+    return sections
+
+def fit_grid(times, period, fixed_period=False):
+    """時刻 = 原点 + 番号 × 周期 を当てはめ、(原点, 周期) を返す"""
+    if len(times) == 1:
+        return float(times[0]), period
+    # 間隔ごとに丸めて番号を付けるので、初期周期の誤差が曲の後ろほど積み重なることはない
+    steps = np.concatenate([[0.0], np.cumsum(np.rint(np.diff(times) / period))])
+    origin = float(times[0])
+    for _ in range(REFINE_ITERATIONS):
+        residual = times - (origin + steps * period)
+        inliers = np.abs(residual) <= OUTLIER_FRACTION * period
+        if inliers.sum() < 2:
+            inliers[:] = True
+        x, y = steps[inliers], times[inliers]
+        if fixed_period or np.ptp(x) == 0:
+            origin = float(np.mean(y - x * period))
+        else:
+            period, origin = (float(v) for v in np.polyfit(x, y, 1))
+        steps = np.rint((times - origin) / period)
+    return origin, period
+
+def fit_tempo(times, divisor=DEFAULT_DIVISOR, bpm_range=DEFAULT_BPM_RANGE, bpm=None):
+    """昇順の時刻列にテンポ区間のグリッドを当てはめる
+
+    戻り値は区間ごとの {"start", "end"（時刻列のindex）, "bpm", "period"（グリッド間隔の秒数）,
+    "origin"（グリッドの点の1つ）, "firstBeat"（区間の最初のノーツ以前で最も近い拍の時刻）} のリスト
+    """
+    times = np.asarray(times, dtype=np.float64)
+    if len(times) < 2:
+        # 間隔がないのでテンポは決まらない
+        return []
+    if bpm_range[0] <= 0 or not bpm_range[0] < bpm_range[1]:
+        raise ValueError(f"bpm_rangeが正しくありません: {bpm_range}")
+    if bpm is not None:
+        sections = [(0, len(times), 60.0 / bpm / divisor)]
+    else:
+        sections = tempo_sections(times, divisor, bpm_range)
+
+    segments = [fit_segment(times, start, end, period, divisor, fixed_period=bpm is not None)
+                for start, end, period in sections]
+    # 当てはめた結果のBPMが許容範囲内で同じになった隣り合う区間は、つなげて当てはめ直す
+    merged = [segments[0]]
+    for segment in segments[1:]:
+        previous = merged[-1]
+        if abs(math.log(segment["period"] / previous["period"])) > TEMPO_TOLERANCE:
+            merged.append(segment)
+        else:
+            merged[-1] = fit_segment(times, previous["start"], segment["end"], previous["period"], divisor)
+    return merged
+
+def fit_segment(times, start, end, period, divisor, fixed_period=False):
+    part = times[start:end]
+    origin, period = fit_grid(part, period, fixed_period)
+    # 拍の頭（divisor個ごとの点）は、ノーツが最も多く乗っている位相とみなす
+    steps = np.rint((part - origin) / period).astype(np.int64)
+    phase = int(np.bincount(steps % divisor, minlength=divisor).argmax())
+    beat = origin + phase * period
+    beat -= math.ceil((beat - part[0]) / (divisor * period) - 1e-9) * divisor * period
+    return {"start": start, "end": end, "bpm": 60.0 / (period * divisor), "period": period,
+            "origin": origin, "firstBeat": beat}
+
+def snap(times, segments):
+    """昇順の時刻列を、各時刻が属する区間のグリッドの最も近い点に寄せる"""
+    times = np.asarray(times, dtype=np.float64)
+    snapped = np.empty_like(times)
+    for segment in segments:
+        part = slice(segment["start"], segment["end"])
+        origin, period = segment["origin"], segment["period"]
+        snapped[part] = origin + np.rint((times[part] - origin) / period) * period
+    return np.round(snapped, DECIMALS)
+
+def residual_report(residuals, period):
+    """残差（秒）の要約。単位はミリ秒"""
+    if len(residuals) == 0:
+        return {"count": 0}
+    magnitude = np.abs(residuals) * 1000
+    return {
+        "count": int(len(residuals)),
+        "meanAbsMs": round(float(magnitude.mean()), 2),
+        "rmsMs": round(float(np.sqrt(np.mean(magnitude ** 2))), 2),
+        "p95Ms": round(float(np.percentile(magnitude, 95)), 2),
+        "maxMs": round(float(magnitude.max()), 2),
+        # グリッド間隔の1/4以上ずれたノーツは別の分割（3連符など）の可能性が高い（グリッドがなければ0）
+        "offGrid": int(np.count_nonzero(magnitude >= OUTLIER_FRACTION * period * 1000)) if period else 0,
+    }
+
+def quantize(times, divisor=DEFAULT_DIVISOR, bpm_range=DEFAULT_BPM_RANGE, bpm=None):
+    """時刻列（並び順は任意）をクオンタイズする
+
+    戻り値は {"times": 元の並び順のクオンタイズ後の時刻, "residuals": 元の時刻 − クオンタイズ後,
+    "segments": fit_tempoの区間, "report": 全体と区間ごとの残差の要約}
+    """
+    times = np.asarray(times, dtype=np.float64)
+    if not np.all(np.isfinite(times)):
+        raise ValueError("時刻にNaN・無限大があります")
+    if divisor < 1:
+        raise ValueError(f"divisorは1以上で指定してください: {divisor}")
+    if bpm is not None and not bpm > 0:
+        raise ValueError(f"bpmは正の数で指定してください: {bpm}")
+    order = np.argsort(times, kind="stable")
+    ordered = times[order]
+    segments = fit_tempo(ordered, divisor, bpm_range, bpm)
+    snapped_ordered = snap(ordered, segments) if segments else ordered
+    snapped = np.empty_like(times)
+    snapped[order] = snapped_ordered
+    residuals = times - snapped
+    for segment in segments:
+        part = slice(segment["start"], segment["end"])
+        segment["residuals"] = residual_report((ordered - snapped_ordered)[part], segment["period"])
+    main = dominant_segment(segments)
+    return {
+        "times": snapped,
+        "residuals": residuals,
+        "segments": segments,
+        "report": residual_report(residuals, main["period"] if main else 0.0),
+    }
+
+def dominant_segment(segments):
+    """最も長いテンポ区間（譜面の bpm に書く）"""
+    return max(segments, key=lambda segment: segment["end"] - segment["start"], default=None)
+
+def tempo_metadata(segments):
+    """譜面・記録データに書く {"bpm"} と、テンポが変わるなら {"bpmChanges"}"""
+    main = dominant_segment(segments)
+    if main is None:
+        return {}
+    meta = {"bpm": round(main["bpm"], 2)}
+    if len(segments) > 1:
+        meta["bpmChanges"] = [{"time": round(segment["firstBeat"], 3), "bpm": round(segment["bpm"], 2)}
+                              for segment in segments]
+    return meta
+
+def quantize_recording(raw, **options):
+    """記録データ（recordedTimings）をクオンタイズした新しい記録データと、quantizeの結果を返す
+
+    同じグリッドの点に寄った時刻は1つにまとめる
+    """
+    timings = raw.get("recordedTimings")
+    if not isinstance(timings, list):
+        raise ValueError("recordedTimingsがありません")
+    result = quantize(timings, **options)
+    unique = np.unique(result["times"])
+    result["merged"] = len(timings) - len(unique)
+    data = dict(raw, recordedTimings=unique.tolist())
+    if "totalTimings" in data:
+        data["totalTimings"] = len(unique)
+    data.pop("bpmChanges", None)
+    data.update(tempo_metadata(result["segments"]))
+    return data, result
+
+def quantize_chart(chart, **options):
+    """譜面のノーツの時刻（ロングノーツは終点も）をクオンタイズした新しいChartと、quantizeの結果を返す
+
+    テンポは重複を除いた時刻で推定する（同時押しで同じ時刻が何度も入ると、その時刻に重みが偏るため）。
+    寄せた結果、同じ時刻・同じレーンに重なったノーツは先のものだけを残す
+    """
+    notes = chart.notes
+    times = np.frombuffer(notes.times, dtype=np.float64)
+    unique, inverse = np.unique(times, return_inverse=True)
+    result = quantize(unique, **options)
+    snapped = result["times"][inverse]
+    result["times"], result["residuals"] = snapped, times - snapped
+    durations = np.frombuffer(notes.durations, dtype=np.float64)
+    holds = ~np.isnan(durations)
+    if holds.any():
+        # 終点も同じグリッドに寄せる（始点と同じ点に寄ったロングノーツは1グリッド分の長さにする）
+        snapped_ends, periods = snap_with(times[holds] + durations[holds], result["segments"], unique)
+        durations = durations.copy()
+        durations[holds] = np.round(np.maximum(snapped_ends - snapped[holds], periods), DECIMALS)
+    notes = notes.with_times(snapped.tolist(), durations.tolist())
+    seen = set()
+    keep = bytearray()
+    for key in zip(notes.times, notes.lanes):
+        keep.append(key not in seen)
+        seen.add(key)
+    result["merged"] = len(keep) - sum(keep)
+    meta = {key: value for key, value in chart.meta.items() if key != "bpmChanges"}
+    meta.update(tempo_metadata(result["segments"]))
+    return Chart(meta, notes.select(bytes(keep)), chart.notes_at), result
+
+def snap_with(times, segments, reference):
+    """昇順の時刻列referenceで求めた区間のグリッドに、別の時刻列を寄せる（区間は時刻で引く）。
+    寄せた時刻と、各時刻の区間のグリッド間隔を返す（区間がなければ寄せずに間隔0を返す）"""
+    times = np.asarray(times, dtype=np.float64)
+    if not segments:
+        return np.round(times, DECIMALS), np.zeros(len(times))
+    bounds = np.array([reference[segment["start"]] for segment in segments[1:]])
+    which = np.searchsorted(bounds, times, side="right")
+    origins = np.array([segment["origin"] for segment in segments])[which]
+    periods = np.array([segment["period"] for segment in segments])[which]
+    return np.round(origins + np.rint((times - origins) / periods) * periods, DECIMALS), periods
+
+def parse_bpm_range(text):
+    try:
+        low, high = (float(value) for value in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"BPMの範囲は 最小,最大 で指定してください: {text}")
+    return low, high
+
+def print_result(path, result):
+    report = result["report"]
+    print(f"{path}: {report['count']}個 → グリッドとのずれ 平均{report.get('meanAbsMs', 0)}ms "
+          f"RMS {report.get('rmsMs', 0)}ms 95% {report.get('p95Ms', 0)}ms 最大{report.get('maxMs', 0)}ms "
+          f"（グリッド外 {report.get('offGrid', 0)}個、まとめた重複 {result['merged']}個）")
+    if report["count"] and report["offGrid"] > OFF_GRID_WARNING * report["count"]:
+        print("  警告: グリッド外のノーツが多く、分割が細かすぎる可能性があります（--divisor を小さくしてください）")
+    for segment in result["segments"]:
+        residuals = segment["residuals"]
+        print(f"  #{segment['start']}〜{segment['end'] - 1}: BPM {segment['bpm']:.2f} "
+              f"最初の拍 {segment['firstBeat']:.3f}秒 平均のずれ {residuals.get('meanAbsMs', 0)}ms")
+
+def segment_summary(segments):
+    return [{key: (round(value, DECIMALS) if isinstance(value, float) else value) for key, value in segment.items()}
+            for segment in segments]
+
+def main():
+    parser = argparse.ArgumentParser(description="記録データ・譜面の時刻をBPMのグリッドに揃える")
+    parser.add_argument("files", nargs="+", help="記録データ（*_raw_recording.json）または譜面JSON")
+    parser.add_argument("--divisor", type=int, default=DEFAULT_DIVISOR, help="1拍の分割数（4で16分、3で8分3連）")
+    parser.add_argument("--bpm-range", type=parse_bpm_range, default=DEFAULT_BPM_RANGE,
+                        help="推定するBPMの範囲（例: 90,180）")
+    parser.add_argument("--bpm", type=float, help="BPMを推定せずに固定する（拍の位置だけ当てはめる）")
+    parser.add_argument("--output", help="書き出し先（入力が1ファイルのとき）")
+    parser.add_argument("--in-place", action="store_true", help="入力ファイルを書き換える")
+    parser.add_argument("--report", help="当てはめたテンポ区間と残差をJSONで保存する")
+    args = parser.parse_args()
+    if args.output and len(args.files) != 1:
+        parser.error("--output は入力が1ファイルのときだけ使えます")
+    options = {"divisor": args.divisor, "bpm_range": args.bpm_range, "bpm": args.bpm}
+
+    reports = {}
+    for path in args.files:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        try:
+            if "recordedTimings" in data:
+                output, result = quantize_recording(data, **options)
+            else:
+                output, result = quantize_chart(Chart.from_dict(data), **options)
+        except ValueError as e:
+            print(f"{path}: クオンタイズできません ({e})")
+            continue
+        print_result(path, result)
+        reports[path] = {"report": result["report"], "merged": result["merged"],
+                         "segments": segment_summary(result["segments"])}
+        destination = args.output or (path if args.in_place else None)
+        if destination:
+            write_json_atomic(destination, output)
+            print(f"  書き出し: {destination}")
+    if args.report:
+        write_json_atomic(args.report, reports)
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,27 @@
 """
 譜面からスクラッチノーツを削除するスクリプト
 """
-import json
+import argparse
 import glob
 
+from chart_transform import NoteFilter, transform_charts
+from paths import root_path
+
 def remove_scratch_notes():
     """全ての譜面ファイルからスクラッチノーツを削除"""
-    chart_files = glob.glob("assets/charts/gozen4ji_*.json")
+    chart_files = glob.glob(root_path("assets", "charts", "gozen4ji_*.json"))
+    
+    # スクラッチノーツ（lane 6以上）を削除
+    results = transform_charts(chart_files, [NoteFilter(max_lane=5)])
     
-    for chart_file in chart_files:
-        print(f"更新中: {chart_file}")
-        
-        with open(chart_file, 'r', encoding='utf-8') as f:
-            chart = json.load(f)
-        
-        # スクラッチノーツ（lane 6以上）を削除
-        original_count = len(chart['notes'])
-        chart['notes'] = [note for note in chart['notes'] if note['lane'] < 6]
-        new_count = len(chart['notes'])
-        
-        # ファイルを更新
-        with open(chart_file, 'w', encoding='utf-8') as f:
-            json.dump(chart, f, indent=2, ensure_ascii=False)
-        
-        print(f"完了: {original_count} -> {new_count}ノーツ (削除: {original_count - new_count})")
+    for result in results:
+        original_count, new_count = result["notes_before"], result["notes_after"]
+        print(f"完了: {result['path']} {original_count} -> {new_count}ノーツ (削除: {original_count - new_count})")
 
-if __name__ == "__main__":
+def main():
+    argparse.ArgumentParser(description="午前四時の宮殿の譜面からスクラッチノーツを削除する").parse_args()
     remove_scratch_notes()
-    print("全ての譜面からスクラッチノーツを削除しました！")
\ No newline at end of file
+    print("全ての譜面からスクラッチノーツを削除しました！")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+スコアの保存とランキング（server.py / simple_server.py から使う）
+
+    POST /api/scores
+        {"songId", "difficulty", "player", "score", "maxCombo", "judgments"} を保存する
+        （maxCombo・judgments は省略可）。譜面が存在し、スコアがノーツ数×1000点以下のときだけ受け付ける。
+        返り値は {"best": 自己ベスト, "newBest": 自己ベストを更新したか, "rank": 順位, "total": 人数}
+    GET /api/leaderboard/<曲ID>/<難易度>?limit=10&player=<名前>
+        自己ベストの上位limit件（同点は先に出した人が上）と、playerを指定したときはその順位
+
+スコアはSQLite（WALモード）に保存する。投稿はキューに積み、書き込みスレッドが溜まった分を
+1トランザクションにまとめて書き込む（グループコミット）。リクエストは自分を含むバッチの
+コミットを待ってから応答するので、応答した時点でスコアは保存済み。
+
+ランキングは曲・難易度ごとに自己ベストを (−スコア, 達成時刻, プレイヤー) の昇順に並べた
+リストとしてメモリに持つ（参照・投稿のあった曲から順にLRUで保持）。上位N件はスライス、
+順位は二分探索で求める。
+"""
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+import chart_api
+from chart_api import NAME_PATTERN, ApiError, json_response
+
+DB_PATH = "scores.db"
+SUBMIT_PATH = "/api/scores"
+LEADERBOARD_PREFIX = "/api/leaderboard/"
+
+# game.js の PERFECT の点数（1ノーツあたりの上限）
+MAX_POINTS_PER_NOTE = 1000
+MAX_PLAYER_LENGTH = 32
+MAX_BODY_BYTES = 16 * 1024
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+# 1トランザクションにまとめる投稿の上限
+BATCH_MAX = 1000
+# メモリに保持するランキングのエントリ数の上限（全曲の合計）
+CACHE_MAX_ENTRIES = 1_000_000
+# 書き込みのコミットを待つ時間の上限
+SUBMIT_TIMEOUT = 10.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY,
+    song_id TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    player TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    max_combo INTEGER NOT NULL,
+    judgments TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scores_player ON scores (player, created_at);
+CREATE TABLE IF NOT EXISTS best_scores (
+    song_id TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    player TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    max_combo INTEGER NOT NULL,
+    achieved_at REAL NOT NULL,
+    PRIMARY KEY (song_id, difficulty, player)
+) WITHOUT ROWID;
+-- ランキングの読み込みが表を引かずに索引だけで済むよう max_combo も含める（player は主キーなので含まれる）
+CREATE INDEX IF NOT EXISTS best_scores_rank ON best_scores (song_id, difficulty, score DESC, achieved_at, max_combo);
+"""
+
+INSERT_SCORE = """
+INSERT INTO scores (song_id, difficulty, player, score, max_combo, judgments, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+# 自己ベストを超えたときだけ更新する
+UPSERT_BEST = """
+INSERT INTO best_scores (song_id, difficulty, player, score, max_combo, achieved_at)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (song_id, difficulty, player) DO UPDATE
+SET score = excluded.score, max_combo = excluded.max_combo, achieved_at = excluded.achieved_at
+WHERE excluded.score > best_scores.score
+"""
+SELECT_BOARD = """
+SELECT player, score, max_combo, achieved_at FROM best_scores
+WHERE song_id = ? AND difficulty = ?
+ORDER BY score DESC, achieved_at
+"""
+
+def connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WALではコミットごとのfsyncを省いても、電源断で失うのは直近のコミットだけでDBは壊れない
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+class Leaderboard:
+    """1曲・1難易度分の自己ベストのソート済みリスト"""
+    def __init__(self, rows):
+        self.keys = [(-score, achieved_at, player) for player, score, _, achieved_at in rows]
+        self.best = {player: (score, max_combo, achieved_at) for player, score, max_combo, achieved_at in rows}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def update(self, player, score, max_combo, achieved_at):
+        """自己ベストを超えていれば入れ替える（同じ投稿を2回適用しても結果は変わらない）"""
+        old = self.best.get(player)
+        if old is not None:
+            if score <= old[0]:
+                return
+            del self.keys[bisect_left(self.keys, (-old[0], old[2], player))]
+        insort(self.keys, (-score, achieved_at, player))
+        self.best[player] = (score, max_combo, achieved_at)
+
+    def rank(self, score):
+        """同点は同じ順位（自分より高いスコアの人数 + 1）"""
+        return bisect_left(self.keys, (-score,)) + 1
+
+    def top(self, limit):
+        entries = []
+        for _, achieved_at, player in self.keys[:limit]:
+            score, max_combo, _ = self.best[player]
+            entries.append({"rank": self.rank(score), "player": player, "score": score,
+                            "maxCombo": max_combo, "achievedAt": achieved_at})
+        return entries
+
+class PendingScore:
+    """書き込みスレッドに渡した投稿（コミットされるとresultかerrorが入る）"""
+    def __init__(self, row):
+        self.row = row
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class ScoreStore:
+    """SQLiteへのまとめ書きと、ランキングのメモリキャッシュ（スレッドセーフ）"""
+    def __init__(self, path=DB_PATH, cache_max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.cache_max_entries = cache_max_entries
+        self.writer = connect(path)
+        self.writer.executescript(SCHEMA)
+        # ランキングの読み込み用（self.lockを持っている間だけ使う）
+        self.reader = connect(path)
+        self.boards = OrderedDict()
+        self.lock = threading.Lock()
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write_loop, name="score-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, song_id, difficulty, player, score, max_combo=0, judgments=None):
+        """投稿がコミットされるまで待ち、自己ベストと順位を返す"""
+        row = (song_id, difficulty, player, score, max_combo,
+               json.dumps(judgments, separators=(",", ":")) if judgments is not None else None, time.time())
+        pending = PendingScore(row)
+        self.queue.put(pending)
+        if not pending.done.wait(SUBMIT_TIMEOUT):
+            raise TimeoutError("スコアの書き込みが時間内に終わりませんでした")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                return
+            # 前のコミット中に溜まった投稿をまとめて書き込む
+            while len(batch) < BATCH_MAX:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        rows = [pending.row for pending in batch]
+        try:
+            self.writer.execute("BEGIN IMMEDIATE")
+            self.writer.executemany(INSERT_SCORE, rows)
+            self.writer.executemany(UPSERT_BEST, [row[:5] + row[6:] for row in rows])
+            self.writer.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self.writer.in_transaction:
+                self.writer.execute("ROLLBACK")
+            for pending in batch:
+                pending.error = e
+                pending.done.set()
+            return
+
+        with self.lock:
+            for pending in batch:
+                song_id, difficulty, player, score, max_combo, _, created_at = pending.row
+                board = self._board(song_id, difficulty)
+                board.update(player, score, max_combo, created_at)
+                best = board.best[player]
+                pending.result = {
+                    "best": best[0],
+                    "newBest": best[2] == created_at,
+                    "rank": board.rank(best[0]),
+                    "total": len(board),
+                }
+            self._evict()
+        for pending in batch:
+            pending.done.set()
+
+    def _board(self, song_id, difficulty):
+        """self.lockを持った状態で呼ぶ。キャッシュになければインデックス順に読み込む"""
+        key = (song_id, difficulty)
+        board = self.boards.get(key)
+        if board is None:
+            board = Leaderboard(self.reader.execute(SELECT_BOARD, key).fetchall())
+            self.boards[key] = board
+        else:
+            self.boards.move_to_end(key)
+        return board
+
+    def _evict(self):
+        # 投稿で件数が増えるので、使い終わった後にまとめて数える
+        total = sum(len(board) for board in self.boards.values())
+        while total > self.cache_max_entries and len(self.boards) > 1:
+            _, old = self.boards.popitem(last=False)
+            total -= len(old)
+
+    def leaderboard(self, song_id, difficulty, limit=DEFAULT_LIMIT, player=None):
+        with self.lock:
+            board = self._board(song_id, difficulty)
+            result = {"songId": song_id, "difficulty": difficulty, "total": len(board), "top": board.top(limit)}
+            if player is not None:
+                best = board.best.get(player)
+                result["player"] = None if best is None else {
+                    "player": player, "rank": board.rank(best[0]), "score": best[0],
+                    "maxCombo": best[1], "achievedAt": best[2],
+                }
+            self._evict()
+        return result
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        self.reader.close()
+
+store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """初めて使うときにDBを開く（サーバーを起動しただけではscores.dbを作らない）"""
+    global store
+    with _store_lock:
+        if store is None:
+            store = ScoreStore()
+            atexit.register(store.close)
+        return store
+
+def parse_submission(body):
+    try:
+        data = json.loads(body)
+    except (UnicodeDecodeError, ValueError):
+        raise ApiError(400, "JSONを解析できません")
+    if not isinstance(data, dict):
+        raise ApiError(400, "JSONオブジェクトを送ってください")
+
+    song_id, difficulty = data.get("songId"), data.get("difficulty")
+    if not isinstance(song_id, str) or not NAME_PATTERN.match(song_id):
+        raise ApiError(400, "songIdが不正です")
+    if not isinstance(difficulty, str) or not NAME_PATTERN.match(difficulty.lower()):
+        raise ApiError(400, "difficultyが不正です")
+    player = data.get("player")
+    if not isinstance(player, str) or not player.strip() or len(player.strip()) > MAX_PLAYER_LENGTH \
+            or not player.isprintable():
+        raise ApiError(400, f"playerは{MAX_PLAYER_LENGTH}文字以内で指定してください")
+    score, max_combo = data.get("score"), data.get("maxCombo", 0)
+    for key, value in (("score", score), ("maxCombo", max_combo)):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ApiError(400, f"{key}は0以上の整数で指定してください")
+    judgments = data.get("judgments")
+    if judgments is not None and not (isinstance(judgments, dict) and
+                                      all(isinstance(v, int) for v in judgments.values())):
+        raise ApiError(400, "judgmentsは {判定: 回数} で指定してください")
+    return song_id, difficulty.lower(), player.strip(), score, max_combo, judgments
+
+def submit(body, charts=None):
+    song_id, difficulty, player, score, max_combo, judgments = parse_submission(body)
+    chart = (charts or chart_api.store).get(song_id, difficulty)
+    note_count = len(chart.times)
+    if score > note_count * MAX_POINTS_PER_NOTE or max_combo > note_count:
+        raise ApiError(400, "譜面のノーツ数から取りうる値を超えています")
+    try:
+        return get_store().submit(song_id, difficulty, player, score, max_combo, judgments)
+    except (sqlite3.Error, TimeoutError) as e:
+        raise ApiError(503, f"スコアを保存できませんでした: {e}")
+
+def respond_post(url, content_length, rfile):
+    """POST /api/scores の (ステータス, ヘッダーのdict, 本文のbytes) を返す。
+    411・413のときは本文を読んでいないので、呼び出し側で接続を閉じる"""
+    try:
+        body = rfile.read(chart_api.content_length(content_length, MAX_BODY_BYTES))
+        if urlsplit(url).path.rstrip("/") != SUBMIT_PATH:
+            raise ApiError(404, "不明なAPIです")
+        return json_response(201, submit(body))
+    except ApiError as e:
+        return json_response(e.status, {"error": str(e)})
+
+def parse_limit(query):
+    values = query.get("limit")
+    if not values:
+        return DEFAULT_LIMIT
+    try:
+        limit = int(values[0])
+    except ValueError:
+        raise ApiError(400, f"limitは整数で指定してください: {values[0]}")
+    return min(max(limit, 1), MAX_LIMIT)
+
+def respond_leaderboard(url):
+    """GET /api/leaderboard/<曲ID>/<難易度> の (ステータス, ヘッダーのdict, 本文のbytes) を返す"""
+    try:
+        parts = urlsplit(url)
+        names = parts.path[len(LEADERBOARD_PREFIX):].strip("/").split("/")
+        if len(names) != 2 or not all(NAME_PATTERN.match(name) for name in names):
+            raise ApiError(404, "不明なAPIです")
+        song_id, difficulty = names[0], names[1].lower()
+        # 存在しない曲のランキングをキャッシュに作らない
+        chart_api.store.get(song_id, difficulty)
+        query = parse_qs(parts.query)
+        player = query.get("player", [None])[0]
+        result = get_store().leaderboard(song_id, difficulty, parse_limit(query),
+                                         player.strip() if player else None)
+        return json_response(200, result)
+    except ApiError as e:
+        return json_response(e.status, {"error": str(e)})
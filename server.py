@@ -1,24 +1,201 @@
 #!/usr/bin/env python3
+"""
+ゲーム用のローカルHTTPサーバー
+スレッドで並行処理し、音楽ファイルのRange(206)リクエストとsendfileによる配信に対応
+譜面API（chart_api.py）・スコアとランキングのAPI（score_api.py）・譜面エディタからのアップロード（upload_api.py）も提供する
+"""
+import argparse
 import http.server
-import socketserver
 import os
+import re
+import time
+from urllib.parse import unquote
+
+import chart_api
+import instrument
+import score_api
+import upload_api
+from paths import root_dir
 
 PORT = 8000
 
+# "bytes=start-end" / "bytes=start-" / "bytes=-suffix" の単一レンジのみ対応
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # 1接続で複数リクエスト（チャート取得→音楽のシーク）を処理する
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーと本文を別々に送るので、keep-aliveで遅延ACK待ち（約40ms）にならないようにする
+    disable_nagle_algorithm = True
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Range')
+        self.send_header('Access-Control-Expose-Headers', 'Content-Range, Content-Length, Accept-Ranges')
+        self.send_header('Accept-Ranges', 'bytes')
         super().end_headers()
 
+    def handle_one_request(self):
+        if not instrument.modes:
+            return super().handle_one_request()
+        # 計測が有効なときだけ、リクエストごとの遅延・状態コード・送信バイト数を集計する
+        self.status = None
+        self.bytes_sent = 0
+        start = time.perf_counter()
+        super().handle_one_request()
+        if self.status is not None:
+            # リクエスト行が読めずにエラーを返したときは path・command が設定されていない
+            path = getattr(self, 'path', '')
+            route = f"{getattr(self, 'command', None)} {os.path.splitext(path.split('?', 1)[0])[1].lower() or '/'}"
+            instrument.server_stats.record(route, self.status, time.perf_counter() - start, self.bytes_sent)
+
+    def log_request(self, code='-', size='-'):
+        self.status = getattr(code, 'value', code)
+        super().log_request(code, size)
+
     def do_OPTIONS(self):
         self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        # URLデコードして日本語ファイル名を処理
+        self.path = unquote(self.path)
+        self.byte_range = None
+        self.etag = None
+        response = self.api_response()
+        if response is not None:
+            self.send_api_response(response, head=False)
+            return
+        super().do_GET()
+
+    def do_HEAD(self):
+        self.path = unquote(self.path)
+        self.byte_range = None
+        self.etag = None
+        response = self.api_response()
+        if response is not None:
+            self.send_api_response(response, head=True)
+            return
+        super().do_HEAD()
+
+    def do_POST(self):
+        """スコアの投稿（POST /api/scores）と記録データのアップロード（POST /api/uploads）"""
+        self.path = unquote(self.path)
+        self.etag = None
+        length = self.headers.get('Content-Length')
+        if self.path.startswith(upload_api.UPLOAD_PATH):
+            response = upload_api.respond_post(self.path, length, self.rfile)
+        else:
+            response = score_api.respond_post(self.path, length, self.rfile)
+        if response[0] in (411, 413):
+            # 本文を読み捨てていないので、続きを次のリクエストとして解釈しないよう接続を閉じる
+            self.close_connection = True
+            response[1]['Connection'] = 'close'
+        self.send_api_response(response, head=False)
+
+    def api_response(self):
+        """GET/HEADのAPIの応答（APIのパスでなければNone）"""
+        if self.path.startswith(chart_api.API_PREFIX):
+            return chart_api.respond(chart_api.store, self.path,
+                                     self.headers.get('Accept-Encoding'),
+                                     self.headers.get('If-None-Match'))
+        if self.path.startswith(score_api.LEADERBOARD_PREFIX):
+            return score_api.respond_leaderboard(self.path)
+        if self.path.startswith(upload_api.UPLOAD_PATH + "/"):
+            return upload_api.respond_status(self.path)
+        return None
+
+    def send_api_response(self, response, head):
+        """APIの (ステータス, ヘッダーのdict, 本文のbytes) を送る"""
+        status, headers, body = response
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        if not head and body:
+            self.wfile.write(body)
+            self.bytes_sent = len(body)
+
+    def send_head(self):
+        """Rangeヘッダーがあれば206で部分レスポンスを返す"""
+        range_header = self.headers.get('Range')
+        if range_header is None:
+            return super().send_head()
+
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return super().send_head()
+
+        match = RANGE_PATTERN.match(range_header.strip())
+        if (not match or match.group(1) == match.group(2) == '' or
+                (match.group(1) and match.group(2) and int(match.group(2)) < int(match.group(1)))):
+            # 複数レンジや不正な指定（終わりが始めより前など）は無視して全体を返す（RFC 7233）
+            return super().send_head()
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+
+        try:
+            fs = os.fstat(f.fileno())
+            size = fs.st_size
+            first, last = match.group(1), match.group(2)
+            if first == '':
+                # 末尾からnバイト
+                start = max(size - int(last), 0)
+                end = size - 1
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+
+            if start >= size or start > end:
+                f.close()
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+            self.send_response(206)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+            self.end_headers()
+            self.byte_range = (start, end - start + 1)
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile):
+        """ソケットへsendfileでゼロコピー転送（使えない環境では通常の送信にフォールバック）"""
+        offset, count = self.byte_range or (0, None)
+        outputfile.flush()
+        self.bytes_sent = self.connection.sendfile(source, offset, count)
+
+def run(port=PORT, handler=MyHTTPRequestHandler):
+    # APIの譜面・アップロード先はプロジェクトのディレクトリからの相対パス
+    os.chdir(root_dir())
+
+    with http.server.ThreadingHTTPServer(("", port), handler) as httpd:
+        print(f"サーバーを起動しました: http://localhost:{port}")
+        print("Ctrl+C で終了します")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\nサーバーを停止しています...")
 
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
+def main():
+    parser = argparse.ArgumentParser(description="ゲームと譜面・スコアAPIを配信する開発用サーバーを起動する")
+    parser.add_argument("--port", type=int, default=PORT, help=f"待ち受けるポート（既定: {PORT}）")
+    args = parser.parse_args()
+    run(args.port)
 
-with socketserver.TCPServer(("", PORT), MyHTTPRequestHandler) as httpd:
-    print(f"サーバーを起動しました: http://localhost:{PORT}")
-    print("Ctrl+C で終了します")
-    httpd.serve_forever()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
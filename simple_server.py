@@ -1,36 +1,195 @@
 #!/usr/bin/env python3
-import http.server
-import socketserver
+"""
+開発用の高速サーバー
+ETag/Last-Modifiedによる条件付きリクエスト(304)と、譜面JSONの圧縮配信に対応
+"""
+import argparse
+import gzip
+import hashlib
+import io
 import os
-from urllib.parse import unquote
+import threading
+from collections import OrderedDict
+
+import instrument
+from chart_api import coded_etag, etag_matches, parse_accept_encoding
+from server import MyHTTPRequestHandler, run
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 PORT = 8001
 
-class FastHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+# 圧縮済みボディを保持するメモリ上限
+BODY_CACHE_BYTES = 32 * 1024 * 1024
+
+# 対応する圧縮形式（優先順）と、ディスク上の事前圧縮ファイルの拡張子
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")] if brotli else [("gzip", ".gz")]
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return data
+
+class CachedBody:
+    """1ファイル分の本文・強いETag・圧縮済みバリアント"""
+    def __init__(self, path, stat, data):
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.etag = '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+        self.variants = {"identity": data}
+
+    def nbytes(self):
+        return sum(len(body) for body in self.variants.values())
+
+    def build_variant(self, encoding, suffix):
+        """encodingの本文を作る（self.variantsには入れない。呼び出し側でロックを取って入れる）"""
+        precompressed = self.path + suffix
+        try:
+            # 元ファイルより新しい事前圧縮ファイルがあればそれを使う
+            if os.stat(precompressed).st_mtime_ns >= self.mtime_ns:
+                with open(precompressed, 'rb') as f:
+                    return f.read()
+        except OSError:
+            pass
+        return compress(self.variants["identity"], encoding)
+
+class BodyCache:
+    """mtimeが変わると無効化されるLRUキャッシュ（スレッドセーフ）"""
+    def __init__(self, max_bytes=BODY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, stat):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                self.entries.move_to_end(path)
+                if instrument.modes:
+                    instrument.server_stats.count("body_cache.hit")
+                return entry
+
+        if instrument.modes:
+            instrument.server_stats.count("body_cache.miss")
+        with open(path, 'rb') as f:
+            entry = CachedBody(path, stat, f.read())
+        self.store(entry)
+        return entry
+
+    def variant(self, entry, encoding, suffix):
+        with self.lock:
+            body = entry.variants.get(encoding)
+        if body is not None:
+            return body
+        # 圧縮は時間がかかるのでロックの外で行い、他のスレッドの配信を止めない
+        body = entry.build_variant(encoding, suffix)
+        with self.lock:
+            # 同時に同じ本文を作ったスレッドがあれば、先に入れた方を使う（合計サイズを二重に数えない）
+            if encoding in entry.variants:
+                return entry.variants[encoding]
+            entry.variants[encoding] = body
+            if self.entries.get(entry.path) is entry:
+                self.total += len(body)
+                self.evict()
+        return body
+
+    def store(self, entry):
+        with self.lock:
+            old = self.entries.pop(entry.path, None)
+            if old is not None:
+                self.total -= old.nbytes()
+            self.entries[entry.path] = entry
+            self.total += entry.nbytes()
+            self.evict()
+
+    def evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.total -= old.nbytes()
+
+body_cache = BodyCache()
+
+class FastHTTPRequestHandler(MyHTTPRequestHandler):
     def end_headers(self):
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        # no-cacheは「毎回ETagで再検証する」という意味なので304と組み合わせて使う
         self.send_header('Cache-Control', 'no-cache')
+        if getattr(self, 'etag', None):
+            self.send_header('ETag', self.etag)
         super().end_headers()
 
-    def do_GET(self):
-        # URLデコードして日本語ファイル名を処理
-        self.path = unquote(self.path)
-        super().do_GET()
-    
+    def send_head(self):
+        self.etag = None
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        stat = os.stat(path)
+
+        if not path.endswith('.json'):
+            # 音楽ファイルなど大きいファイルは内容を読まずmtimeとサイズからETagを作る
+            self.etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            if self.not_modified():
+                return None
+            return super().send_head()
+
+        entry = body_cache.get(path, stat)
+        # 範囲リクエストは圧縮しない元のファイルから返す
+        encoding, suffix = ("identity", None) if 'Range' in self.headers else self.negotiate_encoding()
+        self.etag = coded_etag(entry.etag, encoding)
+        if self.not_modified():
+            return None
+        if 'Range' in self.headers:
+            return super().send_head()
+        return self.send_json_head(path, entry, encoding, suffix)
+
+    def negotiate_encoding(self):
+        """(圧縮形式, 事前圧縮ファイルの拡張子)。圧縮しないときは ("identity", None)"""
+        accepted = parse_accept_encoding(self.headers.get('Accept-Encoding'))
+        for name, suffix in ENCODINGS:
+            if name in accepted:
+                return name, suffix
+        return "identity", None
+
+    def send_json_head(self, path, entry, encoding, suffix):
+        if encoding == "identity":
+            body = entry.variants["identity"]
+        else:
+            body = body_cache.variant(entry, encoding, suffix)
+
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        if encoding != "identity":
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified', self.date_time_string(entry.mtime))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def not_modified(self):
+        header = self.headers.get('If-None-Match')
+        if header is None or not etag_matches(header, self.etag):
+            return False
+        self.send_response(304)
+        self.end_headers()
+        return True
+
     def log_message(self, format, *args):
         # ログを簡潔に
         print(f"{self.address_string()} - {format % args}")
 
+def main():
+    parser = argparse.ArgumentParser(description="圧縮・キャッシュ付きの静的ファイルサーバーを起動する")
+    parser.add_argument("--port", type=int, default=PORT, help=f"待ち受けるポート（既定: {PORT}）")
+    args = parser.parse_args()
+    run(args.port, FastHTTPRequestHandler)
+
 if __name__ == "__main__":
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
-    
-    with socketserver.TCPServer(("", PORT), FastHTTPRequestHandler) as httpd:
-        print(f"高速サーバーを起動: http://localhost:{PORT}")
-        print("Ctrl+C で終了")
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\nサーバーを停止しています...")
-            httpd.shutdown()
\ No newline at end of file
+    main()
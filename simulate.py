@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+判定のヘッドレスシミュレーター（ブラウザなしで譜面を大量に試しプレイする）
+
+js/game.js と同じ判定窓・同じ対応付けで、入力（合成プレイヤーか記録した押下）を譜面に当てる。
+- 押下は同じレーンの「まだ判定していない、時刻差が POOR の窓以内の最初のノーツ」に対応付ける
+  （game.js の this.notes.find(...)。ここではレーンごとに時刻順に並べた列の先頭を指す位置で求める）
+- 窓を過ぎても押されなかったノーツは POOR（見逃し）。POOR はコンボを切る
+- 押せるのは game.js の keyMap にあるレーン（0〜5）だけ。time/lane が数値でないノーツは
+  game.js では判定も見逃しもされないので、どちらにも数えない
+
+1回の判定で多数のプレイ（行）をまとめて進めるので、押下1回あたりの処理はNumPyの配列演算数回で済む。
+さらにプレイを BATCH_PLAYS 回ずつに分けてプロセスプールで並列に実行する（乱数は SeedSequence から
+バッチごとに分けるので、並列数を変えても結果は同じ）。
+
+合成プレイヤーは「打鍵のずれの標準偏差」と「速さ（毎秒何ノーツまで押せるか）」を持つ。周りの密度が速さを
+超えたノーツは超えた割合で押し損ね、同じキーを REPEAT_LIMIT より短い間隔では押せない。
+難易度は、LEVELS の各段階のプレイヤーでクリア率（判定のうち POOR 以外が CLEAR_ACCURACY 以上の割合）が
+半分を超える最も低い段階とする（押せないノーツは除く）。
+
+使い方:
+    python simulate.py assets/charts/gozen4ji_*.json                # 難易度の推定と押せないノーツの一覧
+    python simulate.py assets/charts/gozen4ji_hyper.json --level 8 --plays 5000
+    python simulate.py assets/charts/gozen4ji_hyper.json --input presses.json   # 記録した押下を再生
+"""
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# game.js の judgmentTiming と得点（窓は時刻差の絶対値の上限、小さい順）
+JUDGMENTS = ("PERFECT", "GREAT", "GOOD", "BAD", "POOR")
+JUDGMENT_WINDOWS = np.array([0.08, 0.12, 0.18, 0.25, 0.35])
+JUDGMENT_POINTS = np.array([1000, 800, 500, 200, 50, 0])
+POOR_WINDOW = float(JUDGMENT_WINDOWS[-1])
+POOR = JUDGMENTS.index("POOR")
+# 見逃し（判定の列ではPOORの次の番号、得点0）
+MISS = len(JUDGMENTS)
+# game.js の keyMap（a s d g h j）で押せるレーン
+KEY_LANES = frozenset(range(6))
+# 同じキーを続けて押せる最短の間隔（秒）
+REPEAT_LIMIT = 0.06
+# プレイヤーが周りの密度を数える幅（秒）
+DENSITY_WINDOW = 1.0
+
+# 難易度の段階（レベル → 速さ[ノーツ/秒]・打鍵のずれの標準偏差[秒]）
+LEVELS = {level: (1.5 * 1.25 ** (level - 1), 0.09 * 0.88 ** (level - 1)) for level in range(1, 13)}
+CLEAR_ACCURACY = 0.8
+ESTIMATE_PLAYS = 256
+BATCH_PLAYS = 256
+DEFAULT_PLAYS = 1000
+
+def load_notes(chart):
+    """譜面のノーツを (時刻, レーン, 判定されるか) の配列にする（時刻・レーンが数値でないノーツは判定されない）"""
+    notes = chart.get("notes", [])
+    valid = np.array([type(note.get("time")) in (int, float) and type(note.get("lane")) is int
+                      for note in notes], dtype=bool)
+    times = np.array([note["time"] if ok else np.nan for note, ok in zip(notes, valid)], dtype=np.float64)
+    lanes = np.array([note["lane"] if ok else -1 for note, ok in zip(notes, valid)], dtype=np.int64)
+    return times, lanes, valid & np.isfinite(times)
+
+def find_unhittable(times, lanes, judged):
+    """押せないノーツ（番号のリスト）を理由ごとに返す
+
+    - malformed: time/laneが数値でない（game.jsでは判定されない）
+    - no_key: 押すキーのないレーン
+    - repeat: 同じレーンの前のノーツから REPEAT_LIMIT 未満（続けて押せない）
+    - overlap: 同じレーンの前のノーツから POOR の窓以内（後のノーツをちょうどに押しても、前のノーツが
+      残っていればそちらに判定される。押せなくはないので警告）
+    """
+    keyed = judged & np.isin(lanes, list(KEY_LANES))
+    index = np.flatnonzero(keyed)
+    order = index[np.lexsort((times[index], lanes[index]))]
+    same_lane = lanes[order][1:] == lanes[order][:-1]
+    gap = np.diff(times[order])
+    return {
+        "malformed": np.flatnonzero(~judged).tolist(),
+        "no_key": np.flatnonzero(judged & ~keyed).tolist(),
+        "repeat": sorted(order[1:][same_lane & (gap < REPEAT_LIMIT)].tolist()),
+        "overlap": sorted(order[1:][same_lane & (gap >= REPEAT_LIMIT) & (gap <= POOR_WINDOW)].tolist()),
+    }
+
+def judge_lane(note_times, presses):
+    """1レーン分の判定。note_times は時刻順、presses は (プレイ数, 押下数) の押下時刻（行ごとに昇順、空きはNaN）
+
+    戻り値は (判定番号, 判定した時刻) でどちらも (プレイ数, ノーツ数)。見逃しは MISS で、時刻は窓を過ぎた時点
+    """
+    plays, count = presses.shape[0], len(note_times)
+    grades = np.full((plays, count), MISS, dtype=np.int8)
+    events = np.broadcast_to(note_times + POOR_WINDOW, (plays, count)).copy()
+    if count == 0:
+        return grades, events
+    pointer = np.zeros(plays, dtype=np.int64)
+    rows = np.arange(plays)
+    for column in presses.T:
+        pressed = ~np.isnan(column)
+        if not pressed.any():
+            break
+        # 窓を過ぎたノーツは見逃しなので飛ばす（先頭を窓の始まり以降の最初のノーツまで進める）
+        earliest = np.searchsorted(note_times, column - POOR_WINDOW, side="left")
+        pointer = np.where(pressed, np.maximum(pointer, earliest), pointer)
+        target = np.minimum(pointer, count - 1)
+        diff = np.abs(column - note_times[target])
+        hit = pressed & (pointer < count) & (diff <= POOR_WINDOW)
+        grades[rows[hit], target[hit]] = np.searchsorted(JUDGMENT_WINDOWS, diff[hit], side="left")
+        events[rows[hit], target[hit]] = column[hit]
+        pointer += hit
+    return grades, events
+
+def max_combo(grades, events):
+    """判定した時刻の順に並べたときの、POOR・見逃しを挟まない最長の連続数（プレイごと）"""
+    if grades.shape[1] == 0:
+        return np.zeros(len(grades), dtype=np.int64)
+    ordered = np.take_along_axis(grades, np.argsort(events, axis=1, kind="stable"), axis=1)
+    position = np.arange(ordered.shape[1])
+    last_break = np.maximum.accumulate(np.where(ordered >= POOR, position, -1), axis=1)
+    return (position - last_break).max(axis=1)
+
+def player_presses(rng, note_times, density, plays, speed, timing_sd, bias=0.0):
+    """合成プレイヤーの押下（1レーン分、(プレイ数, ノーツ数)、行ごとに昇順、押さなかった所はNaN）"""
+    count = len(note_times)
+    presses = note_times + bias + timing_sd * rng.standard_normal((plays, count))
+    # 周りの密度が速さを超えた分だけ押し損ねる
+    drop = np.clip(1.0 - speed / np.maximum(density, 1e-9), 0.0, 1.0)
+    presses[rng.random((plays, count)) < drop] = np.nan
+    presses.sort(axis=1)
+    # 同じキーを REPEAT_LIMIT 未満で続けて押した分は1回にまとめる
+    too_fast = np.zeros_like(presses, dtype=bool)
+    too_fast[:, 1:] = np.diff(presses, axis=1) < REPEAT_LIMIT
+    if too_fast.any():
+        presses[too_fast] = np.nan
+        presses.sort(axis=1)
+    return presses
+
+def local_density(times):
+    """各ノーツの前後 DENSITY_WINDOW/2 秒に入るノーツ数（毎秒）"""
+    ordered = np.sort(times)
+    half = DENSITY_WINDOW / 2
+    return (np.searchsorted(ordered, times + half, side="right")
+            - np.searchsorted(ordered, times - half, side="left")) / DENSITY_WINDOW
+
+def simulate_plays(times, lanes, judged, plays, rng=None, speed=None, timing_sd=None, presses=None):
+    """plays回分のプレイを判定して、(判定番号, 判定した時刻) を (プレイ数, 判定されるノーツ数) で返す
+
+    presses（レーン → (プレイ数, 押下数) の押下時刻）を渡すとそれを使い、なければ合成プレイヤーで作る
+    """
+    index = np.flatnonzero(judged)
+    times, lanes = times[index], lanes[index]
+    grades = np.full((plays, len(index)), MISS, dtype=np.int8)
+    events = np.broadcast_to(times + POOR_WINDOW, (plays, len(index))).copy()
+    keyed = np.isin(lanes, list(KEY_LANES))
+    density = local_density(times[keyed])
+    for lane in sorted(KEY_LANES):
+        in_lane = np.flatnonzero(lanes == lane)
+        order = in_lane[np.argsort(times[in_lane], kind="stable")]
+        if presses is None:
+            lane_density = density[np.searchsorted(np.flatnonzero(keyed), order)]
+            lane_presses = player_presses(rng, times[order], lane_density, plays, speed, timing_sd)
+        else:
+            lane_presses = presses.get(lane, np.empty((plays, 0)))
+        grades[:, order], events[:, order] = judge_lane(times[order], lane_presses)
+    return grades, events
+
+def summarize(grades, events, note_count):
+    """プレイごとの判定から、判定の分布・得点・コンボ・クリア率を集計する（note_countは満点の計算に使う）"""
+    plays = len(grades)
+    counts = np.stack([(grades == code).sum(axis=1) for code in range(MISS + 1)], axis=1)
+    scores = JUDGMENT_POINTS[grades].sum(axis=1) if grades.size else np.zeros(plays, dtype=np.int64)
+    accuracy = (grades < POOR).sum(axis=1) / max(grades.shape[1], 1)
+    return {
+        "plays": plays,
+        "counts": counts.sum(axis=0),
+        "scores": scores,
+        "combos": max_combo(grades, events),
+        "clears": int((accuracy >= CLEAR_ACCURACY).sum()),
+        "miss_by_note": (grades >= POOR).sum(axis=0),
+        "max_score": note_count * int(JUDGMENT_POINTS[0]),
+    }
+
+def merge_summaries(parts):
+    return {
+        "plays": sum(part["plays"] for part in parts),
+        "counts": sum(part["counts"] for part in parts),
+        "scores": np.concatenate([part["scores"] for part in parts]),
+        "combos": np.concatenate([part["combos"] for part in parts]),
+        "clears": sum(part["clears"] for part in parts),
+        "miss_by_note": sum(part["miss_by_note"] for part in parts),
+        "max_score": parts[0]["max_score"],
+    }
+
+def _simulate_batch(args):
+    times, lanes, judged, plays, seed, speed, timing_sd = args
+    rng = np.random.default_rng(seed)
+    grades, events = simulate_plays(times, lanes, judged, plays, rng, speed, timing_sd)
+    return summarize(grades, events, int(judged.sum()))
+
+def batches(times, lanes, judged, plays, seed, speed, timing_sd):
+    counts = [BATCH_PLAYS] * (plays // BATCH_PLAYS) + ([plays % BATCH_PLAYS] if plays % BATCH_PLAYS else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+    return [(times, lanes, judged, count, child, speed, timing_sd) for count, child in zip(counts, seeds)]
+
+def run_batches(jobs, executor=None):
+    results = list(executor.map(_simulate_batch, jobs)) if executor else [_simulate_batch(job) for job in jobs]
+    return merge_summaries(results)
+
+def playable(times, lanes, judged):
+    """難易度の推定に使うノーツ（押せないノーツを除く）"""
+    unhittable = find_unhittable(times, lanes, judged)
+    mask = judged.copy()
+    for reason in ("malformed", "no_key", "repeat"):
+        mask[unhittable[reason]] = False
+    return mask
+
+def clear_rate(times, lanes, judged, level, plays=ESTIMATE_PLAYS, seed=0, executor=None):
+    speed, timing_sd = LEVELS[level]
+    summary = run_batches(batches(times, lanes, judged, plays, seed, speed, timing_sd), executor)
+    return summary["clears"] / summary["plays"]
+
+def estimate_level(times, lanes, judged, plays=ESTIMATE_PLAYS, seed=0, executor=None):
+    """クリア率が半分を超える最も低いレベル（最高レベルでも超えなければNone）
+
+    クリア率はレベルが上がるほど高くなるので、二分探索で数段階だけ試す
+    """
+    judged = playable(times, lanes, judged)
+    if not judged.any():
+        return None
+    levels = sorted(LEVELS)
+    low, high = 0, len(levels)
+    while low < high:
+        middle = (low + high) // 2
+        if clear_rate(times, lanes, judged, levels[middle], plays, seed, executor) >= 0.5:
+            high = middle
+        else:
+            low = middle + 1
+    return levels[low] if low < len(levels) else None
+
+def load_presses(path):
+    """記録した押下（{"presses": [{"time", "lane"}, ...]} か [[time, lane], ...]）をレーンごとの (1, 押下数) にする"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data["presses"]
+    pairs = [(item["time"], item["lane"]) if isinstance(item, dict) else tuple(item) for item in data]
+    presses = {}
+    for lane in sorted(KEY_LANES):
+        lane_times = sorted(float(time) for time, press_lane in pairs if press_lane == lane)
+        presses[lane] = np.array([lane_times], dtype=np.float64).reshape(1, -1)
+    return presses
+
+def simulate_chart(chart, plays=DEFAULT_PLAYS, level=None, seed=0, estimate=True, presses=None, executor=None):
+    """1譜面分の結果（判定の分布・得点・押せないノーツ・推定難易度）をまとめる"""
+    times, lanes, judged = load_notes(chart)
+    unhittable = find_unhittable(times, lanes, judged)
+    result = {
+        "noteCount": len(times),
+        "unhittable": {reason: len(index) for reason, index in unhittable.items()},
+        "unhittableNotes": {reason: [{"index": i, "time": float(times[i]), "lane": int(lanes[i])}
+                                     for i in index[:20]]
+                            for reason, index in unhittable.items() if reason != "malformed" and index},
+        "level": (chart.get("difficulty") or {}).get("level"),
+    }
+    if estimate:
+        result["estimatedLevel"] = estimate_level(times, lanes, judged, seed=seed, executor=executor)
+
+    if presses is not None:
+        grades, events = simulate_plays(times, lanes, judged, 1, presses=presses)
+        summary = summarize(grades, events, int(judged.sum()))
+    else:
+        level = level or result["level"] or result.get("estimatedLevel") or max(LEVELS)
+        speed, timing_sd = LEVELS[min(max(level, min(LEVELS)), max(LEVELS))]
+        summary = run_batches(batches(times, lanes, judged, plays, seed, speed, timing_sd), executor)
+        result["playerLevel"] = level
+    result.update(report_summary(summary, times[judged], lanes[judged]))
+    return result
+
+def report_summary(summary, times, lanes):
+    plays = summary["plays"]
+    names = JUDGMENTS + ("MISS",)
+    counts = summary["counts"].copy()
+    counts[POOR] += counts[MISS]
+    scores = summary["scores"]
+    misses = summary["miss_by_note"] / plays
+    hardest = np.argsort(-misses, kind="stable")[:5]
+    return {
+        "plays": plays,
+        # game.js と同じく見逃しもPOORに数える（MISS はその内訳）
+        "judgments": {name: round(float(count) / plays, 2) for name, count in zip(names, counts)},
+        "score": {"mean": round(float(scores.mean()), 1), "min": int(scores.min()), "max": int(scores.max()),
+                  "rate": round(float(scores.mean()) / max(summary["max_score"], 1), 4)},
+        "maxCombo": {"mean": round(float(summary["combos"].mean()), 1), "max": int(summary["combos"].max())},
+        "clearRate": round(summary["clears"] / plays, 4),
+        "hardestNotes": [{"time": float(times[i]), "lane": int(lanes[i]), "missRate": round(float(misses[i]), 3)}
+                         for i in hardest if misses[i] > 0],
+    }
+
+def print_result(name, result):
+    label = f"レベル{result['level']}" if result["level"] is not None else "レベルなし"
+    estimated = result.get("estimatedLevel", "-")
+    print(f"{name}: {result['noteCount']}ノーツ / {label} / 推定レベル {estimated if estimated else '判定不能'}")
+    judgments = dict(result["judgments"])
+    missed = judgments.pop("MISS")
+    counts = " ".join(f"{name} {count}" for name, count in judgments.items()) + f"（うち見逃し {missed}）"
+    player = f"レベル{result['playerLevel']}のプレイヤー" if "playerLevel" in result else "記録した押下"
+    print(f"  {player}で{result['plays']}回: {counts}")
+    print(f"  得点 平均{result['score']['mean']}（{result['score']['rate']:.1%}） 最大コンボ 平均{result['maxCombo']['mean']} "
+          f"/ クリア率 {result['clearRate']:.1%}")
+    reasons = {"malformed": "形式不正", "no_key": "キーのないレーン", "repeat": "連打の限界以下の間隔",
+               "overlap": "前のノーツのPOORの窓の中（警告）"}
+    for reason, count in result["unhittable"].items():
+        if count:
+            print(f"  {reasons[reason]}: {count}ノーツ")
+            for note in result["unhittableNotes"].get(reason, [])[:3]:
+                print(f"    #{note['index']} {note['time']:.3f}秒 レーン{note['lane']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="譜面を game.js と同じ判定で試しプレイして集計する")
+    parser.add_argument("paths", nargs="+", help="譜面ファイル（globパターン可）")
+    parser.add_argument("--plays", type=int, default=DEFAULT_PLAYS, help="1譜面あたりのプレイ回数")
+    parser.add_argument("--level", type=int, choices=sorted(LEVELS),
+                        help="合成プレイヤーのレベル（既定は譜面のレベル、なければ推定レベル）")
+    parser.add_argument("--input", help="記録した押下のJSON（指定すると合成プレイヤーの代わりに使う）")
+    parser.add_argument("--no-estimate", action="store_true", help="難易度を推定しない")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--workers", type=int, help="並列プロセス数")
+    parser.add_argument("--json", help="結果をJSONで書き出す先")
+    args = parser.parse_args()
+
+    presses = load_presses(args.input) if args.input else None
+    paths = sorted({path for pattern in args.paths for path in (glob.glob(pattern) or [pattern])})
+    results = {}
+    with ProcessPoolExecutor(max_workers=args.workers or os.cpu_count() or 1) as executor:
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                chart = json.load(f)
+            if "notes" not in chart:
+                continue
+            results[path] = simulate_chart(chart, args.plays, args.level, args.seed, not args.no_estimate,
+                                           presses, executor)
+            print_result(path, results[path])
+    if args.json:
+        from chart_transform import write_json_atomic
+        write_json_atomic(args.json, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+曲の構成（イントロ・Aメロ・サビなど）の自動推定
+
+analyze.py が1回のSTFTから求めたクロマ・MFCC・RMSを拍ごとに平均し（ビート同期）、
+拍どうしの自己類似度から Foote のチェッカーボードカーネルで「前後で音が変わる度合い」（ノベルティ）を求め、
+その山を区間の境界にする。自己類似度は対角付近の帯（±KERNEL_BEATS拍）しか計算しないので、
+計算量・メモリは拍数に比例する（1時間の曲でも拍数×拍数の行列は作らない）。
+
+区間ごとの密度は平均音量から DENSITY_RANGE の範囲に割り当て、名前（intro / verse / chorus / bridge / outro）は
+位置と密度から付ける。結果は分析結果（analysis_cache）に保存されるので、譜面を作り直すときは再計算しない。
+
+使い方:
+    python structure.py assets/sounds/gozen4ji.mp3
+"""
+import argparse
+
+import numpy as np
+
+# ノベルティのカーネルの片側の拍数と、区間の最短の拍数
+KERNEL_BEATS = 16
+MIN_SECTION_BEATS = 16
+# 境界は小節（4拍）の頭に揃える
+BAR_BEATS = 4
+# ノベルティの山のうち、標準偏差のこの倍数以上突き出たものを境界にする
+PEAK_PROMINENCE = 0.5
+# 区間の密度の範囲（最も静かな区間〜最も大きい区間）
+DENSITY_RANGE = (0.3, 1.0)
+# サビ・ブリッジとみなす密度
+CHORUS_DENSITY = 0.75
+BRIDGE_DENSITY = 0.45
+
+def fill_beats(beat_frames, frames):
+    """拍の列を、拍の間隔の中央値で曲の最初と最後まで延ばす
+
+    beat_trackは静かなイントロ・アウトロの拍を省くので、そのままだと曲の端が1つの列にまとまってしまう
+    """
+    beats = np.unique(np.asarray(beat_frames, dtype=np.int64))
+    if len(beats) < 2:
+        return beats
+    interval = max(int(np.median(np.diff(beats))), 1)
+    before = np.arange(beats[0] - interval, 0, -interval)[::-1]
+    after = np.arange(beats[-1] + interval, frames, interval)
+    return np.concatenate([before, beats, after])
+
+def beat_sync(features, beat_frames):
+    """フレームごとの特徴量 (次元, フレーム数) を拍の区切りごとに平均する
+
+    列0は最初の拍より前、列j（j≥1）はj-1番目の拍から次の拍まで。戻り値は (次元, 拍数+1)
+    """
+    features = np.atleast_2d(np.asarray(features, dtype=np.float64))
+    frames = features.shape[1]
+    bounds = np.concatenate([[0], np.clip(np.asarray(beat_frames, dtype=np.int64), 0, frames), [frames]])
+    starts = np.minimum(bounds[:-1], max(frames - 1, 0))
+    counts = np.diff(bounds)
+    sums = np.add.reduceat(features, starts, axis=1) if frames else np.zeros((len(features), len(starts)))
+    # 空の区切り（拍が重なった・曲の終わりより後）はreduceatが隣の値を返すので0にする
+    sums[:, counts <= 0] = 0.0
+    return sums / np.maximum(counts, 1)
+
+def band_similarity(features, width):
+    """列どうしのコサイン類似度のうち、差が1〜width-1のものだけを返す。sim[d][i] は列iと列i+dの類似度"""
+    normalized = features - features.mean(axis=1, keepdims=True)
+    normalized /= np.maximum(normalized.std(axis=1, keepdims=True), 1e-9)
+    normalized /= np.maximum(np.linalg.norm(normalized, axis=0, keepdims=True), 1e-9)
+    count = normalized.shape[1]
+    return [None] + [np.einsum("ij,ij->j", normalized[:, :count - d], normalized[:, d:]) for d in range(1, width)]
+
+def novelty(features, half_width=KERNEL_BEATS):
+    """各列の前後half_width列ずつで、同じ側どうしの平均類似度 − 反対側どうしの平均類似度
+
+    チェッカーボードカーネル（重みは一様）と自己類似度行列の相関を、対角からの差ごとの
+    累積和で求める。両側がそろわない曲の端は0
+    """
+    count = features.shape[1]
+    result = np.zeros(count)
+    if count < 2 * half_width + 1:
+        return result
+    sims = band_similarity(features, 2 * half_width)
+    centers = np.arange(half_width, count - half_width + 1)
+    within = np.zeros(len(centers))
+    cross = np.zeros(len(centers))
+    for d in range(1, 2 * half_width):
+        prefix = np.concatenate([[0.0], np.cumsum(sims[d])])
+
+        def window_sum(lo, hi):
+            # 中心iに対して、ペアの左端が i+lo 〜 i+hi-1 のものの類似度の和
+            if hi <= lo:
+                return 0.0
+            return prefix[centers + hi] - prefix[centers + lo]
+        # 両方とも前側: a < a+d < 0、反対側: a < 0 <= a+d、両方とも後側: 0 <= a < a+d < half_width
+        within += window_sum(-half_width, -d) if d < half_width else 0.0
+        within += window_sum(0, half_width - d) if d < half_width else 0.0
+        cross += window_sum(max(-d, -half_width), min(0, half_width - d))
+    result[centers] = within / (half_width * (half_width - 1)) - cross / (half_width * half_width)
+    return result
+
+def find_boundaries(curve, min_beats=MIN_SECTION_BEATS, bar_beats=BAR_BEATS):
+    """ノベルティの山を境界（列番号、小節の頭に揃える）にする"""
+    from scipy.signal import find_peaks
+    if not np.any(curve > 0):
+        return []
+    peaks, _ = find_peaks(curve, distance=min_beats, prominence=PEAK_PROMINENCE * curve.std())
+    # 列0は最初の拍より前なので、拍番号 = 列番号 - 1 を小節の頭に揃える
+    snapped = np.unique(np.rint((peaks - 1) / bar_beats).astype(np.int64) * bar_beats + 1)
+    boundaries = []
+    for column in snapped.tolist():
+        if column >= min_beats and len(curve) - column >= min_beats and \
+                (not boundaries or column - boundaries[-1] >= min_beats):
+            boundaries.append(column)
+    return boundaries
+
+def section_densities(energy, starts):
+    """区間ごとの平均音量（dB）を DENSITY_RANGE に割り当てる"""
+    ends = np.append(starts[1:], len(energy))
+    level = np.array([20 * np.log10(max(float(energy[s:e].mean()), 1e-6)) for s, e in zip(starts, ends)])
+    low, high = DENSITY_RANGE
+    if level.max() - level.min() < 1e-6:
+        return np.full(len(starts), (low + high) / 2)
+    return low + (high - low) * (level - level.min()) / (level.max() - level.min())
+
+def analyze_structure(frame_features, rms, beat_frames, frame_seconds):
+    """フレームごとの特徴量（クロマ・MFCCなど）とRMSから、分析結果に保存する構成の情報を求める
+
+    戻り値は {"beat_features": ビート同期の特徴量（最後の行がRMS, float32）, "beat_feature_times": 各列の開始時刻,
+    "section_starts": 区間の開始時刻（秒）, "section_density": 区間の密度}
+    """
+    features = np.vstack([frame_features, np.atleast_2d(rms)])
+    beats = fill_beats(beat_frames, features.shape[1])
+    beat_features = beat_sync(features, beats)
+    column_times = np.concatenate([[0.0], beats * frame_seconds])
+    return dict(segment_beats(beat_features, column_times), beat_features=beat_features.astype(np.float32),
+                beat_feature_times=column_times.tolist())
+
+def segment_beats(beat_features, column_times):
+    """ビート同期の特徴量（最後の行がRMS）と各列の開始時刻から、区間の開始時刻と密度を求める"""
+    beat_features = np.asarray(beat_features, dtype=np.float64)
+    column_times = np.asarray(column_times, dtype=np.float64)
+    starts = np.array([0] + find_boundaries(novelty(beat_features)), dtype=np.int64)
+    density = section_densities(beat_features[-1], starts)
+    return {"section_starts": column_times[starts].tolist(), "section_density": density.tolist()}
+
+def label_sections(starts, density, duration):
+    """区間に create_chart.STRUCTURE と同じ形の名前を付ける（{"name", "start", "end", "density"} のリスト）
+
+    最初と最後の区間は、他より静かならintro/outro。残りは密度の高い区間をchorus、
+    低い区間をbridge、その他をverseとして出現順に番号を付ける
+    """
+    starts = list(starts)
+    ends = starts[1:] + [duration]
+    middle = density[1:-1] if len(density) > 2 else density
+    quiet = float(np.median(middle)) if len(middle) else 1.0
+    counts = {}
+    sections = []
+    for i, (start, end, value) in enumerate(zip(starts, ends, density)):
+        if len(starts) > 2 and i == 0 and value < quiet:
+            name = "intro"
+        elif len(starts) > 2 and i == len(starts) - 1 and value < quiet:
+            name = "outro"
+        else:
+            kind = "chorus" if value >= CHORUS_DENSITY else "bridge" if value <= BRIDGE_DENSITY else "verse"
+            counts[kind] = counts.get(kind, 0) + 1
+            name = f"{kind}{counts[kind]}" if kind != "bridge" else "bridge"
+        sections.append({"name": name, "start": round(float(start), 3), "end": round(float(end), 3),
+                         "density": round(float(value), 2)})
+    return sections
+
+def sections_from_analysis(analysis):
+    """分析結果に保存した構成から、名前付きの区間のリストを作る"""
+    return label_sections(analysis["section_starts"], np.asarray(analysis["section_density"]), analysis["duration"])
+
+def main():
+    import analysis_cache
+    import analyze
+    parser = argparse.ArgumentParser(description="楽曲の構成（区間の境界と密度）を推定して表示する")
+    parser.add_argument("audio", help="音楽ファイル")
+    parser.add_argument("--cache-dir", default=analysis_cache.CACHE_DIR, help="分析結果のキャッシュ先")
+    parser.add_argument("--streaming", action="store_true", help="ブロック単位で分析する（長い曲向け）")
+    args = parser.parse_args()
+    analysis = analyze.analyze_audio_cached(args.audio, args.cache_dir, verbose=False, streaming=args.streaming)
+    print(f"BPM {analysis['bpm']:.1f} 長さ {analysis['duration']:.1f}秒")
+    for section in sections_from_analysis(analysis):
+        print(f"  {section['start']:7.2f}〜{section['end']:7.2f}秒 {section['name']:<8} 密度 {section['density']}")
+
+if __name__ == "__main__":
+    main()
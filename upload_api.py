@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+譜面エディタからのアップロード（server.py / simple_server.py から使う）
+
+    POST /api/uploads?songId=<曲ID>&seed=42[&overwrite=1]
+        本文は chart-editor.js の記録データ（*_raw_recording.json と同じ形）。
+        "settings" に難易度ごとの {"density", "chordLevel"} を入れるとエディタの設定で生成する。
+        本文は読んだそばからディスクに書き出し、202 と {"jobId", "status", "statusUrl"} を返す。
+        assets/charts に譜面がある曲IDは、以前にアップロードで作った曲でなければ 409 を返す
+        （同梱の譜面を上書きするときは overwrite=1 を付ける）
+    GET /api/uploads/<ジョブID>
+        ジョブの状態（queued / running / done / failed）。完了していれば書き出した譜面とノーツ数
+
+譜面の生成（editor_charts.py）はリクエストのスレッドではなくワーカープロセスのプールで行うので、
+生成中も他のクライアントへの配信は止まらない。完了すると assets/charts に
+<曲ID>_raw_recording.json と <曲ID>_<難易度>.json を書き出し、マニフェスト（index.json）も更新する。
+ジョブの状態はサーバーのメモリにだけ持つ（再起動すると消える）。アップロードで作った曲IDは
+uploads/songs/<曲ID> に印を残し、同じ曲の再アップロードはそのまま上書きできるようにする。
+"""
+import glob
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, urlsplit
+
+import chart_api
+from chart_api import NAME_PATTERN, ApiError, json_response
+
+UPLOAD_PATH = "/api/uploads"
+UPLOAD_DIR = "uploads"
+# アップロードで作った曲IDの印を置くディレクトリ（UPLOAD_DIR の中）
+SONGS_DIR = "songs"
+CHARTS_DIR = "assets/charts"
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+CHUNK_BYTES = 64 * 1024
+UPLOAD_WORKERS = 2
+DEFAULT_SEED = 42
+# 保持する終了済みジョブの上限（古いものから消す）
+MAX_FINISHED_JOBS = 1000
+
+def build_upload(upload_path, song_id, seed, charts_dir):
+    """ワーカープロセスで実行する。記録データから全難易度を生成して書き出す"""
+    import chart_index
+    import editor_charts
+    from build_charts import write_outputs
+    from chart_transform import write_json_atomic
+
+    start = time.perf_counter()
+    try:
+        with open(upload_path, 'r', encoding='utf-8') as f:
+            raw = json.load(f)
+        charts = editor_charts.generate_charts(raw, raw.get("settings"), seed)
+    finally:
+        os.unlink(upload_path)
+    # 譜面より先に印を書く（途中で失敗しても、同じ曲の再アップロードで上書きできるように）
+    songs_dir = os.path.join(os.path.dirname(upload_path), SONGS_DIR)
+    os.makedirs(songs_dir, exist_ok=True)
+    with open(os.path.join(songs_dir, song_id), 'w', encoding='utf-8'):
+        pass
+    write_json_atomic(os.path.join(charts_dir, f"{song_id}_raw_recording.json"), raw)
+    paths = {difficulty: os.path.join(charts_dir, f"{song_id}_{difficulty}.json") for difficulty in charts}
+    write_outputs({paths[difficulty]: chart for difficulty, chart in charts.items()})
+    chart_index.build_manifest(charts_dir)
+    return {
+        "charts": {difficulty: {"path": paths[difficulty], "noteCount": len(chart["notes"])}
+                   for difficulty, chart in charts.items()},
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+class Job:
+    def __init__(self, job_id, song_id, future):
+        self.id = job_id
+        self.song_id = song_id
+        self.future = future
+        self.submitted_at = time.time()
+        self.finished_at = None
+        future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        self.finished_at = time.time()
+
+    def status(self):
+        result = {"jobId": self.id, "songId": self.song_id, "submittedAt": self.submitted_at}
+        if not self.future.done():
+            result["status"] = "running" if self.future.running() else "queued"
+            return result
+        result["finishedAt"] = self.finished_at
+        error = self.future.exception()
+        if error is not None:
+            result.update(status="failed", error=str(error) or type(error).__name__)
+        else:
+            result.update(status="done", **self.future.result())
+        return result
+
+class UploadQueue:
+    """アップロードの受け付けと、生成ジョブの管理（スレッドセーフ）"""
+    def __init__(self, upload_dir=UPLOAD_DIR, charts_dir=CHARTS_DIR, workers=UPLOAD_WORKERS):
+        self.upload_dir = upload_dir
+        self.charts_dir = charts_dir
+        self.workers = workers
+        self.executor = None
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def receive(self, rfile, length):
+        """本文をチャンクごとにディスクへ書き出し、ファイルのパスを返す"""
+        os.makedirs(self.upload_dir, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.upload_dir, f"{job_id}.json")
+        tmp = path + ".part"
+        remaining = length
+        try:
+            with open(tmp, 'wb') as f:
+                while remaining:
+                    chunk = rfile.read(min(CHUNK_BYTES, remaining))
+                    if not chunk:
+                        raise ApiError(400, "本文が途中で切れました")
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return job_id, path
+
+    def uploaded(self, song_id):
+        """song_id がアップロードで作った曲か"""
+        return os.path.exists(os.path.join(self.upload_dir, SONGS_DIR, song_id))
+
+    def check_song(self, song_id, overwrite):
+        """アップロードで作っていない曲の譜面を上書きしようとしていれば409にする"""
+        if overwrite or self.uploaded(song_id):
+            return
+        # 曲IDは英数字・ハイフンだけなので、そのままglobのパターンに使える
+        existing = glob.glob(os.path.join(self.charts_dir, f"{song_id}_*.json"))
+        if existing or os.path.exists(os.path.join(self.charts_dir, f"{song_id}.json")):
+            raise ApiError(409, f"曲IDの譜面がすでにあります（上書きするときは overwrite=1 を付けてください）: {song_id}")
+
+    def submit(self, job_id, path, song_id, seed):
+        with self.lock:
+            for attempt in range(2):
+                if self.executor is None:
+                    # スレッドを持つサーバープロセスからforkしないようspawnで起動する
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                        mp_context=multiprocessing.get_context("spawn"))
+                try:
+                    future = self.executor.submit(build_upload, path, song_id, seed, self.charts_dir)
+                    break
+                except BrokenProcessPool:
+                    # ワーカーが異常終了したプールは使えないので作り直す
+                    self.executor = None
+                    if attempt:
+                        raise
+            job = Job(job_id, song_id, future)
+            self.jobs[job_id] = job
+            finished = [key for key, old in self.jobs.items() if old.future.done()]
+            for key in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[key]
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise ApiError(404, f"ジョブがありません: {job_id}")
+        return job
+
+queue = UploadQueue()
+
+def parse_seed(query):
+    values = query.get("seed")
+    if not values:
+        return DEFAULT_SEED
+    try:
+        return int(values[0])
+    except ValueError:
+        raise ApiError(400, f"seedは整数で指定してください: {values[0]}")
+
+def parse_overwrite(query):
+    value = query.get("overwrite", [""])[0].lower()
+    if value not in ("", "0", "1", "false", "true"):
+        raise ApiError(400, f"overwriteは1か0で指定してください: {value}")
+    return value in ("1", "true")
+
+def discard(rfile, length):
+    """受け付けない本文を読み捨てる（keep-aliveの次のリクエストと混ざらないように）"""
+    while length:
+        chunk = rfile.read(min(CHUNK_BYTES, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+
+def respond_post(url, content_length, rfile):
+    """POST /api/uploads の (ステータス, ヘッダーのdict, 本文のbytes) を返す。
+    411・413のときは本文を読んでいないので、呼び出し側で接続を閉じる"""
+    try:
+        length = chart_api.content_length(content_length, MAX_UPLOAD_BYTES)
+    except ApiError as e:
+        return json_response(e.status, {"error": str(e)})
+    try:
+        parts = urlsplit(url)
+        if parts.path.rstrip("/") != UPLOAD_PATH:
+            raise ApiError(404, "不明なAPIです")
+        query = parse_qs(parts.query)
+        song_id = query.get("songId", [""])[0]
+        # 譜面のファイル名は <曲ID>_<難易度>.json なので、曲IDにはアンダースコアを使えない
+        if not NAME_PATTERN.match(song_id) or "_" in song_id:
+            raise ApiError(400, "songIdは英数字・ハイフンで指定してください")
+        seed = parse_seed(query)
+        queue.check_song(song_id, parse_overwrite(query))
+    except ApiError as e:
+        discard(rfile, length)
+        return json_response(e.status, {"error": str(e)})
+    try:
+        job_id, path = queue.receive(rfile, length)
+        job = queue.submit(job_id, path, song_id, seed)
+    except ApiError as e:
+        return json_response(e.status, {"error": str(e)})
+
+    status_url = f"{UPLOAD_PATH}/{job.id}"
+    status, headers, body = json_response(202, dict(job.status(), statusUrl=status_url))
+    headers["Location"] = status_url
+    return status, headers, body
+
+def respond_status(url):
+    """GET /api/uploads/<ジョブID> の (ステータス, ヘッダーのdict, 本文のbytes) を返す"""
+    job_id = urlsplit(url).path[len(UPLOAD_PATH):].strip("/")
+    try:
+        if not NAME_PATTERN.match(job_id):
+            raise ApiError(404, "不明なAPIです")
+        return json_response(200, queue.get(job_id).status())
+    except ApiError as e:
+        return json_response(e.status, {"error": str(e)})